@@ -0,0 +1,191 @@
+import time
+import argparse
+from collections import OrderedDict
+
+import sqlparse
+
+from database import parse_sql, Select, Insert, Update, UpdateSet, Delete, \
+    Control
+
+
+# the statements twitter.py sends, one of each shape
+CORPUS = [
+    "INSERT INTO users VALUES ('alice', '5f4dcc3b5aa765d61d8327deb882cf99', '2021-03-01 10:00:00');",
+    "SELECT FROM users WHERE username == 'alice' and password == '5f4dcc3b5aa765d61d8327deb882cf99';",
+    "SELECT FROM users WHERE id == '12';",
+    "INSERT INTO tweets VALUES ('12', 'alice', 'hello, world; again', '2021-03-01 10:00:00', '', '', 0);",
+    "SELECT FROM tweets WHERE id == 381;",
+    "SELECT FROM tweets;",
+    "SELECT FROM tweet_likes WHERE user_id == 12;",
+    "SELECT FROM tweets WHERE text CONTAINS 'hello';",
+    "UPDATE tweets SET likes = likes + 1 WHERE id == 381;",
+    "DELETE FROM tweet_likes WHERE user_id == 12 AND tweet_id == 381;",
+    "INSERT INTO tweet_likes VALUES (381, 12);",
+    "SELECT FROM users WHERE id == 3 OR id == 7 OR id == 12 OR id == 40;",
+    "DELETE FROM tweets WHERE id == 381 AND user_id == 12;",
+    "UPDATE users WHERE id == 12 VALUES ('alice', 'secret', '2021-03-01 10:00:00');",
+    "BEGIN; COMMIT;",
+]
+
+
+class LegacyParser(object):
+    '''The sqlparse based parsing Database.run_query did before, reduced
+    to building the same statement tuples as parse_sql.'''
+
+    def _where(self, where):
+        cond = []
+        for token in where[1:]:  # start after where keyword
+            if token.ttype == sqlparse.tokens.Whitespace:
+                continue
+
+            elif isinstance(token, sqlparse.sql.Comparison):
+                op = token.value \
+                    .replace(token.left.value, '') \
+                    .replace(token.right.value, '') \
+                    .strip()
+                cond.extend([token.left.value, op, token.right.value])
+            elif token.match(sqlparse.tokens.Keyword, ['AND', 'OR']):
+                cond.append(token.value)
+            elif token.match(sqlparse.tokens.Keyword, ['CONTAINS', 'MATCH']):
+                cond.append(token.value.upper())
+            elif cond[-1:] in (['CONTAINS'], ['MATCH']) \
+                    and token.ttype == sqlparse.tokens.String.Single:
+                cond.append(token.value)
+            elif (not cond or cond[-1].upper() in ('AND', 'OR')) \
+                    and (isinstance(token, sqlparse.sql.Identifier)
+                         or token.ttype in sqlparse.tokens.Name):
+                cond.append(token.value)  # left side of CONTAINS
+            else:
+                raise ValueError('Error in where clause syntax')
+        return cond
+
+    def _values(self, values):
+        fields = []
+        for token in values[1:]:  # start after value keyword
+            if isinstance(token, sqlparse.sql.Parenthesis):
+                for vals in token:
+                    if vals.ttype == sqlparse.tokens.Punctuation:
+                        continue
+                    try:
+                        parts = [v for v in vals if v.ttype not in (
+                            sqlparse.tokens.Punctuation, sqlparse.tokens.Whitespace)]
+                    except TypeError:
+                        parts = [vals]
+                    for val in parts:
+                        v = val.value
+                        if v.startswith("'") and v.endswith("'"):
+                            v = v[1:-1]
+                        fields.append(v)
+        return fields
+
+    def _update_set(self, table, st):
+        where = None
+        assignments = OrderedDict()
+        parts = [[]]
+        for token in st:
+            if isinstance(token, sqlparse.sql.Where):
+                where = self._where(token)
+                break
+            for t in token.flatten():
+                if t.ttype == sqlparse.tokens.Whitespace:
+                    continue
+                if t.match(sqlparse.tokens.Punctuation, [',']):
+                    parts.append([])
+                    continue
+                parts[-1].append(t.value)
+
+        for part in parts:
+            column, _, *expr = part
+            if len(expr) == 1:
+                v = expr[0]
+                if v.startswith("'") and v.endswith("'"):
+                    v = v[1:-1]
+                assignments[column] = ('value', v)
+            elif len(expr) == 3:
+                assignments[column] = ('add', expr[0], f'{expr[1]}{expr[2]}')
+            else:
+                assignments[column] = ('add', expr[0], expr[1])
+        return UpdateSet(table, assignments, where)
+
+    def _statement(self, statement):
+        _type = statement.get_type()
+        st = filter(lambda t: t.ttype != sqlparse.tokens.Whitespace, statement)
+        first = next(st)
+
+        if _type == 'SELECT':
+            next(st)
+            table = next(st).value
+            where = next(st, None)
+            return Select(table, where and self._where(where), None)
+        if _type == 'DELETE':
+            next(st)
+            table = next(st).value
+            where = next(st, None)
+            return Delete(table, where and self._where(where))
+        if _type == 'INSERT':
+            next(st)
+            table = next(st).value
+            return Insert(table, self._values(next(st)))
+        if _type == 'UPDATE':
+            table = next(st).value
+            where_n_values = next(st)
+            if where_n_values.match(sqlparse.tokens.Keyword, ['SET']):
+                return self._update_set(table, st)
+            values_idx = [n for n, i in enumerate(where_n_values)
+                          if i.match(sqlparse.tokens.Keyword, 'VALUES')][-1]
+            return Update(table, self._where(where_n_values[:values_idx]),
+                          self._values(where_n_values[values_idx:]))
+        if _type == 'START' or first.normalized == 'BEGIN':
+            return Control('BEGIN')
+        return Control(_type)
+
+    def parse(self, query):
+        splited = sqlparse.split(query)
+        if not all(p.endswith(';') for p in splited):
+            raise ValueError('Query should be ended with ;')
+
+        statements = []
+        for part in splited:
+            for statement in sqlparse.parse(part.strip(';')):
+                statements.append(self._statement(statement))
+        return statements
+
+
+def comparable(statements):
+    return [s._replace(text=None) if isinstance(s, Select) else s
+            for s in statements]
+
+
+def timed(parse, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for query in CORPUS:
+            parse(query)
+    return (time.perf_counter() - start) / (rounds * len(CORPUS)) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Compare the query parser of Database.run_query with the '
+                    'sqlparse based one it replaced.')
+    parser.add_argument('--rounds', type=int, default=200,
+                        help='times to parse the whole corpus (default: 200)')
+    args = parser.parse_args()
+
+    legacy = LegacyParser()
+    for query in CORPUS:
+        old, new = legacy.parse(query), comparable(parse_sql(query))
+        if old != new:
+            raise SystemExit(f'parsers disagree on {query}\n  sqlparse: {old}\n  '
+                             f'parse_sql: {new}')
+
+    old = timed(legacy.parse, args.rounds)
+    new = timed(parse_sql, args.rounds)
+    print(f'{len(CORPUS)} statements x {args.rounds} rounds')
+    print(f'{"sqlparse".ljust(12)}{old:>10.1f} us/query')
+    print(f'{"parse_sql".ljust(12)}{new:>10.1f} us/query')
+    print(f'\n{old / new:.1f}x faster')
+
+
+if __name__ == '__main__':
+    main()
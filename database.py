@@ -1,19 +1,25 @@
+import io
 import re
+import json
 import os
 import sys
 import csv
-import sqlparse
+import time
+import operator
+import locale
+import math
+import bisect
+import functools
+import shutil
 import tempfile
+import threading
+import asyncio
+import hashlib
+import importlib
 from pathlib import Path
 from datetime import datetime
-from collections import OrderedDict
-from contextlib import contextmanager
-
-from pygments.lexers.sql import SqlLexer
-from prompt_toolkit import PromptSession
-from prompt_toolkit.lexers import PygmentsLexer
-from prompt_toolkit.completion import WordCompleter
-from prompt_toolkit import print_formatted_text, HTML
+from collections import OrderedDict, Counter, namedtuple
+from contextlib import contextmanager, nullcontext, ExitStack
 
 
 class CharField(str):
@@ -107,18 +113,991 @@ class TimestampField(datetime):
         return Timestamp
 
 
+_sql_token_re = re.compile(r"""
+    (?P<ws>\s+)
+  | (?P<comment>--[^\n]*)
+  | (?P<string>'(?:[^'\\]|\\.|'')*')
+  | (?P<number>[-+]?\d+(?:\.\d+)?)
+  | (?P<op>==|!=|<=|>=|<|>|=)
+  | (?P<punct>[(),;*+-])
+  | (?P<name>[A-Za-z_][A-Za-z0-9_]*)
+""", re.VERBOSE)
+
+_comparisons = {'==': operator.eq, '!=': operator.ne, '<': operator.lt,
+                '<=': operator.le, '>': operator.gt, '>=': operator.ge}
+_aggregates = ('COUNT', 'SUM', 'MAX', 'MIN')
+_numeric_types = ('INTEGER', 'BOOLEAN', 'TIMESTAMP')
+
+Select = namedtuple('Select', 'table where text order_by', defaults=(None,))
+Aggregate = namedtuple('Aggregate', 'table func column where group_by')
+Insert = namedtuple('Insert', 'table values')
+Update = namedtuple('Update', 'table where values')
+UpdateSet = namedtuple('UpdateSet', 'table assignments where')
+Delete = namedtuple('Delete', 'table where')
+Control = namedtuple('Control', 'action')  # BEGIN, COMMIT or ROLLBACK
+Analyze = namedtuple('Analyze', 'table')
+Explain = namedtuple('Explain', 'statement')
+
+
+def lex_sql(query):
+    """(kind, text) tokens of a query, whitespace and -- comments dropped."""
+    tokens = []
+    pos = 0
+    end = len(query)
+    while pos < end:
+        m = _sql_token_re.match(query, pos)
+        if m is None:
+            raise ValueError('Error in query syntax')
+        if m.lastgroup not in ('ws', 'comment'):
+            tokens.append((m.lastgroup, m.group()))
+        pos = m.end()
+    return tokens
+
+
+class SQLParser(object):
+    """Recursive-descent parser of the statements Database runs:
+
+        SELECT FROM <table> [WHERE <cond>] [ORDER BY <col> [ASC|DESC]];
+        SELECT COUNT(*) | SUM|MAX|MIN(<col>) FROM <table> [WHERE <cond>] [GROUP BY <col>];
+        INSERT INTO <table> VALUES (<value>, ...);
+        UPDATE <table> SET <col> = <value> | <col> (+|-) <n>, ... [WHERE <cond>];
+        UPDATE <table> WHERE <cond> VALUES (<value>, ...);
+        DELETE FROM <table> [WHERE <cond>];
+        BEGIN | START TRANSACTION | COMMIT | ROLLBACK;
+        ANALYZE [<table>];
+        EXPLAIN SELECT ...;
+
+    A where clause comes out as the flat list the tables evaluate, like
+    ['id', '==', '3', 'AND', '(', 'text', 'CONTAINS', "'hi'", ')']."""
+
+    def __init__(self, query):
+        self.tokens = lex_sql(query)
+        self.pos = 0
+
+    def _peek(self, offset=0):
+        i = self.pos + offset
+        return self.tokens[i] if i < len(self.tokens) else (None, None)
+
+    def _next(self):
+        token = self._peek()
+        if token[0] is None:
+            raise ValueError('Error in query syntax')
+        self.pos += 1
+        return token
+
+    def _keyword(self, *words):
+        """Consume the next token if it is one of the keywords."""
+        kind, text = self._peek()
+        if kind == 'name' and text.upper() in words:
+            self.pos += 1
+            return text.upper()
+        return None
+
+    def _expect(self, *words):
+        if not self._keyword(*words):
+            raise ValueError('Error in query syntax')
+
+    def _name(self):
+        kind, text = self._next()
+        if kind != 'name':
+            raise ValueError('Error in query syntax')
+        return text
+
+    def _punct(self, char):
+        if self._peek() == ('punct', char):
+            self.pos += 1
+            return True
+        return False
+
+    def parse(self):
+        """Generate the statements, every one must end with ;"""
+        while self.pos < len(self.tokens):
+            if self._punct(';'):
+                continue
+            start = self.pos
+            statement = self._statement(start)
+            if not self._punct(';'):
+                if self.pos >= len(self.tokens):
+                    raise ValueError('Query should be ended with ;')
+                raise ValueError('Error in query syntax')
+            yield statement
+
+    def _statement(self, start):
+        kind, text = self._next()
+        word = text.upper() if kind == 'name' else None
+        if word == 'SELECT':
+            func = self._keyword(*_aggregates)
+            if func:
+                return self._aggregate(func)
+            self._expect('FROM')
+            table = self._name()
+            where = self._where()
+            order_by = None
+            if self._keyword('ORDER'):
+                self._expect('BY')
+                order_by = self._name(), self._keyword('ASC', 'DESC') == 'DESC'
+            return Select(table, where,
+                          ' '.join(t for _, t in self.tokens[start:self.pos]),
+                          order_by)
+        if word == 'INSERT':
+            self._expect('INTO')
+            table = self._name()
+            self._expect('VALUES')
+            return Insert(table, self._values())
+        if word == 'UPDATE':
+            table = self._name()
+            if self._keyword('SET'):
+                assignments = self._assignments()
+                return UpdateSet(table, assignments, self._where())
+            where = self._where(until='VALUES')
+            if where is None or not self._keyword('VALUES'):
+                raise ValueError('Error in query syntax')
+            return Update(table, where, self._values())
+        if word == 'DELETE':
+            self._expect('FROM')
+            table = self._name()
+            return Delete(table, self._where())
+        if word in ('BEGIN', 'START'):
+            self._keyword('TRANSACTION')
+            return Control('BEGIN')
+        if word in ('COMMIT', 'ROLLBACK'):
+            self._keyword('TRANSACTION')
+            return Control(word)
+        if word == 'ANALYZE':
+            return Analyze(self._name() if self._peek()[0] == 'name' else None)
+        if word == 'EXPLAIN':
+            statement = self._statement(self.pos)
+            if not isinstance(statement, Select):
+                raise ValueError('Only selects can be explained')
+            return Explain(statement)
+        raise ValueError('Error in query syntax')
+
+    def _aggregate(self, func):
+        if not self._punct('('):
+            raise ValueError('Error in query syntax')
+        column = None
+        if not (func == 'COUNT' and self._punct('*')):
+            column = self._name()
+        if not self._punct(')'):
+            raise ValueError('Error in query syntax')
+        self._expect('FROM')
+        table = self._name()
+        where = self._where()
+        group_by = None
+        if self._keyword('GROUP'):
+            self._expect('BY')
+            group_by = self._name()
+        return Aggregate(table, func, column, where, group_by)
+
+    def _values(self):
+        if not self._punct('('):
+            raise ValueError('Error in query syntax')
+        values = []
+        while True:
+            kind, text = self._next()
+            if kind == 'string':
+                values.append(text[1:-1])
+            elif kind in ('number', 'name'):
+                values.append(text)
+            else:
+                raise ValueError('Error in query syntax')
+            if self._punct(')'):
+                return values
+            if not self._punct(','):
+                raise ValueError('Error in query syntax')
+
+    def _assignments(self):
+        assignments = OrderedDict()
+        while True:
+            column = self._name()
+            if self._next() != ('op', '='):
+                raise ValueError('Error in query syntax')
+            kind, text = self._next()
+            following = self._peek()
+            if kind == 'name' and following in (('punct', '+'), ('punct', '-')):
+                self.pos += 1
+                sign = following[1]
+                kind, delta = self._next()
+                if kind != 'number' or delta[0] in '+-':
+                    raise ValueError('Error in query syntax')
+                assignments[column] = ('add', text, f'{sign}{delta}')
+            elif kind == 'name' and following[0] == 'number' and following[1][0] in '+-':
+                self.pos += 1
+                assignments[column] = ('add', text, following[1])
+            elif kind == 'string':
+                assignments[column] = ('value', text[1:-1])
+            elif kind in ('number', 'name'):
+                assignments[column] = ('value', text)
+            else:
+                raise ValueError('Error in query syntax')
+            if not self._punct(','):
+                return assignments
+
+    def _where(self, until=None):
+        if not self._keyword('WHERE'):
+            return None
+        cond = []
+        self._condition(cond, until)
+        return cond
+
+    def _condition(self, cond, until, depth=0):
+        while True:
+            self._term(cond, until, depth)
+            kind, text = self._peek()
+            if kind == 'name' and text.upper() in ('AND', 'OR'):
+                self.pos += 1
+                cond.append(text)
+                continue
+            return
+
+    def _term(self, cond, until, depth):
+        if self._punct('('):
+            cond.append('(')
+            self._condition(cond, until, depth + 1)
+            if not self._punct(')'):
+                raise ValueError('Error in where clause syntax')
+            cond.append(')')
+            return
+
+        kind, left = self._peek()
+        if kind != 'name' or (until and left.upper() == until):
+            raise ValueError('Error in where clause syntax')
+        self.pos += 1
+
+        kind, op = self._peek()
+        if kind == 'op' and op in _comparisons:
+            self.pos += 1
+            kind, right = self._peek()
+            if kind not in ('string', 'number', 'name'):
+                raise ValueError('Error in where clause syntax')
+            self.pos += 1
+            cond.extend([left, op, right])
+        elif kind == 'name' and op.upper() in ('CONTAINS', 'MATCH'):
+            self.pos += 1
+            kind, right = self._peek()
+            if kind != 'string':
+                raise ValueError('Error in where clause syntax')
+            self.pos += 1
+            cond.extend([left, op.upper(), right])
+        else:
+            raise ValueError('Error in where clause syntax')
+
+
+def parse_sql(query):
+    return list(SQLParser(query).parse())
+
+
+class RWLock(object):
+    """Readers share the lock, writers get it alone. Waiting writers hold
+    off new readers, but a thread already reading may read again, and the
+    writing thread may re-enter both sides. A reader can't take the write
+    side."""
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._readers = 0
+        self._reading = {}  # thread id -> read depth
+        self._writer = None
+        self._writer_depth = 0
+        self._waiting_writers = 0
+
+    @contextmanager
+    def read(self):
+        me = threading.get_ident()
+        with self._cond:
+            if self._writer != me and me not in self._reading:
+                while self._writer is not None or self._waiting_writers:
+                    self._cond.wait()
+            self._reading[me] = self._reading.get(me, 0) + 1
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._readers -= 1
+                self._reading[me] -= 1
+                if not self._reading[me]:
+                    del self._reading[me]
+                if not self._readers:
+                    self._cond.notify_all()
+
+    @contextmanager
+    def write(self):
+        me = threading.get_ident()
+        with self._cond:
+            if self._writer != me:
+                self._waiting_writers += 1
+                try:
+                    while self._writer is not None or self._readers:
+                        self._cond.wait()
+                finally:
+                    self._waiting_writers -= 1
+                self._writer = me
+            self._writer_depth += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._writer_depth -= 1
+                if not self._writer_depth:
+                    self._writer = None
+                    self._cond.notify_all()
+
+
+def _numpy():
+    # numpy is only needed by the column scans, the rest works without it
+    try:
+        import numpy
+    except ImportError:
+        raise ValueError('column scans need numpy, install it with pip install numpy')
+    return numpy
+
+
+def tokenize(text):
+    """Lowercased words of a text, hashtags and mentions are kept both
+    with and without their sign."""
+    tokens = set()
+    for token in re.findall(r'[#@]?\w+', text.lower()):
+        tokens.add(token)
+        if token[0] in '#@':
+            tokens.add(token[1:])
+    return tokens
+
+
+def match(text, query):
+    return tokenize(query) <= tokenize(text)
+
+
+def id_terms(condition):
+    """Sorted ids of a condition made only of id == terms joined by OR,
+    or None for any other condition."""
+    if not condition or len(condition) % 4 != 3:
+        return None
+    ids = set()
+    for i in range(0, len(condition), 4):
+        left, op, right = condition[i:i+3]
+        if left != 'id' or op != '==' or i and condition[i-1].upper() != 'OR':
+            return None
+        try:
+            ids.add(int(right.strip("'")))
+        except ValueError:
+            return None
+    return sorted(ids)
+
+
+def condition_tree(condition):
+    """A where clause as nested ('AND', [...]) and ('OR', [...]) groups of
+    (left, op, right) terms, AND binding tighter than OR like in the row
+    scans. Parentheses become groups, groups of one kind are merged."""
+    pos = 0
+
+    def term():
+        nonlocal pos
+        if condition[pos] == '(':
+            pos += 1
+            node = either()
+            pos += 1  # the closing parenthesis
+            return node
+        pos += 3
+        return tuple(condition[pos - 3:pos])
+
+    def group(kind, part):
+        nonlocal pos
+        children = [part()]
+        while pos < len(condition) and condition[pos].upper() == kind:
+            pos += 1
+            children.append(part())
+        if len(children) == 1:
+            return children[0]
+        merged = []
+        for child in children:
+            merged.extend(child[1] if len(child) == 2 and child[0] == kind else [child])
+        return kind, merged
+
+    def both():
+        return group('AND', term)
+
+    def either():
+        return group('OR', both)
+
+    return either()
+
+
+def flatten_condition(node):
+    """The where clause of a condition tree."""
+    if len(node) == 3:
+        return list(node)
+    flat = []
+    for child in node[1]:
+        if flat:
+            flat.append(node[0])
+        if len(child) == 2 and child[0] == 'OR':
+            flat.extend(['(', *flatten_condition(child), ')'])
+        else:
+            flat.extend(flatten_condition(child))
+    return flat
+
+
+def scan_range(path, start, end, condition, encoding):
+    """Evaluate a compiled where clause over the rows in [start, end) of a
+    data file, both ends on row boundaries. Returns the number of rows read
+    and (row number, offset, size, row) of every match."""
+    code = compile(condition, '<where>', 'eval')
+    with open(path, 'rb') as f:
+        f.seek(start)
+        lines = f.read(end - start).split(b'\n')
+    if lines and not lines[-1]:
+        lines.pop()
+
+    matched = []
+    offset = start
+    decoded = (line.decode(encoding) for line in lines)
+    for line_c, (line, row) in enumerate(
+            zip(lines, csv.reader(decoded, delimiter=' ')), 1):
+        if eval(code, {"row": row, "match": match}):
+            matched.append((line_c, offset, len(line) + 1, row))
+        offset += len(line) + 1
+    return len(lines), matched
+
+
+_scan_pool = None
+_scan_pool_lock = threading.Lock()
+scan_workers = os.cpu_count() or 1
+
+
+def get_scan_pool():
+    global _scan_pool
+    with _scan_pool_lock:
+        if _scan_pool is None:
+            from concurrent.futures import ProcessPoolExecutor  # pulls in multiprocessing
+
+            # workers only run scan_range, which takes no locks, so the
+            # platform's default start method is fine even under threads
+            _scan_pool = ProcessPoolExecutor(max_workers=scan_workers)
+        return _scan_pool
+
+
+class FullTextIndex(object):
+    """Inverted index (token -> row ids) of one CHAR column, persisted as an
+    append-only log of added and removed postings next to the table."""
+
+    suffix = 'fts'
+    magic = 'FTS1'
+    operators = ('CONTAINS', 'MATCH')  # the where clause terms it answers
+
+    def __init__(self, table, field_name):
+        self.table = table
+        self.field_name = field_name
+        self._file = table._data_dir / f'{table.table_name}.{field_name}.{self.suffix}'
+        self._postings = None
+        self._log_lines = 0
+        self._known = None  # (inode, size) of the log read so far
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return f'<FullTextIndex {self.table.table_name}.{self.field_name}>'
+
+    def _is_stale(self):
+        try:
+            return self._file.stat().st_mtime_ns < self.table.data_mtime_ns()
+        except FileNotFoundError:
+            return True
+
+    def _load(self):
+        postings = {}
+        with open(self._file, 'rb') as f:
+            if f.readline() != f'{self.magic}\n'.encode():
+                raise ValueError(f'{self._file.name} is not a {type(self).__name__}')
+            live = self._read_log(postings, f)
+        self._postings = postings
+        if self._log_lines > 2 * max(live, 1):
+            self._write_snapshot()
+
+    def _read_log(self, postings, f):
+        """Apply the complete lines of the log from where f is, returns how
+        many rows they add."""
+        live = 0
+        pos = f.tell()
+        for line in f:
+            if not line.endswith(b'\n'):
+                break  # still being written
+            pos += len(line)
+            op, row_id, *tokens = line.decode('utf-8').split()
+            row_id = int(row_id)
+            self._log_lines += 1
+            for token in tokens:
+                if op == '+':
+                    self._post(postings, token, row_id)
+                else:
+                    self._unpost(postings, token, row_id)
+            live += 1 if op == '+' else -1
+        self._known = os.fstat(f.fileno()).st_ino, pos
+        return live
+
+    def _catch_up(self):
+        """Apply what other processes wrote to the log since it was read."""
+        try:
+            st = self._file.stat()
+        except FileNotFoundError:
+            return
+        with self._lock:
+            ino, size = self._known
+            if (st.st_ino, st.st_size) == (ino, size):
+                return
+            if st.st_ino != ino:
+                self._load()  # written again as a snapshot
+                return
+            with open(self._file, 'rb') as f:
+                f.seek(size)
+                self._read_log(self._postings, f)
+
+    def _write_snapshot(self):
+        by_id = {}
+        for token, ids in self._postings.items():
+            for row_id in ids:
+                by_id.setdefault(row_id, []).append(token)
+
+        tmp = self._file.with_suffix(f'.{self.suffix}.tmp')
+        with open(tmp, 'w', encoding='utf-8') as f:
+            f.write(f'{self.magic}\n')
+            for row_id in sorted(by_id):
+                f.write(f'+ {row_id} {" ".join(by_id[row_id])}\n')
+            f.flush()
+            self._known = os.fstat(f.fileno()).st_ino, f.tell()
+        os.replace(tmp, self._file)
+        self._log_lines = len(by_id)
+
+    def rebuild(self):
+        with self._lock:
+            self._postings = {}
+            with self.table.get_reader() as reader:
+                idx = list(self.table).index(self.field_name)
+                for row in reader:
+                    for token in self._tokens(row[idx]):
+                        self._post(self._postings, token, int(row[0]))
+            self._write_snapshot()
+
+    def ensure(self):
+        if self._postings is None:
+            if self._is_stale():
+                self.rebuild()
+            else:
+                with self._lock:
+                    self._load()
+        else:
+            self._catch_up()
+
+    def _append(self, op, row_id, tokens):
+        with open(self._file, 'a', encoding='utf-8') as f:
+            f.write(f'{op} {row_id} {" ".join(sorted(tokens))}\n')
+            f.flush()
+            self._known = self._known[0], f.tell()
+        self._log_lines += 1
+
+    def _tokens(self, value):
+        return tokenize(value)
+
+    @staticmethod
+    def _post(postings, token, row_id):
+        postings.setdefault(token, set()).add(row_id)
+
+    @staticmethod
+    def _unpost(postings, token, row_id):
+        if (ids := postings.get(token)) is not None:
+            ids.discard(row_id)
+            if not ids:
+                del postings[token]
+
+    def add(self, row_id, value):
+        self.ensure()
+        tokens = self._tokens(value)
+        with self._lock:
+            for token in tokens:
+                self._post(self._postings, token, row_id)
+            self._append('+', row_id, tokens)
+
+    def remove(self, row_id, value):
+        self.ensure()
+        tokens = self._tokens(value)
+        with self._lock:
+            for token in tokens:
+                self._unpost(self._postings, token, row_id)
+            self._append('-', row_id, tokens)
+
+    def touch(self):
+        self.ensure()
+        now = time.time_ns()  # not before the data file's mtime, see Table._changed
+        os.utime(self._file, ns=(now, now))
+
+    def search(self, query):
+        """Sorted ids of the rows having every token of the query."""
+        self.ensure()
+        tokens = sorted(tokenize(query),
+                        key=lambda t: len(self._postings.get(t, ())))
+        if not tokens:
+            return []
+        with self._lock:
+            ids = set(self._postings.get(tokens[0], ()))
+            for token in tokens[1:]:
+                ids &= self._postings.get(token, set())
+                if not ids:
+                    break
+        return sorted(ids)
+
+    def count(self, query):
+        """At most how many ids search(query) gives, without finding them."""
+        self.ensure()
+        with self._lock:
+            return min((len(self._postings.get(t, ())) for t in tokenize(query)), default=0)
+
+    def matches(self, query, value):
+        """Whether search(query) would give a row with the value."""
+        tokens = tokenize(query)
+        return bool(tokens) and tokens <= tokenize(value)
+
+
+class ValueIndex(FullTextIndex):
+    """Sorted ids of the rows having each value of one INTEGER column, in
+    the same log as a FullTextIndex. A page of the newest rows of a value
+    costs the size of the page, however many rows have it."""
+
+    suffix = 'idx'
+    magic = 'IDX1'
+    operators = ('==',)
+
+    def __repr__(self):
+        return f'<ValueIndex {self.table.table_name}.{self.field_name}>'
+
+    @staticmethod
+    def _key(value):
+        try:
+            return str(int(value))
+        except ValueError:
+            return str(value)
+
+    def _tokens(self, value):
+        return [self._key(value)]
+
+    @staticmethod
+    def _post(postings, token, row_id):
+        ids = postings.setdefault(token, [])
+        i = bisect.bisect_left(ids, row_id)
+        if i == len(ids) or ids[i] != row_id:
+            ids.insert(i, row_id)  # at the end, unless ids come out of order
+
+    @staticmethod
+    def _unpost(postings, token, row_id):
+        if (ids := postings.get(token)) is not None:
+            i = bisect.bisect_left(ids, row_id)
+            if i < len(ids) and ids[i] == row_id:
+                del ids[i]
+            if not ids:
+                del postings[token]
+
+    def search(self, query):
+        """Sorted ids of the rows having the value."""
+        self.ensure()
+        with self._lock:
+            return list(self._postings.get(self._key(query), ()))
+
+    def count(self, query):
+        self.ensure()
+        with self._lock:
+            return len(self._postings.get(self._key(query), ()))
+
+    def page(self, query, limit, reverse=False, before=None):
+        """Sorted ids of the first limit rows having the value, or with
+        reverse of the last limit ones before the id before."""
+        self.ensure()
+        with self._lock:
+            ids = self._postings.get(self._key(query), [])
+            if not reverse:
+                return ids[:limit]
+            end = len(ids) if before is None else bisect.bisect_left(ids, int(before))
+            return ids[max(end - limit, 0):end]
+
+    def matches(self, query, value):
+        return self._key(query) == self._key(value)
+
+
+class _SnapshotFile(io.RawIOBase):
+    """Read-only view of the first size bytes of an open file, with a
+    position of its own. Many of them can share one descriptor."""
+
+    def __init__(self, fd, size, f=None):
+        self._fd = fd
+        self._size = size
+        self._pos = 0
+        self._f = f  # keeps the descriptor open while this is in use
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, b):
+        data = os.pread(self._fd, min(len(b), max(self._size - self._pos, 0)), self._pos)
+        b[:len(data)] = data
+        self._pos += len(data)
+        return len(data)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        base = {os.SEEK_SET: 0, os.SEEK_CUR: self._pos, os.SEEK_END: self._size}[whence]
+        self._pos = base + offset
+        return self._pos
+
+    def tell(self):
+        return self._pos
+
+
+class _DeferredIndex(object):
+    """Stands in for an index in a transaction, the changes reach the index
+    on commit. Searches see them already."""
+
+    def __init__(self, index):
+        self.index = index
+        self.operators = index.operators
+        self.ops = []
+
+    def add(self, row_id, text):
+        self.ops.append(('add', row_id, text))
+
+    def remove(self, row_id, text):
+        self.ops.append(('remove', row_id, text))
+
+    def ensure(self):
+        self.index.ensure()
+
+    def touch(self):
+        pass
+
+    def search(self, query):
+        ids = set(self.index.search(query))
+        for op, row_id, value in self.ops:
+            if self.index.matches(query, value):
+                if op == 'add':
+                    ids.add(row_id)
+                else:
+                    ids.discard(row_id)
+        return sorted(ids)
+
+    def count(self, query):
+        return self.index.count(query) + sum(op == 'add' for op, *_ in self.ops)
+
+
+class _DeferredLog(object):
+    """Collects the ReplicationLog entries of a transaction until commit."""
+
+    def __init__(self):
+        self.entries = []
+
+    def append(self, table_name, op, rows):
+        self.entries.append((table_name, op, rows))
+
+
 class Table(OrderedDict):
-    def __init__(self, table_name: str, fields: dict, data_dir: Path):
+    _encoding = locale.getpreferredencoding(False)  # what open() uses
+    column_scans = False  # answer numeric where clauses from the column arrays
+
+    def __init__(self, table_name: str, fields: dict, data_dir: Path,
+                 indexes: dict = None, parallel_scan_threshold: int = None,
+                 file_name: str = None):
         self.table_name = table_name
-        self._file = data_dir / f'{table_name}.txt'
-        self._file.touch(exist_ok=True)
+        self.parallel_scan_threshold = parallel_scan_threshold
+        self._data_dir = data_dir
+        self._is_segment = file_name is not None
+        self._file = data_dir / (file_name or f'{table_name}.txt')
+        self._lock = RWLock()
+        self.version = 0  # bumped on every change of the data file
+        self.log = None  # ReplicationLog of a primary database
+        self._snap_lock = threading.Lock()  # taken to pin or swap the data file
+        self._readers = 0  # open snapshots of the current data file
+        self._generation = 0  # bumped whenever the data file is swapped
+        self._local = threading.local()
+        self._arrays = None  # (stamp of the data read, {column: numpy array})
+        self._handle = None  # (pooled read-only file, (st_dev, st_ino))
+        self._append = None  # (buffered append file, (st_dev, st_ino), csv writer)
+        self._dirty = False  # rows in the append buffer, not in the file yet
         self['id'] = IntegerField('id', unique=True)
         self.update(fields)
-        self._check_fields()
+        self.indexes = OrderedDict()
+        self._open()
+
+        for field_name, kind in (indexes or {}).items():
+            if kind == 'fulltext':
+                self.indexes[field_name] = FullTextIndex(self, field_name)
+            elif kind == 'index':
+                self.indexes[field_name] = ValueIndex(self, field_name)
 
     def __repr__(self):
         return f'<Table {self.table_name} ({super().__repr__()})>'
 
+    def _open(self):
+        if not self._file.exists():
+            self._file.touch()  # touching an existing file would outdate its indexes
+        self._check_fields()
+
+        manifest = self._data_dir / f'{self.table_name}.manifest'
+        if not self._is_segment and manifest.exists():
+            # partitioning was removed from the schema, merge the segments back
+            PartitionedTable.merge_segments(self, manifest)
+
+    def data_mtime_ns(self):
+        return self._file.stat().st_mtime_ns
+
+    def stamp(self):
+        """Short string that changes with every change of the table, made by
+        this process or any other. version only counts those of this one."""
+        st = self._file.stat()
+        return f'{st.st_ino:x}.{st.st_size:x}.{st.st_mtime_ns:x}'
+
+    @property
+    def fields(self):
+        fields = OrderedDict(self)
+        del fields['id']
+        return fields
+
+    @contextmanager
+    def snapshot(self):
+        """Pin the data file as it is now for the reads of this thread.
+        Writers leave a pinned file alone: appended rows are past the end of
+        the snapshot, and rewrites or patches go to a new file that replaces
+        it. Readers never wait for writers."""
+        if getattr(self._local, 'snapshot', None) is not None:
+            yield  # nested reads share the outer snapshot
+            return
+
+        version = self.version  # the pinned file is at least this new
+        with self._snap_lock:
+            f, size = self._data_handle()
+            generation = self._generation
+            self._readers += 1
+            link = None
+            if self._use_parallel_scan():
+                # scan workers open the file by name, give them this version
+                link = self._new_version()
+                os.unlink(link)
+                try:
+                    os.link(self._file, link)
+                except OSError:
+                    link = None
+
+        self._local.snapshot = f.fileno(), size, link, version
+        try:
+            yield
+        finally:
+            self._local.snapshot = None
+            with self._snap_lock:
+                if generation == self._generation:
+                    self._readers -= 1
+            if link is not None:
+                os.unlink(link)
+
+    def _open_data(self, mode='r'):
+        """Open the data file as it is now, or this thread's snapshot of
+        it. Both read through the pooled handle."""
+        snap = getattr(self._local, 'snapshot', None)
+        if snap is None:
+            self._flush_appends()  # a writer reads the rows it appended
+            handle, size = self._data_handle()
+            raw = _SnapshotFile(handle.fileno(), size, handle)
+        else:
+            raw = _SnapshotFile(*snap[:2])
+        f = io.BufferedReader(raw)
+        return f if 'b' in mode else io.TextIOWrapper(f, encoding=self._encoding)
+
+    def _data_handle(self):
+        """The pooled read-only handle of the data file and the file's size.
+        It is opened again when the file was replaced, by this process or
+        another; readers still holding the old one keep it open."""
+        st = os.stat(self._file)
+        handle = self._handle
+        if handle is None or handle[1] != (st.st_dev, st.st_ino):
+            f = open(self._file, 'rb')
+            st = os.fstat(f.fileno())
+            handle = self._handle = f, (st.st_dev, st.st_ino)
+        return handle[0], st.st_size
+
+    def _appender(self):
+        """The long-lived buffered append handle, checked against the file
+        on disk whenever its buffer is empty."""
+        handle = self._append
+        if not self._dirty:
+            st = os.stat(self._file)
+            if handle is None or handle[1] != (st.st_dev, st.st_ino):
+                if handle is not None:
+                    handle[0].close()
+                f = open(self._file, 'a')
+                st = os.fstat(f.fileno())
+                handle = self._append = f, (st.st_dev, st.st_ino), csv.writer(
+                    f, delimiter=' ', quotechar='"', quoting=csv.QUOTE_ALL,
+                    lineterminator='\n')
+        return handle
+
+    def _flush_appends(self):
+        if self._dirty:
+            with self._snap_lock:  # snapshots see whole rows only
+                self._append[0].flush()
+                self._dirty = False
+
+    def flush(self):
+        """Write the buffered appends to the data file. Every change is
+        flushed when it is done, this is for the rows of one still running."""
+        self._flush_appends()
+
+    def sync(self):
+        """Flush, then fsync the data file."""
+        self._flush_appends()
+        fd = os.open(self._file, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def close(self):
+        """Flush and let go of the pooled handles, the next use of the
+        table opens them again."""
+        self._flush_appends()
+        with self._snap_lock:
+            if self._append is not None:
+                self._append[0].close()
+            # snapshots may still read through the pooled reader, it is
+            # closed when the last of them is done
+            self._append = self._handle = None
+
+    def _new_version(self, copy=False):
+        """Path for a new version of the data file, next to it."""
+        fd, path = tempfile.mkstemp(prefix=f'.{self._file.name}.', suffix='.tmp',
+                                    dir=self._data_dir)
+        os.close(fd)
+        if copy:
+            self._flush_appends()
+            shutil.copyfile(self._file, path)
+        return Path(path)
+
+    def _replace_file(self, path):
+        self._flush_appends()
+        shutil.copymode(self._file, path)
+        with self._snap_lock:
+            os.replace(path, self._file)
+            self._generation += 1
+            self._readers = 0  # the snapshots pin the old file
+
+    @contextmanager
+    def _rewriter(self):
+        """csv writer of a new version of the data file, which replaces the
+        current one when the block is done."""
+        path = self._new_version()
+        try:
+            with open(path, 'w') as f:
+                yield csv.writer(f, delimiter=' ', quotechar='"',
+                                 quoting=csv.QUOTE_ALL, lineterminator='\n')
+            self._replace_file(path)
+        finally:
+            if path.exists():
+                path.unlink()
+
     def _check_fields(self):
         with self.get_reader(no_header=False) as reader:
             try:
@@ -142,10 +1121,7 @@ class Table(OrderedDict):
 
     def _add_field(self, field_name, field_idx, field):
         with self.get_reader(no_header=False) as reader:
-            with tempfile.NamedTemporaryFile('w+') as tmp_file:
-                tmp_writer = csv.writer(tmp_file, delimiter=' ', quotechar='"',
-                                        quoting=csv.QUOTE_ALL, lineterminator='\n')
-
+            with self._rewriter() as tmp_writer:
                 try:
                     header = next(reader)
                 except StopIteration:
@@ -157,16 +1133,11 @@ class Table(OrderedDict):
                     row.insert(field_idx, field())
                     tmp_writer.writerow(row)
 
-                tmp_file.seek(0)
-                with open(self._file, 'w') as f:
-                    f.write(tmp_file.read())
+        self._changed()
 
     def _rem_field(self, field_name):
         with self.get_reader(no_header=False) as reader:
-            with tempfile.NamedTemporaryFile('w+') as tmp_file:
-                tmp_writer = csv.writer(tmp_file, delimiter=' ', quotechar='"',
-                                        quoting=csv.QUOTE_ALL, lineterminator='\n')
-
+            with self._rewriter() as tmp_writer:
                 try:
                     header = next(reader)
                 except StopIteration:
@@ -179,17 +1150,11 @@ class Table(OrderedDict):
                     del row[field_idx]
                     tmp_writer.writerow(row)
 
-                tmp_file.flush()
-                tmp_file.seek(0)
-                with open(self._file, 'w') as f:
-                    f.write(tmp_file.read())
+        self._changed()
 
     def _shift_field(self, field_name, to_idx):
         with self.get_reader(no_header=False) as reader:
-            with tempfile.NamedTemporaryFile('w+') as tmp_file:
-                tmp_writer = csv.writer(tmp_file, delimiter=' ', quotechar='"',
-                                        quoting=csv.QUOTE_ALL, lineterminator='\n')
-
+            with self._rewriter() as tmp_writer:
                 try:
                     header = next(reader)
                 except StopIteration:
@@ -202,17 +1167,11 @@ class Table(OrderedDict):
                     row.insert(to_idx, row.pop(field_idx))
                     tmp_writer.writerow(row)
 
-                tmp_file.flush()
-                tmp_file.seek(0)
-                with open(self._file, 'w') as f:
-                    f.write(tmp_file.read())
+        self._changed()
 
     def _delete_lines(self, lines: list):
         with self.get_reader(no_header=False) as reader:
-            with tempfile.NamedTemporaryFile('w+') as tmp_file:
-                tmp_writer = csv.writer(tmp_file, delimiter=' ', quotechar='"',
-                                        quoting=csv.QUOTE_ALL, lineterminator='\n')
-
+            with self._rewriter() as tmp_writer:
                 header = next(reader)
                 tmp_writer.writerow(header)
                 line_c = 1  # start from header
@@ -222,33 +1181,141 @@ class Table(OrderedDict):
                         continue
                     tmp_writer.writerow(row)
 
-                tmp_file.flush()
-                tmp_file.seek(0)
-                with open(self._file, 'w') as f:
-                    f.write(tmp_file.read())
-
-    def _update_line(self, line: int, values: list):
+    def _update_lines(self, lines: dict):
         with self.get_reader(no_header=False) as reader:
-            with tempfile.NamedTemporaryFile('w+') as tmp_file:
-                tmp_writer = csv.writer(tmp_file, delimiter=' ', quotechar='"',
-                                        quoting=csv.QUOTE_ALL, lineterminator='\n')
-
+            with self._rewriter() as tmp_writer:
                 header = next(reader)
                 tmp_writer.writerow(header)
                 line_c = 1  # start from header
                 for row in reader:
                     line_c += 1
-                    if line_c == line:
-                        tmp_writer.writerow(values)
+                    if line_c in lines:
+                        tmp_writer.writerow(lines[line_c])
                         continue
                     tmp_writer.writerow(row)
 
-                tmp_file.flush()
-                tmp_file.seek(0)
-                with open(self._file, 'w') as f:
-                    f.write(tmp_file.read())
+    @contextmanager
+    def _write_lock(self):
+        """Write side of the table lock, with the indexes loaded first. An
+        index loaded after the data file changed would look stale."""
+        with self._lock.write():
+            for index in self.indexes.values():
+                index.ensure()
+            yield
+
+    def _changed(self):
+        self._flush_appends()  # a change is complete on disk before readers see it
+        self.version += 1
+        # the kernel keeps mtimes to the clock tick, give every change its own
+        now = time.time_ns()
+        os.utime(self._file, ns=(now, now))
+        for index in self.indexes.values():
+            index.touch()  # the index is as fresh as the data file
+
+    def _index_add(self, row):
+        for field_name, index in self.indexes.items():
+            index.add(row['id'], row[field_name])
+
+    def _index_remove(self, row):
+        for field_name, index in self.indexes.items():
+            index.remove(row['id'], row[field_name])
+
+    def _index_replace(self, old, new):
+        for field_name, index in self.indexes.items():
+            if old[field_name] != new[field_name]:
+                index.remove(old['id'], old[field_name])
+                index.add(new['id'], new[field_name])
+
+    def _index_candidates(self, condition, limit=None, reverse=False, before=None):
+        """Sorted ids that may match an AND-only condition, looked up from
+        the indexes of its terms, or None if no index can be used. For a
+        single term of an index with pages, only the ids of the page that
+        limit, reverse and before ask for are looked up."""
+        if not condition or any(p.lower() in ('or', '(', ')') for p in condition):
+            return None
+
+        index = self.indexes.get(condition[0])
+        if limit is not None and len(condition) == 3 and hasattr(index, 'page') \
+                and condition[1] in index.operators:
+            return index.page(condition[2].strip("'"), limit, reverse, before)
+
+        candidates = None
+        for i, p in enumerate(condition):
+            index = self.indexes.get(condition[i-1])
+            if index is not None and p.upper() in index.operators:
+                query = condition[i+1]
+                if query.startswith("'") and query.endswith("'"):
+                    query = query[1:-1]
+                ids = self.indexes[condition[i-1]].search(query)
+                candidates = ids if candidates is None \
+                    else sorted(set(candidates).intersection(ids))
+        return candidates
+
+    def _candidate_ids(self, condition):
+        """Sorted ids an AND-only condition may match, from one of its id ==
+        terms or from the indexes, or None if the rows have to be scanned."""
+        if not condition or any(p.lower() in ('or', '(', ')') for p in condition):
+            return None
+        for i in range(1, len(condition) - 1, 4):
+            if condition[i-1] == 'id' and condition[i] == '==':
+                try:
+                    return [int(condition[i+1].strip("'"))]
+                except ValueError:
+                    return None
+        return self._index_candidates(condition)
+
+    def _rows_by_ids(self, ids):
+        """Generate raw rows of the given ids using binary search, missing
+        ids are skipped."""
+        with self._open_data('rb') as f:
+            for row_id in ids:
+                f.seek(self._seek_id(f, row_id))
+                line = f.readline()
+                if not line:
+                    continue
+                row = next(csv.reader([line.decode(self._encoding)], delimiter=' '))
+                if int(row[0]) == row_id:
+                    yield row
+
+    def _patch_lines(self, patches: list):
+        """Replace the (line, offset, size, data) rows at their byte offsets,
+        data None deletes the row. Rows keeping their size are overwritten
+        in place, otherwise the bytes around them are copied to a new
+        version of the file without parsing them."""
+        self._flush_appends()
+        patches = sorted(patches, key=lambda p: p[1])
+        with self._snap_lock:
+            if not self._readers and all(d is not None and len(d) == size
+                                         for _, _, size, d in patches):
+                # nobody has a snapshot of this file, change it in place
+                with open(self._file, 'r+b') as f:
+                    for _, offset, _, data in patches:
+                        f.seek(offset)
+                        f.write(data)
+                return
+
+        path = self._new_version()
+        with self._open_data('rb') as src, open(path, 'wb') as dst:
+            pos = 0
+            for _, offset, size, data in patches:
+                dst.write(src.read(offset - pos))
+                if data is not None:
+                    dst.write(data)
+                src.seek(offset + size)
+                pos = offset + size
+            shutil.copyfileobj(src, dst)
+        self._replace_file(path)
+
+    def _dump_row(self, values) -> bytes:
+        buf = io.StringIO()
+        csv.writer(buf, delimiter=' ', quotechar='"',
+                   quoting=csv.QUOTE_ALL, lineterminator='\n').writerow(values)
+        return buf.getvalue().encode(self._encoding)
 
     def _compile_condition(self, condition: list):
+        if not condition:
+            return 'True'
+
         new_condition = []
         for i, p in enumerate(condition):
             if p in ('==', '!='):
@@ -263,22 +1330,161 @@ class Table(OrderedDict):
                     right = right[1:-1]
                 right = right.replace("'", "\\'")
                 new_condition.insert(i+1, f'\'{self[left](right)}\'')
+            elif p in _comparisons:
+                left = condition[i-1]
+                if left not in self:
+                    raise ValueError(f'Column {left} doesn\'t exist')
+                right = condition[i+1]
+                if right.startswith("'") and right.endswith("'"):
+                    right = right[1:-1]
+                value = self[left](right)
+                column = f'row[{list(self).index(left)}]'
+                if self[left].__qualname__ in ('INTEGER', 'BOOLEAN'):
+                    new_condition.extend([f'int({column})', p, str(int(value))])
+                else:
+                    # CHAR and TIMESTAMP values compare as their stored text
+                    new_condition.extend([column, p, repr(str(value))])
+            elif p.upper() in ('CONTAINS', 'MATCH'):
+                left = condition[i-1]
+                if left not in self:
+                    raise ValueError(f'Column {left} doesn\'t exist')
+                right = condition[i+1]
+                if right.startswith("'") and right.endswith("'"):
+                    right = right[1:-1]
+                new_condition.insert(
+                    i-1, f'match(row[{list(self).index(left)}], {right!r})')
             elif p.lower() in ('or', 'and', '(', ')'):
                 new_condition.insert(i, p.lower())
 
         return ' '.join(new_condition)
 
-    def _search(self, condition, reverse=False):
+    def _compile_where(self, condition):
         condition = self._compile_condition(condition)
-        with self.get_reader(no_header=not reverse, reverse=reverse) as reader:
+        try:
+            return condition, compile(condition, '<where>', 'eval')
+        except SyntaxError:
+            raise ValueError('Error in where clause syntax')
+
+    def _use_parallel_scan(self):
+        snap = getattr(self._local, 'snapshot', None)
+        if snap is not None:
+            return snap[2] is not None
+        return self.parallel_scan_threshold is not None \
+            and self._file.stat().st_size >= self.parallel_scan_threshold
+
+    def _search(self, condition, reverse=False, end=None):
+        if self._use_parallel_scan():
+            for line_c, _, _, row in self._parallel_search(condition, reverse, end):
+                yield line_c, self._parse_values(row)
+            return
+
+        _, code = self._compile_where(condition)
+        with self.get_reader(no_header=not reverse, reverse=reverse, end=end) as reader:
             line_c = 1
             for row in reader:
                 line_c += 1
-                try:
-                    if eval(condition, {"row": row}):
-                        yield line_c, self._parse_values(row)
-                except SyntaxError:
-                    raise ValueError('Error in where clause syntax')
+                if eval(code, {"row": row, "match": match}):
+                    yield line_c, self._parse_values(row)
+
+    def _search_offsets(self, condition):
+        """Like _search but also yields the byte offset and raw length of
+        every matched row. Rows asked for by id, or found in an index, are
+        looked up by binary search, their line is None."""
+        ids = id_terms(condition)
+        if ids is not None:
+            yield from self._offsets_of_ids(ids)
+            return
+        ids = self._candidate_ids(condition)
+        if ids is not None:
+            yield from self._offsets_of_ids(ids, self._compile_where(condition)[1])
+            return
+        if self._use_parallel_scan():
+            for line_c, offset, size, row in self._parallel_search(condition):
+                yield line_c, offset, size, self._parse_values(row)
+            return
+
+        _, code = self._compile_where(condition)
+        with self._open_data('rb') as f:
+            offset = len(f.readline())  # pass header
+            line_c = 1
+            for raw in f:
+                line_c += 1
+                row = next(csv.reader([raw.decode(self._encoding)], delimiter=' '))
+                if eval(code, {"row": row, "match": match}):
+                    yield line_c, offset, len(raw), self._parse_values(row)
+                offset += len(raw)
+
+    def _offsets_of_ids(self, ids, code=None):
+        """(None, offset, size, row) of the rows of the ids that are there,
+        and match the compiled where clause code if given."""
+        with self._open_data('rb') as f:
+            for row_id in ids:
+                offset = self._seek_id(f, row_id)
+                f.seek(offset)
+                raw = f.readline()
+                if not raw:
+                    continue
+                row = next(csv.reader([raw.decode(self._encoding)], delimiter=' '))
+                if int(row[0]) == row_id \
+                        and (code is None or eval(code, {"row": row, "match": match})):
+                    yield None, offset, len(raw), self._parse_values(row)
+
+    def _scan_ranges(self, end=None, chunk_size=None):
+        """Split the rows of the data file into byte ranges that start and
+        end on row boundaries."""
+        with self._open_data('rb') as f:
+            start = len(f.readline())
+            if end is None:
+                end = f.seek(0, os.SEEK_END)
+            chunk_size = chunk_size or max((end - start) // (scan_workers * 4), 1 << 20)
+
+            ranges = []
+            while start < end:
+                f.seek(min(start + chunk_size, end) - 1)
+                f.readline()
+                stop = min(f.tell(), end)
+                ranges.append((start, stop))
+                start = stop
+            return ranges
+
+    def _parallel_search(self, condition, reverse=False, end=None):
+        """Evaluate the condition over byte ranges of the file in a process
+        pool, matches come back in file order (or reversed)."""
+        condition, _ = self._compile_where(condition)
+        pool = get_scan_pool()
+        ranges = self._scan_ranges(end=end)
+        if reverse:
+            ranges.reverse()
+        snap = getattr(self._local, 'snapshot', None)
+        path = str(snap[2] if snap is not None else self._file)
+
+        pending = []
+        window = scan_workers * 2  # stay a little ahead of the consumer
+        line_base = 1
+        try:
+            for start, stop in ranges:
+                pending.append(pool.submit(scan_range, path, start,
+                                           stop, condition, self._encoding))
+                if len(pending) < window:
+                    continue
+                line_base = yield from self._merge_scan(pending.pop(0), line_base, reverse)
+
+            while pending:
+                line_base = yield from self._merge_scan(pending.pop(0), line_base, reverse)
+        finally:
+            for future in pending:
+                future.cancel()
+
+    def _merge_scan(self, future, line_base, reverse):
+        count, matched = future.result()
+        if reverse:
+            # like the serial reverse scan, rows are numbered from the end
+            for line_c, offset, size, row in reversed(matched):
+                yield line_base + count - line_c + 1, offset, size, row
+        else:
+            for line_c, offset, size, row in matched:
+                yield line_base + line_c, offset, size, row
+        return line_base + count
 
     def _parse_values(self, row):
         idx = 0
@@ -316,23 +1522,25 @@ class Table(OrderedDict):
                     if row[field_name] == fields[field_name]:
                         raise ValueError(f'duplicate data for {field_name} field')
 
-    def _reverse_db_csv(self, file):
-        part = ''
-        for block in self._reverse_file_blocks(file):
-            for c in reversed(block):
-                if c == '\n' and part:
-                    yield part[::-1]
-                    part = ''
-                part += c
+    def _reverse_db_csv(self, file, end=None):
+        part = b''
+        for block in self._reverse_file_blocks(file, end=end):
+            lines = (block + part).split(b'\n')
+            part = lines.pop(0)
+            for line in reversed(lines):
+                if line:
+                    yield line.decode(self._encoding)
 
         # it won't yield last part to pass header
         # if part:
-        #    yield part[::-1]
+        #    yield part
 
-    def _reverse_file_blocks(self, file, blocksize=4096):
+    def _reverse_file_blocks(self, file, blocksize=65536, end=None):
         "Generate blocks of file's contents in reverse order."
-        file.seek(0, os.SEEK_END)
-        here = file.tell()
+        if end is None:
+            file.seek(0, os.SEEK_END)
+            end = file.tell()
+        here = end
         while 0 < here:
             delta = min(blocksize, here)
             here -= delta
@@ -341,45 +1549,82 @@ class Table(OrderedDict):
 
     @contextmanager
     def get_writer(self, reset=False):
-        f = open(self._file, 'a' if reset is False else 'w')
+        """csv writer appending through the buffered append handle, the rows
+        reach the file at the next flush. With reset the file is truncated."""
+        if reset is False:
+            _, _, writer = self._appender()
+            self._dirty = True
+            yield writer
+            return
+
+        self.close()
+        f = open(self._file, 'w')
         try:
             yield csv.writer(f, delimiter=' ', quotechar='"', quoting=csv.QUOTE_ALL, lineterminator='\n')
         finally:
             f.close()
 
-    @contextmanager
-    def get_reader(self, no_header=True, reverse=False):
-        f = open(self._file, 'r')
+    def _offset_of_id(self, row_id):
+        with self._open_data('rb') as f:
+            return self._seek_id(f, row_id)
+
+    def _seek_id(self, f, row_id):
+        """Binary search the id-ordered file for the byte offset of the first
+        row whose id is not less than row_id."""
+        f.seek(0)
+        lo = len(f.readline())  # rows start after the header
+        hi = f.seek(0, os.SEEK_END)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            f.seek(mid - 1)
+            f.readline()  # move to the first row starting at or after mid
+            pos = f.tell()
+            if pos >= hi:
+                hi = mid
+                continue
 
-        if not no_header and reverse:
-            f = self._reverse_db_csv(f)
+            line = f.readline()
+            row = next(csv.reader([line.decode(self._encoding)], delimiter=' '))
+            if int(row[0]) < row_id:
+                lo = pos + len(line)
+            else:
+                hi = mid
+        return lo
 
-        elif no_header and reverse:
+    @contextmanager
+    def get_reader(self, no_header=True, reverse=False, end=None):
+        if no_header and reverse:
             raise EnvironmentError(
                 'You cannot set both no_header and reverse True'
                 '\nin general, header won\'t be read in reverse mode'
             )
 
+        f = self._open_data('r' if not reverse else 'rb')
+        lines = f
+        if reverse:
+            lines = self._reverse_db_csv(f, end=end)
+
         if no_header:
             next(f)  # pass header
 
         try:
-            reader = csv.reader(f, delimiter=' ')
+            reader = csv.reader(lines, delimiter=' ')
             yield reader
         finally:
             f.close()
 
+    @property
+    def first_id(self):
+        with self.get_reader(no_header=True) as reader:
+            row = next(reader, None)
+            return int(row[0]) if row else None
+
     @property
     def last_id(self):
         if not getattr(self, '_last_id', None):
-            with self.get_reader(no_header=True) as reader:
-                row = None
-                for row in reader:
-                    pass
-                if row:
-                    self._last_id = self._parse_values(row).get('id')
-                else:
-                    self._last_id = 0
+            with self.get_reader(no_header=False, reverse=True) as reader:
+                row = next(reader, None)
+                self._last_id = int(row[0]) if row else 0
         return self._last_id
 
     @last_id.setter
@@ -387,25 +1632,91 @@ class Table(OrderedDict):
         self._last_id = value
 
     def db_insert(self, values: list):
-        next_id = self.last_id + 1
-        values.insert(0, next_id)  # auto increament
-        parsed = self._parse_values(values)
-        self._check_for_uniqueness(parsed)
-
-        with self.get_writer() as writer:
+        with self._write_lock():
+            next_id = self.last_id + 1
+            values.insert(0, next_id)  # auto increament
+            parsed = self._parse_values(values)
+            self._check_for_uniqueness(parsed)
+            self._log_change('insert', [parsed.values()])
+
+            self._append_row(parsed)
+            self.last_id = parsed['id']
+
+            self._index_add(parsed)
+            self._changed()
+            return parsed['id']
+
+    def _append_row(self, parsed):
+        # snapshots end on a row boundary, past the rows appended later
+        with self._snap_lock, self.get_writer() as writer:
             writer.writerow(parsed.values())
-            self.last_id += 1
-
-        return parsed['id']
 
     def db_delete(self, where: list):
-        search = self._search(where)
-        lines = [r[0] for r in search]
-        self._delete_lines(lines)
+        with self._write_lock():
+            found = list(self._search_offsets(where))
+            if found:
+                self._log_change('delete', [[row['id']] for *_, row in found])
+                self._patch_lines([(line, offset, size, None)
+                                   for line, offset, size, _ in found])
+                for *_, row in found:
+                    self._index_remove(row)
+                self._changed()
+
+    def db_select(self, where: list = None, limit: int = None, reverse: bool = False,
+                  before: int = None, order_by: str = None, planner=None):
+        """Rows matching the where clause in id order, or sorted by the
+        numeric column order_by; reverse gives the last ones first. A
+        Planner picks how the rows are found."""
+        with self._read_view():
+            if order_by is not None:
+                return self._select_ordered(where, order_by, descending=reverse,
+                                            limit=limit, before=before)
+            if planner is not None:
+                plan = planner.plan(self, where, limit=limit, reverse=reverse, before=before)
+                return self._select(plan.where, limit=plan.limit, reverse=plan.reverse,
+                                    before=before, plan=plan)
+            return self._select(where, limit=limit, reverse=reverse, before=before)
+
+    def db_iter(self, where: list = None):
+        """Rows matching the where clause in id order like db_select, but
+        one at a time, for results too big to build in memory. The snapshot
+        they come from is held until the generator is done."""
+        with self._read_view():
+            yield from self._iter(where)
+
+    def _iter(self, where):
+        ids = self._index_candidates(where)
+        if ids is None:
+            ids = self._column_candidates(where)
+        if ids is not None:
+            yield from self._select_ids(ids, where)
+        elif where is None:
+            with self.get_reader() as reader:
+                for row in reader:
+                    yield self._parse_values(row)
+        else:
+            for _, row in self._search(where):
+                yield row
+
+    def _read_view(self):
+        return self.snapshot()
+
+    def _select(self, where, limit=None, reverse=False, before=None, plan=None):
+        ids = self._index_candidates(where) if plan is None else plan.ids
+        if ids is None:
+            ids = self._column_candidates(where)
+        if ids is not None:
+            return self._select_ids(ids, where, limit=limit, reverse=reverse,
+                                    before=before)
+
+        end = None
+        if before is not None:
+            if not reverse:
+                raise ValueError('before can only be used with a reverse select')
+            end = self._offset_of_id(int(before))
 
-    def db_select(self, where: list = None, limit: int = None, reverse: bool = False):
         if where is None:
-            with self.get_reader(no_header=not reverse, reverse=reverse) as reader:
+            with self.get_reader(no_header=not reverse, reverse=reverse, end=end) as reader:
                 if limit is not None:
                     results = []
                     i = 0
@@ -418,7 +1729,7 @@ class Table(OrderedDict):
 
                 return [self._parse_values(row) for row in reader]
 
-        search = self._search(where, reverse=reverse)
+        search = self._search(where, reverse=reverse, end=end)
         if limit is not None:
             results = []
             i = 0
@@ -431,76 +1742,2080 @@ class Table(OrderedDict):
 
         return [r[1] for r in search]  # values
 
+    def _select_ids(self, ids, where, limit=None, reverse=False, before=None):
+        if before is not None:
+            if not reverse:
+                raise ValueError('before can only be used with a reverse select')
+            ids = ids[:bisect.bisect_left(ids, int(before))]
+        if reverse:
+            ids = reversed(ids)
+
+        _, code = self._compile_where(where)
+        results = []
+        for row in self._rows_by_ids(ids):
+            if limit is not None and len(results) == limit:
+                break
+            if eval(code, {"row": row, "match": match}):
+                results.append(self._parse_values(row))
+        return results
+
+    def _column_where(self, condition):
+        """Columns of a condition made only of comparisons of numeric
+        columns, or None if it has other terms."""
+        columns = []
+        for i, p in enumerate(condition or ()):
+            if p.upper() in ('CONTAINS', 'MATCH'):
+                return None
+            if p in _comparisons:
+                left = condition[i-1]
+                if left not in self:
+                    raise ValueError(f'Column {left} doesn\'t exist')
+                if self[left].__qualname__ not in _numeric_types:
+                    return None
+                columns.append(left)
+        return columns
+
+    def _column_arrays(self, columns):
+        """numpy arrays of the id and the given numeric columns, in file
+        order. They are loaded in one scan of the read view and kept until
+        the data file changes, in this process or another."""
+        np = _numpy()
+        for name in columns:
+            if name not in self:
+                raise ValueError(f'Column {name} doesn\'t exist')
+            if self[name].__qualname__ not in _numeric_types:
+                raise ValueError(f'Column {name} is not numeric')
+
+        snap = getattr(self._local, 'snapshot', None)
+        if snap is None:
+            self._flush_appends()
+            stamp = self.stamp()
+        else:  # the pinned file up to the snapshot's end
+            st = os.fstat(snap[0])
+            stamp = f'{st.st_ino:x}.{snap[1]:x}.{st.st_mtime_ns:x}'
+        cached = self._arrays
+        if cached is None or cached[0] != stamp:
+            cached = self._arrays = (stamp, {})
+        arrays = cached[1]
+
+        names = list(OrderedDict.fromkeys(['id', *columns]))
+        missing = [name for name in names if name not in arrays]
+        if missing:
+            fields = list(self)
+            values = [[] for _ in missing]
+            idx = [fields.index(name) for name in missing]
+            with self.get_reader() as reader:
+                for row in reader:
+                    for i, column in zip(idx, values):
+                        column.append(row[i])
+
+            for name, column in zip(missing, values):
+                kind = self[name].__qualname__
+                if kind == 'TIMESTAMP':
+                    arrays[name] = np.array(column, dtype='datetime64[s]')
+                elif kind == 'BOOLEAN':
+                    arrays[name] = np.fromiter(map(self[name], column), np.int64, len(column))
+                else:
+                    arrays[name] = np.array(column).astype(np.int64)
+        return {name: arrays[name] for name in names}
+
+    def _column_value(self, name, value):
+        """A where clause value as a scalar of the column's array."""
+        if value.startswith("'") and value.endswith("'"):
+            value = value[1:-1]
+        value = self[name](value)
+        if self[name].__qualname__ == 'TIMESTAMP':
+            return _numpy().datetime64(value.replace(tzinfo=None), 's')
+        return int(value)
+
+    def _column_mask(self, node, arrays):
+        """Evaluate a condition of numeric comparisons over the column
+        arrays at once, node is the condition or a part of its tree."""
+        if isinstance(node, list):
+            node = condition_tree(node)
+        if len(node) == 3:
+            left, op, right = node
+            return _comparisons[op](arrays[left], self._column_value(left, right))
+        masks = [self._column_mask(child, arrays) for child in node[1]]
+        return functools.reduce(operator.and_ if node[0] == 'AND' else operator.or_, masks)
+
+    def _column_filter(self, where, arrays):
+        """Mask of the rows matching a where clause, vectorized when it only
+        compares numeric columns and taken from a select otherwise."""
+        np = _numpy()
+        if not where:
+            return np.ones(len(arrays['id']), dtype=bool)
+        if self._column_where(where) is not None:
+            return self._column_mask(where, arrays)
+        ids = self._index_candidates(where)
+        if ids is None:
+            ids = [row['id'] for row in self._select(where)]
+        return np.isin(arrays['id'], ids)
+
+    def _column_candidates(self, condition):
+        """Sorted ids that may match a condition of numeric comparisons,
+        from the column arrays, or None if column scans are off or the
+        condition has other terms."""
+        if not self.column_scans or not condition:
+            return None
+        columns = self._column_where(condition)
+        if columns is None:
+            return None
+        arrays = self._column_arrays(columns)
+        ids = arrays['id'][self._column_mask(condition, arrays)]
+        return _numpy().sort(ids).tolist()
+
+    def _select_ordered(self, where, order_by, descending=False, limit=None,
+                        before=None):
+        """Rows matching the where clause sorted by a numeric column, ties
+        in ascending id order either way, fetched by id until the limit is
+        reached."""
+        np = _numpy()
+        arrays = self._column_arrays([order_by, *(self._column_where(where) or ())])
+        mask = self._column_filter(where, arrays)
+        if before is not None:
+            mask &= arrays['id'] < int(before)
+        ids = arrays['id'][mask]
+        if descending:  # reversed, so ties sort by descending id first
+            ids = ids[np.lexsort((-ids, arrays[order_by][mask]))][::-1]
+        else:
+            ids = ids[np.lexsort((ids, arrays[order_by][mask]))]
+
+        _, code = self._compile_where(where)
+        results = []
+        for row in self._rows_by_ids(ids.tolist()):
+            if limit is not None and len(results) == limit:
+                break
+            if eval(code, {"row": row, "match": match}):
+                results.append(self._parse_values(row))
+        return results
+
+    def db_aggregate(self, func: str, column: str = None, where: list = None,
+                     group_by: str = None):
+        """COUNT, SUM, MAX or MIN of a numeric column over the rows matching
+        the where clause, computed on the column arrays. With group_by
+        there is one row per value of that column, in its order."""
+        np = _numpy()
+        func = func.upper()
+        if func not in _aggregates:
+            raise ValueError(f'Unknown aggregate {func}')
+        if column is None and func != 'COUNT':
+            raise ValueError(f'{func} needs a column')
+        if func == 'SUM' and self[column].__qualname__ == 'TIMESTAMP':
+            raise ValueError(f'Cannot SUM the TIMESTAMP column {column}')
+        name = f'{func}({column or "*"})'
+        columns = [c for c in (column, group_by) if c is not None]
+
+        with self._read_view():
+            arrays = self._column_arrays(columns + (self._column_where(where) or []))
+            mask = self._column_filter(where, arrays)
+
+        values = arrays[column][mask] if column else None
+        if group_by is None:
+            if func == 'COUNT':
+                result = int(np.count_nonzero(mask))
+            elif func == 'SUM':
+                result = int(values.sum())
+            elif not len(values):
+                result = None
+            else:
+                result = self._column_result(column, getattr(values, func.lower())())
+            return [OrderedDict([(name, result)])]
+
+        keys = arrays[group_by][mask]
+        if not len(keys):
+            return []
+        order = np.argsort(keys, kind='stable')
+        keys = keys[order]
+        starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+        if func == 'COUNT':
+            results = np.diff(np.r_[starts, len(keys)]).tolist()
+        else:
+            ufunc = {'SUM': np.add, 'MAX': np.maximum, 'MIN': np.minimum}[func]
+            results = ufunc.reduceat(values[order], starts)
+            results = [int(v) if func == 'SUM' else self._column_result(column, v)
+                       for v in results]
+        return [OrderedDict([(group_by, self._column_result(group_by, key)), (name, result)])
+                for key, result in zip(keys[starts], results)]
+
+    def _column_result(self, name, value):
+        """A scalar of a column array as a value of the column's field."""
+        if self[name].__qualname__ == 'TIMESTAMP':
+            return self[name](str(value))
+        return self[name](int(value))
+
+    def analyze(self, common=10, buckets=10):
+        """Statistics for the Planner: the row count and, per column, the
+        distinct count, the most common values with their counts, equi-depth
+        histogram bounds and how well the values follow the row order (-1 to
+        1, numeric columns only). Values are ints for INTEGER and BOOLEAN
+        columns and stored text otherwise, long CHAR columns are skipped."""
+        fields = list(self)
+        kinds = [self[name].__qualname__ for name in fields]
+        tracked = [i for i, name in enumerate(fields)
+                   if not kinds[i].startswith('CHAR') or self[name]().length <= 64]
+        counters = {i: Counter() for i in tracked}
+        sums = {i: [0, 0, 0] for i in tracked if kinds[i] in _numeric_types}
+        rows = 0
+        with self._read_view(), self.get_reader() as reader:
+            for row in reader:
+                for i in tracked:
+                    counters[i][row[i]] += 1
+                for i, acc in sums.items():
+                    y = datetime.fromisoformat(row[i]).timestamp() \
+                        if kinds[i] == 'TIMESTAMP' else int(row[i])
+                    acc[0] += y
+                    acc[1] += y * y
+                    acc[2] += rows * y  # rows is the position of the row here
+                rows += 1
+
+        columns = {}
+        for i in tracked:
+            convert = int if kinds[i] in ('INTEGER', 'BOOLEAN') else str
+            counts = sorted((convert(v), c) for v, c in counters[i].items())
+            # the values at ranks 0, rows / buckets, ... rows - 1, frequent
+            # values show up as repeated bounds
+            histogram = []
+            seen = 0
+            for value, count in counts:
+                seen += count
+                while len(histogram) <= buckets \
+                        and len(histogram) * (rows - 1) // buckets < seen:
+                    histogram.append(value)
+
+            correlation = None
+            if i in sums and rows > 1:
+                sy, syy, sxy = sums[i]
+                sx, sxx = rows * (rows - 1) / 2, (rows - 1) * rows * (2 * rows - 1) / 6
+                var = (rows * sxx - sx * sx) * (rows * syy - sy * sy)
+                if var > 0:
+                    correlation = (rows * sxy - sx * sy) / math.sqrt(var)
+
+            columns[fields[i]] = {
+                'distinct': len(counts),
+                'common': [[v, c] for v, c in sorted(counts, key=lambda vc: -vc[1])[:common]
+                           if c > 1],
+                'histogram': histogram,
+                'correlation': correlation,
+            }
+        return {'rows': rows, 'analyzed_at': time.time(), 'columns': columns}
+
     def db_update(self, where: list, values: list):
-        search = self._search(where)
+        with self._write_lock():
+            found = []
+            for line, offset, size, vals in list(self._search_offsets(where)):
+                parsed = self._parse_values([vals['id']] + values)
+                self._check_for_uniqueness(parsed, to_update=True)
+                found.append((line, offset, size, vals, parsed))
+            if len(found) > 1:  # they would all get the same values
+                for field_name, value in parsed.items():
+                    if field_name != 'id' and value.unique:
+                        raise ValueError(f'duplicate data for {field_name} field')
+
+            self._log_change('update', [parsed.values() for *_, parsed in found])
+            self._replace_rows(found)
+            return [vals['id'] for *_, vals, _ in found]
+
+    def db_update_set(self, where: list, assignments: dict):
+        """Update only the assigned columns, assignments maps a column to
+        ('value', literal) or ('add', source_column, delta)."""
+        for field_name, (kind, *args) in assignments.items():
+            if field_name == 'id' or field_name not in self:
+                raise ValueError(f'Column {field_name} cannot be updated')
+            if kind == 'add':
+                source, delta = args
+                if source not in self:
+                    raise ValueError(f'Column {source} doesn\'t exist')
+                if self[source].__qualname__ != 'INTEGER' \
+                        or self[field_name].__qualname__ != 'INTEGER':
+                    raise ValueError('Only INTEGER columns can be incremented')
+                try:
+                    int(delta)
+                except ValueError:
+                    raise ValueError(f'Invalid increment for {field_name} ({delta})')
+
+        with self._write_lock():
+            found = []
+            # evaluate every expression against the row as it is on disk
+            # right now, while holding the table lock
+            for line, offset, size, vals in list(self._search_offsets(where)):
+                parsed = vals.copy()
+                for field_name, (kind, *args) in assignments.items():
+                    if kind == 'add':
+                        source, delta = args
+                        value = vals[source] + int(delta)
+                    else:
+                        value = args[0]
+                    parsed[field_name] = self[field_name](value)
+
+                if any(parsed[f].unique for f in assignments):
+                    self._check_for_uniqueness(parsed, to_update=True)
+                found.append((line, offset, size, vals, parsed))
+
+            self._log_change('update', [new.values() for *_, new in found])
+            self._replace_rows(found)
+            return [old['id'] for *_, old, _ in found]
+
+    def _replace_rows(self, found: list):
+        """Write the new versions of (line, offset, size, old, new) rows."""
+        if not found:
+            return
+        self._patch_lines([(line, offset, size, self._dump_row(new.values()))
+                           for line, offset, size, _, new in found])
+        for *_, old, new in found:
+            self._index_replace(old, new)
+        self._changed()
+
+    def _log_change(self, op, rows):
+        # before the files change, see ReplicationLog
+        if self.log is not None and rows:
+            self.log.append(self.table_name, op, [[str(v) for v in row] for row in rows])
+
+    def db_apply(self, op: str, rows: list):
+        """Apply a change read from a primary's ReplicationLog. The rows
+        carry their ids, so applying a change twice is harmless."""
+        with self._write_lock():
+            if op == 'insert':
+                for values in rows:
+                    parsed = self._parse_values(values)
+                    if parsed['id'] <= self.last_id:
+                        continue  # already there
+                    self._append_row(parsed)
+                    self.last_id = parsed['id']
+                    self._index_add(parsed)
+                self._changed()
+                return
+
+            new_rows = {int(row[0]): row for row in rows}
+            where = []
+            for row_id in new_rows:
+                where.extend(['id', '==', str(row_id), 'OR'])
+            where = where[:-1]
+
+            if op == 'delete':
+                found = list(self._search_offsets(where))
+                if found:
+                    self._patch_lines([(line, offset, size, None)
+                                       for line, offset, size, _ in found])
+                    for *_, row in found:
+                        self._index_remove(row)
+                    self._changed()
+            elif op == 'update':
+                self._replace_rows([
+                    (line, offset, size, old, self._parse_values(new_rows[old['id']]))
+                    for line, offset, size, old in list(self._search_offsets(where))])
+            else:
+                raise ValueError(f'unknown change {op}')
+
+
+class CompressedTable(Table):
+    """Table stored as zlib or lzma compressed blocks of rows, with an index
+    of the blocks (id range, row count, offsets) in a footer that the first
+    line points to. Reads only decompress the blocks they need. Used for the
+    sealed segments of a partitioned table, changed blocks are compressed
+    again and appended with a new footer."""
+
+    codecs = ('zlib', 'lzma')  # modules of the same name, imported when used
+    block_size = 64 * 1024  # of plain rows
+    _magic = b'RKTZ2'
+
+    def __init__(self, table_name: str, fields: dict, data_dir: Path,
+                 file_name: str, indexes: dict = None):
+        self._cached = None  # (block number, rows of that block)
+        super().__init__(table_name, fields, data_dir, indexes, file_name=file_name)
+
+    def __repr__(self):
+        return f'<CompressedTable {self.table_name} ({self.codec}, {len(self._blocks)} blocks)>'
+
+    def _open(self):
+        with open(self._file, 'rb') as f:
+            magic, codec, *pointer = f.readline().split()
+            if magic != self._magic or codec.decode() not in self.codecs \
+                    or len(pointer) != 2:
+                raise ValueError(f'{self._file.name} is not a compressed table')
+            offset, length = (int(p, 16) for p in pointer)
+            f.seek(offset)
+            footer = json.loads(f.read(length))
+
+        self.codec = codec.decode()
+        self._module = self._codec(self.codec)
+        self.header = footer['header']
+        self.garbage = footer['garbage']
+        self._footer_size = length
+        self._end = offset + length  # anything after it was left by a crash
+        self._set_blocks(footer['blocks'])
+
+    def _set_blocks(self, blocks):
+        # every block is [first_id, last_id, rows, offset, length, raw_length]
+        self._blocks = blocks
+        self._last_ids = [b[1] for b in blocks]
+        self._row_starts = []  # line number of the first row of every block
+        self._raw_starts = []  # offset of the first row in the plain rows
+        line, raw = 2, 0  # line 1 is the header
+        for b in blocks:
+            self._row_starts.append(line)
+            self._raw_starts.append(raw)
+            line += b[2]
+            raw += b[5]
+        self._raw_size = raw
+        self._cached = None
+
+    @staticmethod
+    def _codec(codec):
+        return importlib.import_module(codec)
+
+    @classmethod
+    def seal(cls, table: Table, codec: str, file_name: str):
+        """Write the rows of a plain table into a compressed file."""
+        if codec not in cls.codecs:
+            raise ValueError(f'unknown compression {codec}')
+
+        tmp = table._data_dir / f'{file_name}.tmp'
+        with open(tmp, 'wb') as out, open(table._file, 'rb') as f:
+            out.write(cls._magic + b' ' + codec.encode() + b' ' + cls._pointer(0, 0) + b'\n')
+            header = next(csv.reader([f.readline().decode(table._encoding)], delimiter=' '))
+            module = cls._codec(codec)
+            blocks = []
+            chunk = []
+            for line in f:
+                chunk.append(line)
+                if sum(map(len, chunk)) >= cls.block_size:
+                    blocks.append(cls._write_block(out, module, chunk))
+                    chunk = []
+            if chunk:
+                blocks.append(cls._write_block(out, module, chunk))
+            cls._write_footer(out, codec, header, blocks, 0)
+        os.replace(tmp, table._data_dir / file_name)
+
+    @classmethod
+    def _write_block(cls, out, module, lines):
+        raw = b''.join(lines)
+        first = next(csv.reader([lines[0].decode(Table._encoding)], delimiter=' '))
+        last = next(csv.reader([lines[-1].decode(Table._encoding)], delimiter=' '))
+        data = module.compress(raw)
+        offset = out.tell()
+        out.write(data)
+        return [int(first[0]), int(last[0]), len(lines), offset, len(data), len(raw)]
+
+    @staticmethod
+    def _pointer(offset, length):
+        return f'{offset:016x} {length:016x}'.encode()
+
+    @classmethod
+    def _write_footer(cls, out, codec, header, blocks, garbage):
+        """Write the footer where out is, then point the first line at it.
+        That small write is the last one: until then the old footer is
+        still whole, so a crash loses the change but not the file. Returns
+        the end of the footer."""
+        offset = out.tell()
+        footer = json.dumps({'header': header, 'blocks': blocks,
+                             'garbage': garbage}).encode()
+        out.write(footer)
+        end = out.tell()
+        out.truncate()
+        out.flush()
+        os.fsync(out.fileno())
+        out.seek(len(cls._magic) + len(codec) + 2)
+        out.write(cls._pointer(offset, len(footer)))
+        out.flush()
+        return end
+
+    def thaw(self, file_name: str):
+        """Write the rows back into a plain table file."""
+        tmp = self._data_dir / f'{file_name}.tmp'
+        with open(tmp, 'wb') as out:
+            out.write(self._dump_row(self.header))
+            for i in range(len(self._blocks)):
+                out.write(self._decompress(i))
+        os.replace(tmp, self._data_dir / file_name)
+
+    def _decompress(self, i):
+        # pread leaves the pooled handle's position alone for other threads
+        handle, _ = self._data_handle()
+        offset, length = self._blocks[i][3:5]
+        return self._module.decompress(os.pread(handle.fileno(), length, offset))
+
+    def _block_lines(self, i):
+        cached = self._cached  # other threads may replace it meanwhile
+        if cached is None or cached[0] != i:
+            cached = self._cached = i, self._decompress(i).splitlines(keepends=True)
+        return cached[1]
+
+    def _block_of_id(self, row_id):
+        i = bisect.bisect_left(self._last_ids, row_id)
+        return i if i < len(self._blocks) else None
+
+    def _check_fields(self):
+        pass  # the owner thaws the segment when the schema changes
+
+    def _use_parallel_scan(self):
+        return False
+
+    @property
+    def first_id(self):
+        return self._blocks[0][0] if self._blocks else None
+
+    @property
+    def last_id(self):
+        return self._blocks[-1][1] if self._blocks else 0
+
+    @last_id.setter
+    def last_id(self, value):
+        pass
+
+    def _append_row(self, parsed):
+        raise EnvironmentError('a compressed table cannot be appended to')
+
+    def get_writer(self, reset=False):
+        raise EnvironmentError('a compressed table cannot be appended to')
+
+    def _offset_of_id(self, row_id):
+        i = self._block_of_id(row_id)
+        if i is None:
+            return self._raw_size
+        offset = self._raw_starts[i]
+        for line in self._block_lines(i):
+            if int(next(csv.reader([line.decode(self._encoding)], delimiter=' '))[0]) >= row_id:
+                break
+            offset += len(line)
+        return offset
+
+    @contextmanager
+    def get_reader(self, no_header=True, reverse=False, end=None):
+        if no_header and reverse:
+            raise EnvironmentError(
+                'You cannot set both no_header and reverse True'
+                '\nin general, header won\'t be read in reverse mode'
+            )
+
+        def lines():
+            if not no_header and not reverse:
+                yield self._dump_row(self.header).decode(self._encoding)
+            order = range(len(self._blocks))
+            if reverse:
+                order = reversed(order)
+            for i in order:
+                start = self._raw_starts[i]
+                if end is not None and start >= end:
+                    continue
+                block = self._block_lines(i)
+                if reverse:
+                    if end is not None and start + self._blocks[i][5] > end:
+                        pos, kept = start, []
+                        for line in block:
+                            if pos + len(line) > end:
+                                break
+                            kept.append(line)
+                            pos += len(line)
+                        block = kept
+                    block = reversed(block)
+                for line in block:
+                    yield line.decode(self._encoding)
+
+        gen = lines()
+        try:
+            yield csv.reader(gen, delimiter=' ')
+        finally:
+            gen.close()
+
+    def _search_offsets(self, condition):
+        ids = id_terms(condition)
+        if ids is not None:
+            yield from self._offsets_of_ids(ids)
+            return
+        _, code = self._compile_where(condition)
+        ids = self._candidate_ids(condition)
+        if ids is not None:
+            yield from self._offsets_of_ids(ids, code)
+            return
+        with self.get_reader(no_header=True) as reader:
+            line_c, offset = 1, 0
+            for row in reader:
+                line_c += 1
+                size = len(self._dump_row(row))
+                if eval(code, {"row": row, "match": match}):
+                    yield line_c, offset, size, self._parse_values(row)
+                offset += size
+
+    def _offsets_of_ids(self, ids, code=None):
+        for row_id in ids:
+            i = self._block_of_id(row_id)
+            if i is None or row_id < self._blocks[i][0]:
+                continue
+            offset = self._raw_starts[i]
+            for n, line in enumerate(self._block_lines(i)):
+                row = next(csv.reader([line.decode(self._encoding)], delimiter=' '))
+                if int(row[0]) == row_id:
+                    if code is None or eval(code, {"row": row, "match": match}):
+                        yield self._row_starts[i] + n, offset, len(line), \
+                            self._parse_values(row)
+                    break
+                offset += len(line)
+
+    def _rows_by_ids(self, ids):
+        for row_id in ids:
+            i = self._block_of_id(row_id)
+            if i is None or row_id < self._blocks[i][0]:
+                continue
+            for line in self._block_lines(i):
+                row = next(csv.reader([line.decode(self._encoding)], delimiter=' '))
+                if int(row[0]) == row_id:
+                    yield row
+                    break
+
+    def _rewrite_rows(self, changes: dict):
+        """Apply {line: row or None to delete} by compressing the changed
+        blocks again at the end of the file."""
+        by_block = {}
+        for line, row in changes.items():
+            i = bisect.bisect_right(self._row_starts, line) - 1
+            by_block.setdefault(i, {})[line - self._row_starts[i]] = row
+
+        blocks = list(self._blocks)
+        with open(self._file, 'r+b') as f:
+            f.seek(self._end)  # the current footer stays as it is
+            garbage = self.garbage + self._footer_size
+            for i, rows in sorted(by_block.items()):
+                lines = []
+                for n, line in enumerate(self._block_lines(i)):
+                    if n not in rows:
+                        lines.append(line)
+                    elif rows[n] is not None:
+                        lines.append(self._dump_row(rows[n]))
+                garbage += blocks[i][4]
+                blocks[i] = self._write_block(f, self._module, lines) if lines else None
+            blocks = [b for b in blocks if b is not None]
+            footer_start = f.tell()
+            self._end = self._write_footer(f, self.codec, self.header, blocks, garbage)
+            self._footer_size = self._end - footer_start
+
+        self.garbage = garbage
+        self._set_blocks(blocks)
+        if self.garbage > self._end // 2:
+            self._compact()
+
+    def _compact(self):
+        tmp_name = f'{self._file.name}.plain'
+        self.thaw(tmp_name)
+        plain = Table(self.table_name, self.fields, self._data_dir, file_name=tmp_name)
+        self.seal(plain, self.codec, self._file.name)
+        plain._file.unlink()
+        self._open()
+
+    def _delete_lines(self, lines: list):
+        self._rewrite_rows({line: None for line in lines})
+
+    def _update_lines(self, lines: dict):
+        self._rewrite_rows(lines)
+
+    def _patch_lines(self, patches: list):
+        self._rewrite_rows({
+            line: data and next(csv.reader([data.decode(self._encoding)], delimiter=' '))
+            for line, _, _, data in patches})
+
+    def stats(self):
+        start = time.perf_counter()
+        for i in range(len(self._blocks)):
+            self._decompress(i)
+        return {'codec': self.codec,
+                'blocks': len(self._blocks),
+                'rows': sum(b[2] for b in self._blocks),
+                'raw_bytes': self._raw_size,
+                'stored_bytes': self._file.stat().st_size,
+                'decompress_seconds': time.perf_counter() - start}
+
+
+class PartitionedTable(Table):
+    """Table stored as one segment file per range of ids, or per month of a
+    TIMESTAMP column. The segments are tables of their own, listed in
+    <table>.manifest; reads skip the segments that cannot hold the rows they
+    look for and writes only rewrite the segments they touch. With compress
+    set, every segment but the newest one is kept as a CompressedTable."""
+
+    def __init__(self, table_name: str, fields: dict, data_dir: Path,
+                 indexes: dict = None, parallel_scan_threshold: int = None,
+                 partition: tuple = ('id', 100000), compress: str = None):
+        self.partition_field, self.partition_size = partition
+        if compress is not None and compress not in CompressedTable.codecs:
+            raise ValueError(f'unknown compression {compress}')
+        self.compress = compress
+        self.segments = OrderedDict()  # key -> Table, in key order
+        self._ranges = {}  # key -> [min_id, max_id] or None when empty
+        super().__init__(table_name, fields, data_dir, indexes,
+                         parallel_scan_threshold)
+
+    def __repr__(self):
+        return f'<PartitionedTable {self.table_name} ({len(self.segments)} segments)>'
+
+    @property
+    def _manifest(self):
+        return self._data_dir / f'{self.table_name}.manifest'
+
+    def _open(self):
+        self._file = self._manifest
+        if self.partition_field == 'id':
+            if not str(self.partition_size).isdigit() or int(self.partition_size) < 1:
+                raise ValueError('id partitions need a positive size')
+            self.partition_size = int(self.partition_size)
+        elif self.get(self.partition_field) is None \
+                or self[self.partition_field].__qualname__ != 'TIMESTAMP' \
+                or str(self.partition_size).lower() != 'month':
+            raise ValueError('partition by id <size> or by <timestamp field> month')
+        else:
+            self.partition_size = 'month'
+
+        spec = {'field': self.partition_field, 'size': self.partition_size}
+        manifest = self._read_manifest()
+        for key in manifest.get('segments', []):
+            self._open_segment(key)
+
+        sources = []
+        single = self._data_dir / f'{self.table_name}.txt'
+        if single.exists():
+            # the table was not partitioned before, split its file up
+            sources.append(Table(self.table_name, self.fields, self._data_dir,
+                                 file_name=single.name))
+        if manifest and {k: manifest.get(k) for k in spec} != spec:
+            sources.extend(self.segments.values())
+
+        if sources:
+            self._repartition(sources)
+        elif manifest.get('compress') != self.compress or not manifest:
+            self._write_manifest()
+        self._apply_compression()
+
+    def _read_manifest(self):
+        try:
+            with open(self._manifest, 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def _write_manifest(self):
+        manifest = {'field': self.partition_field,
+                    'size': self.partition_size,
+                    'compress': self.compress,
+                    'segments': list(self.segments)}
+        tmp = self._manifest.with_suffix('.manifest.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(manifest, f, indent=1)
+        os.replace(tmp, self._manifest)
+
+    def _segment_file(self, key):
+        return f'{self.table_name}.{key}.txt'
+
+    @staticmethod
+    def _segment_table(table_name, fields, data_dir, key, parallel_scan_threshold=None):
+        cold = data_dir / f'{table_name}.{key}.cold'
+        plain = data_dir / f'{table_name}.{key}.txt'
+        if cold.exists():
+            if plain.exists():
+                plain.unlink()  # left behind by an interrupted seal or thaw
+            return CompressedTable(table_name, fields, data_dir, cold.name)
+        return Table(table_name, fields, data_dir,
+                     parallel_scan_threshold=parallel_scan_threshold,
+                     file_name=plain.name)
+
+    def _open_segment(self, key):
+        segment = self._segment_table(self.table_name, self.fields, self._data_dir,
+                                      key, self.parallel_scan_threshold)
+        if isinstance(segment, CompressedTable) and segment.header != list(self):
+            segment = self._thaw(key, segment)  # let the plain table migrate it
+        first = segment.first_id
+        self._ranges[key] = [first, segment.last_id] if first is not None else None
+        self.segments[key] = segment
+        return segment
+
+    def _segment_key(self, row_id, row):
+        if self.partition_field == 'id':
+            return f'{(int(row_id) - 1) // self.partition_size:06d}'
+        return str(row[self.partition_field])[:7]  # YYYY-MM
+
+    def _segment_for(self, key):
+        if key not in self.segments:
+            self._open_segment(key)
+            self.segments = OrderedDict(sorted(self.segments.items()))
+            self._write_manifest()
+            self._apply_compression()
+        elif isinstance(self.segments[key], CompressedTable):
+            # a late row for a sealed segment, it is sealed again later
+            self.segments[key] = self._thaw(key, self.segments[key])
+        return self.segments[key]
+
+    def _thaw(self, key, segment):
+        segment.thaw(self._segment_file(key))
+        segment.close()
+        segment._file.unlink()
+        return Table(self.table_name, self.fields, self._data_dir,
+                     parallel_scan_threshold=self.parallel_scan_threshold,
+                     file_name=self._segment_file(key))
+
+    def _seal(self, key, segment):
+        cold = f'{self.table_name}.{key}.cold'
+        CompressedTable.seal(segment, self.compress, cold)
+        segment.close()
+        segment._file.unlink()
+        return CompressedTable(self.table_name, self.fields, self._data_dir, cold)
+
+    def _apply_compression(self):
+        """Seal every segment but the newest one with the configured codec,
+        or thaw them all when compression is off."""
+        keys = list(self.segments)
+        for key in keys:
+            segment = self.segments[key]
+            if isinstance(segment, CompressedTable) and segment.codec != self.compress:
+                segment = self.segments[key] = self._thaw(key, segment)
+            if self.compress and key != keys[-1] \
+                    and not isinstance(segment, CompressedTable):
+                self.segments[key] = self._seal(key, segment)
+
+    def compression_stats(self):
+        return OrderedDict((key, segment.stats())
+                           for key, segment in self.segments.items()
+                           if isinstance(segment, CompressedTable))
+
+    def _repartition(self, sources):
+        """Move every row of the source tables into new segments laid out by
+        the current partitioning, the sources are removed."""
+        tmp_dir = Path(tempfile.mkdtemp(prefix=f'.{self.table_name}-', dir=self._data_dir))
+        field_idx = list(self).index(self.partition_field)
+        files = {}
+        try:
+            for source in sources:
+                with source.get_reader() as reader:
+                    for row in reader:
+                        key = self._segment_key(row[0], {self.partition_field: row[field_idx]})
+                        if key not in files:
+                            f = open(tmp_dir / self._segment_file(key), 'w')
+                            files[key] = f, csv.writer(f, delimiter=' ', quotechar='"',
+                                                       quoting=csv.QUOTE_ALL,
+                                                       lineterminator='\n')
+                            files[key][1].writerow(list(self))
+                        files[key][1].writerow(row)
+        finally:
+            for f, _ in files.values():
+                f.close()
+
+        for source in sources:
+            source.close()
+            source._file.unlink()
+        for new in tmp_dir.iterdir():
+            os.replace(new, self._data_dir / new.name)
+        tmp_dir.rmdir()
+
+        self.segments.clear()
+        self._ranges.clear()
+        for key in sorted(files):
+            self._open_segment(key)
+        self._write_manifest()
+        self._changed()
+
+    @staticmethod
+    def merge_segments(table, manifest):
+        """Append the segments listed in a manifest to a plain table, then
+        drop them."""
+        with open(manifest, 'r') as f:
+            keys = json.load(f).get('segments', [])
+
+        for key in keys:
+            segment = PartitionedTable._segment_table(
+                table.table_name, table.fields, table._data_dir, key)
+            if isinstance(segment, CompressedTable) and segment.header != list(table):
+                segment.thaw(f'{table.table_name}.{key}.txt')
+                segment._file.unlink()
+                segment = Table(table.table_name, table.fields, table._data_dir,
+                                file_name=f'{table.table_name}.{key}.txt')
+            with segment.get_reader() as reader, table.get_writer() as writer:
+                writer.writerows(reader)
+            segment.close()
+            segment._file.unlink()
+        manifest.unlink()
+        table.last_id = None
+        table._changed()
+
+    def data_mtime_ns(self):
+        return max([self._manifest.stat().st_mtime_ns]
+                   + [s.data_mtime_ns() for s in self.segments.values()])
+
+    def _check_fields(self):
+        pass  # every segment checks its own header
+
+    def _flush_appends(self):
+        for segment in self.segments.values():
+            segment._flush_appends()
+
+    def sync(self):
+        for segment in self.segments.values():
+            segment.sync()
+
+    def close(self):
+        for segment in self.segments.values():
+            segment.close()
+
+    def _prune(self, condition=None, before=None):
+        """Keys of the segments that may hold rows matching the condition."""
+        wanted = id_terms(condition)
+        if wanted is None and condition \
+                and not any(p.lower() in ('or', '(', ')') for p in condition):
+            for i, p in enumerate(condition):
+                if p == '==' and condition[i-1] == 'id':
+                    wanted = [int(condition[i+1].strip("'"))]
+
+        keys = []
+        for key, bounds in self._ranges.items():
+            if bounds is None:
+                continue
+            if wanted is not None and not any(bounds[0] <= w <= bounds[1] for w in wanted):
+                continue
+            if before is not None and bounds[0] >= int(before):
+                continue
+            keys.append(key)
+        return keys
+
+    @property
+    def last_id(self):
+        if not getattr(self, '_last_id', None):
+            self._last_id = max([b[1] for b in self._ranges.values() if b] or [0])
+        return self._last_id
+
+    @last_id.setter
+    def last_id(self, value):
+        self._last_id = value
+
+    @property
+    def first_id(self):
+        return min([b[0] for b in self._ranges.values() if b], default=None)
+
+    def _append_row(self, parsed):
+        key = self._segment_key(parsed['id'], parsed)
+        segment = self._segment_for(key)
+        segment._append_row(parsed)
+        segment.last_id = parsed['id']
+        bounds = self._ranges[key]
+        if bounds is None:
+            self._ranges[key] = [parsed['id'], parsed['id']]
+        else:
+            bounds[0] = min(bounds[0], parsed['id'])
+            bounds[1] = max(bounds[1], parsed['id'])
+
+    def _search(self, condition, reverse=False, end=None):
+        keys = self._prune(condition)
+        for key in reversed(keys) if reverse else keys:
+            for line, row in self.segments[key]._search(condition, reverse=reverse):
+                yield (key, line), row
+
+    def _search_offsets(self, condition):
+        ids = self._index_candidates(condition)  # the segments have no indexes
+        code = ids is not None and self._compile_where(condition)[1]
+        for key in self._prune(condition):
+            if ids is None:
+                found = self.segments[key]._search_offsets(condition)
+            else:
+                low, high = self._ranges[key] or (1, 0)
+                found = self.segments[key]._offsets_of_ids(
+                    [row_id for row_id in ids if low <= row_id <= high], code)
+            for line, offset, size, row in found:
+                yield (key, line), offset, size, row
+
+    def _by_segment(self, items):
+        grouped = OrderedDict()
+        for (key, line), value in items:
+            grouped.setdefault(key, []).append((line, value))
+        return grouped
+
+    def _delete_lines(self, lines: list):
+        for key, items in self._by_segment((l, None) for l in lines).items():
+            self.segments[key]._delete_lines([line for line, _ in items])
+
+    def _update_lines(self, lines: dict):
+        for key, items in self._by_segment(lines.items()).items():
+            self.segments[key]._update_lines(dict(items))
+
+    def _patch_lines(self, patches: list):
+        grouped = self._by_segment((loc, (o, s, d)) for loc, o, s, d in patches)
+        for key, items in grouped.items():
+            self.segments[key]._patch_lines([(line, *p) for line, p in items])
+
+    def _rows_by_ids(self, ids):
+        batch_keys, batch = None, []
+        for row_id in ids:
+            # the id ranges of month segments may overlap, look in all of them
+            keys = [k for k, b in self._ranges.items() if b and b[0] <= row_id <= b[1]]
+            if keys != batch_keys and batch:
+                yield from self._segment_rows(batch_keys, batch)
+                batch = []
+            batch_keys = keys
+            if keys:
+                batch.append(row_id)
+        if batch:
+            yield from self._segment_rows(batch_keys, batch)
+
+    def _segment_rows(self, keys, ids):
+        if len(keys) == 1:
+            yield from self.segments[keys[0]]._rows_by_ids(ids)
+            return
+        found = {}
+        for key in keys:
+            for row in self.segments[key]._rows_by_ids(ids):
+                found[int(row[0])] = row
+        for row_id in ids:
+            if row_id in found:
+                yield found[row_id]
+
+    def _column_candidates(self, condition):
+        if self.partition_field != 'id':
+            return None  # selects give rows in month order, not in id order
+        return super()._column_candidates(condition)
+
+    def _select(self, where, limit=None, reverse=False, before=None, plan=None):
+        ids = self._index_candidates(where) if plan is None else plan.ids
+        if ids is None:
+            ids = self._column_candidates(where)
+        if ids is not None:
+            return self._select_ids(ids, where, limit=limit, reverse=reverse,
+                                    before=before)
+        if before is not None and not reverse:
+            raise ValueError('before can only be used with a reverse select')
+
+        keys = self._prune(where, before=before)
         results = []
-        for line, vals in search:
-            results.append(vals['id'])
-            parsed = self._parse_values([vals['id']] + values)
-            self._check_for_uniqueness(parsed, to_update=True)
-            self._update_line(line, parsed.values())
+        for key in reversed(keys) if reverse else keys:
+            if limit is not None and len(results) >= limit:
+                break
+            bounds = self._ranges[key]
+            seg_before = before if before is not None and bounds[1] >= int(before) else None
+            results.extend(self.segments[key]._select(
+                where, limit=None if limit is None else limit - len(results),
+                reverse=reverse, before=seg_before))
         return results
 
+    def _iter(self, where):
+        ids = self._index_candidates(where)
+        if ids is None:
+            ids = self._column_candidates(where)
+        if ids is not None:
+            yield from self._select_ids(ids, where)
+            return
+        for key in self._prune(where):
+            yield from self.segments[key]._iter(where)
+
+    @contextmanager
+    def get_reader(self, no_header=True, reverse=False, end=None):
+        if no_header and reverse:
+            raise EnvironmentError(
+                'You cannot set both no_header and reverse True'
+                '\nin general, header won\'t be read in reverse mode'
+            )
+
+        def rows():
+            if not no_header and not reverse:
+                yield list(self)
+            segments = list(self.segments.values())
+            for segment in reversed(segments) if reverse else segments:
+                with segment.get_reader(no_header=not reverse, reverse=reverse) as reader:
+                    yield from reader
+
+        reader = rows()
+        try:
+            yield reader
+        finally:
+            reader.close()
+
+    def get_writer(self, reset=False):
+        raise EnvironmentError('write to a partitioned table through its segments')
+
+    def _read_view(self):
+        # segments come and go, so readers still share the table lock
+        return self._lock.read()
+
+
+class ResultCache(object):
+    """LRU cache of SELECT results bounded by their approximate size in
+    bytes. Entries remember the stamp of their table and are dropped as
+    soon as the table changes, in this process or another."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # key -> (stamp, rows, size)
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return (f'<ResultCache {len(self._entries)} entries, {self.size} bytes, '
+                f'{self.hits} hits, {self.misses} misses>')
+
+    @staticmethod
+    def _sizeof(rows):
+        size = sys.getsizeof(rows)
+        for row in rows:
+            size += sys.getsizeof(row) + sum(sys.getsizeof(v) for v in row.values())
+        return size
+
+    def _pop(self, key):
+        _, _, size = self._entries.pop(key)
+        self.size -= size
+
+    def get(self, key, stamp):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != stamp:
+                if entry is not None:
+                    self._pop(key)
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return [row.copy() for row in entry[1]]
+
+    def put(self, key, stamp, rows):
+        size = self._sizeof(rows)
+        if size > self.max_bytes:
+            return
+
+        with self._lock:
+            if key in self._entries:
+                self._pop(key)
+            self._entries[key] = (stamp, [row.copy() for row in rows], size)
+            self.size += size
+            while self.size > self.max_bytes:
+                self._pop(next(iter(self._entries)))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+
+class ReplicationLog(object):
+    """Append-only log of the row changes of a primary database, one JSON
+    entry per line: [lsn, unix time, table, op, rows]. Tables append the
+    entry before they change their files, a primary that starts applies
+    the entries after its last checkpoint again. Replicas tail it and apply
+    the entries with Table.db_apply."""
+
+    file_name = 'replication.log'
+    checkpoint_name = 'replication.checkpoint'
+
+    def __init__(self, data_dir: Path):
+        self._file = Path(data_dir) / self.file_name
+        self._checkpoint_file = Path(data_dir) / self.checkpoint_name
+        self._lock = threading.Lock()
+        self._out = None  # append handle, opened by the first append
+        self.lsn = self.last_lsn()
+
+    def __repr__(self):
+        return f'<ReplicationLog {self._file} (lsn {self.lsn})>'
+
+    def last_lsn(self):
+        """The lsn of the last entry, also when checkpoints dropped it."""
+        try:
+            f = open(self._file, 'rb')
+        except FileNotFoundError:
+            return self.checkpoint_lsn()
+        with f:
+            end = f.seek(0, os.SEEK_END)
+            window = 4096
+            while True:
+                start = max(0, end - window)
+                f.seek(start)
+                lines = f.read(end - start).split(b'\n')
+                # the last complete line is before the final newline
+                complete = [l for l in lines[:-1] if l]
+                if complete and (start == 0 or len(complete) > 1):
+                    return max(json.loads(complete[-1])[0], self.checkpoint_lsn())
+                if start == 0:
+                    return self.checkpoint_lsn()
+                window *= 4
+
+    def size(self):
+        """Bytes of entries in the log, checkpoints drop those replicas
+        don't need anymore."""
+        try:
+            return os.path.getsize(self._file)
+        except FileNotFoundError:
+            return 0
+
+    def checkpoint_lsn(self):
+        """The lsn of the last entry known to be in the table files."""
+        try:
+            with open(self._checkpoint_file, 'r') as f:
+                return json.load(f)['lsn']
+        except FileNotFoundError:
+            return 0
+
+    def append(self, table_name, op, rows):
+        with self._lock:
+            self.lsn += 1
+            entry = json.dumps([self.lsn, time.time(), table_name, op, rows])
+            if self._out is None:
+                self._out = open(self._file, 'a', encoding='utf-8')
+            self._out.write(entry + '\n')
+            self._out.flush()  # replicas in other processes read it now
+            return self.lsn
+
+    def read(self, offset=0, start=None):
+        """Generate (entry, offset after it, lsn the log starts with) of the
+        complete entries from offset on. start is the lsn the log started
+        with when offset was taken, a log truncated since then is read from
+        its beginning."""
+        try:
+            f = open(self._file, 'rb')
+        except FileNotFoundError:
+            return
+        with f:
+            first = f.readline()
+            if not first.endswith(b'\n'):
+                return
+            first = json.loads(first)[0]
+            if first != start:
+                offset = 0
+            f.seek(offset)
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break  # still being written
+                offset += len(line)
+                yield json.loads(line), offset, first
+
+    def checkpoint(self, lsn, upto=0):
+        """Record that the entries up to lsn are in the table files, then
+        drop the entries up to lsn upto, or up to lsn if that is lower."""
+        tmp = self._checkpoint_file.with_suffix('.tmp')
+        with open(tmp, 'w') as f:
+            json.dump({'lsn': lsn}, f)
+        os.replace(tmp, self._checkpoint_file)
+
+        upto = min(upto, lsn)
+        with self._lock:
+            try:
+                f = open(self._file, 'rb')
+            except FileNotFoundError:
+                return
+            tmp = self._file.with_suffix('.tmp')
+            with f:
+                first = f.readline()
+                if not first.endswith(b'\n') or json.loads(first)[0] > upto:
+                    return  # nothing to drop
+                with open(tmp, 'wb') as out:
+                    for line in f:
+                        if line.endswith(b'\n') and json.loads(line)[0] > upto:
+                            out.write(line)
+            self.close()
+            os.replace(tmp, self._file)
+
+    def recover(self, db):
+        """Apply the entries after the last checkpoint again, for the
+        changes a crash stopped between the log and the table files.
+        db_apply skips those already there."""
+        checkpoint = self.checkpoint_lsn()
+        for (lsn, _, table_name, op, rows), _, _ in self.read():
+            if lsn > checkpoint and table_name in db:
+                db[table_name].db_apply(op, rows)
+
+    def close(self):
+        if self._out is not None:
+            self._out.close()
+            self._out = None
+
+
+class _TableShadow(Table):
+    """Stands in for a table written in a transaction. The changed rows are
+    kept in memory over the table, which the transaction holds write
+    locked, and the locations of rows are their ids. The changes are also
+    collected as ReplicationLog entries, COMMIT applies those to the table
+    with db_apply so only the changed rows, or segments, are written."""
+
+    def __init__(self, table):
+        OrderedDict.update(self, table)
+        self.__dict__.update(table.__dict__)
+        self._base = table
+        self._rows = {}  # id -> new raw row, None once deleted
+        self._lock = RWLock()
+        self._local = threading.local()
+        self._arrays = None
+        self.column_scans = False
+        self.last_id = table.last_id
+        self.indexes = OrderedDict(
+            (name, _DeferredIndex(index)) for name, index in table.indexes.items())
+        self.log = _DeferredLog()
+
+    def _read_view(self):
+        return nullcontext()  # the table can't change under the transaction
+
+    def _use_parallel_scan(self):
+        return False
+
+    def _changed(self):
+        self.version += 1
+
+    def _offset_of_id(self, row_id):
+        return row_id  # the end of get_reader is an id here
+
+    @contextmanager
+    def get_reader(self, no_header=True, reverse=False, end=None):
+        if no_header and reverse:
+            raise EnvironmentError(
+                'You cannot set both no_header and reverse True'
+                '\nin general, header won\'t be read in reverse mode'
+            )
+
+        def rows():
+            new = [row for row_id, row in sorted(self._rows.items())
+                   if row_id > self._base.last_id and row is not None
+                   and (end is None or row_id < end)]
+            if reverse:
+                yield from reversed(new)
+            with self._base.get_reader(no_header=no_header, reverse=reverse) as reader:
+                if not no_header and not reverse:
+                    header = next(reader, None)
+                    if header is not None:
+                        yield header
+                for row in reader:
+                    row_id = int(row[0])
+                    if end is not None and row_id >= end:
+                        continue
+                    row = self._rows.get(row_id, row)
+                    if row is not None:
+                        yield row
+            if not reverse:
+                yield from new
+
+        gen = rows()
+        try:
+            yield gen
+        finally:
+            gen.close()
+
+    def _rows_by_ids(self, ids):
+        batch = []
+        for row_id in ids:
+            if row_id not in self._rows:
+                batch.append(row_id)
+                if len(batch) < 64:
+                    continue
+            yield from self._base._rows_by_ids(batch)
+            batch = []
+            if self._rows.get(row_id) is not None:
+                yield self._rows[row_id]
+        yield from self._base._rows_by_ids(batch)
+
+    def _matching(self, condition, reverse=False, end=None):
+        ids = id_terms(condition)
+        if ids is not None:
+            ids = [row_id for row_id in ids if end is None or row_id < end]
+            yield from self._rows_by_ids(reversed(ids) if reverse else ids)
+            return
+        with self.get_reader(no_header=not reverse, reverse=reverse, end=end) as reader:
+            yield from reader
+
+    def _search(self, condition, reverse=False, end=None):
+        _, code = self._compile_where(condition)
+        for row in self._matching(condition, reverse, end):
+            if eval(code, {"row": row, "match": match}):
+                yield int(row[0]), self._parse_values(row)
+
+    def _search_offsets(self, condition):
+        for row_id, row in self._search(condition):
+            yield row_id, None, None, row
+
+    def _raw(self, data):
+        return next(csv.reader([data.decode(self._encoding)], delimiter=' '))
+
+    def _append_row(self, parsed):
+        self._rows[parsed['id']] = self._raw(self._dump_row(parsed.values()))
+
+    def _delete_lines(self, lines: list):
+        for row_id in lines:
+            self._rows[row_id] = None
+
+    def _update_lines(self, lines: dict):
+        for row_id, values in lines.items():
+            self._rows[row_id] = self._raw(self._dump_row(values))
+
+    def _patch_lines(self, patches: list):
+        for row_id, _, _, data in patches:
+            self._rows[row_id] = data and self._raw(data)
+
+
+class Transaction(object):
+    """Changes of one BEGIN ... COMMIT. Every table written in it gets a
+    _TableShadow and stays write locked until the end, COMMIT applies the
+    changes to the tables. Readers keep seeing the committed tables
+    meanwhile. A transaction that would wait for a table held by one
+    waiting for its own tables raises ValueError instead."""
+
+    journal_name = '.transaction.json'
+
+    def __init__(self, db):
+        self.db = db
+        self.shadows = OrderedDict()  # table name -> (table, shadow)
+        self._locks = ExitStack()
+
+    def __repr__(self):
+        return f'<Transaction on {", ".join(self.shadows) or "no tables"}>'
+
+    def shadow(self, table):
+        if table.table_name not in self.shadows:
+            self._acquire(table)
+            self.shadows[table.table_name] = table, _TableShadow(table)
+        return self.shadows[table.table_name][1]
+
+    def lock(self, *table_names):
+        """Write lock tables up front, in name order, so what is read from
+        them stays true until the transaction ends."""
+        for table_name in sorted(table_names):
+            if table_name not in self.db:
+                raise ValueError(f'table {table_name} doesn\'t exist')
+            self.shadow(self.db[table_name])
+
+    def _acquire(self, table):
+        db, name = self.db, table.table_name
+        with db._tx_graph:
+            # follow the transactions waiting for each other from the holder
+            owner = db._tx_owners.get(name)
+            while owner is not None:
+                if owner is self:
+                    raise ValueError(f'deadlock waiting for table {name}, roll back and retry')
+                owner = db._tx_owners.get(db._tx_waits.get(owner))
+            db._tx_waits[self] = name
+        try:
+            self._locks.enter_context(table._lock.write())
+        finally:
+            with db._tx_graph:
+                del db._tx_waits[self]
+        with db._tx_graph:
+            db._tx_owners[name] = self
+        self._locks.callback(db._tx_owners.pop, name)
+
+    def read(self, table):
+        shadowed = self.shadows.get(table.table_name)
+        return shadowed[1] if shadowed else table
+
+    def commit(self):
+        try:
+            entries = [entry for _, shadow in self.shadows.values()
+                       for entry in shadow.log.entries]
+            if not entries:
+                return
+            # if the process dies halfway, the next start applies them again
+            journal = self.db._data_dir / self.journal_name
+            tmp = journal.with_suffix('.tmp')
+            with open(tmp, 'w') as f:
+                json.dump(entries, f)
+            os.replace(tmp, journal)
+            self._apply(self.db, entries)
+            journal.unlink()
+        finally:
+            self._locks.close()
+
+    def rollback(self):
+        self._locks.close()
+
+    @staticmethod
+    def _apply(db, entries):
+        for table_name, op, rows in entries:
+            table = db[table_name]
+            if table.log is not None:
+                table.log.append(table_name, op, rows)
+            table.db_apply(op, rows)
+
+    @classmethod
+    def recover(cls, db):
+        """Apply the changes of a transaction whose commit didn't finish,
+        db_apply skips those already there."""
+        journal = db._data_dir / cls.journal_name
+        if not journal.exists():
+            return
+        with open(journal, 'r') as f:
+            cls._apply(db, json.load(f))
+        journal.unlink()
+
+
+Plan = namedtuple('Plan', 'path where ids limit reverse rows')
+
+
+class Planner(object):
+    """Chooses how a select finds its rows, from the statistics ANALYZE
+    keeps in .statistics.json of the data directory:
+
+        ids      binary search of the ids an id == ... condition names
+        index    probe of the ids a full-text or value index gives
+        full     scan of the data file
+        reverse  scan from the end, for a unique column value that the
+                 statistics place among the newer rows
+
+    Probes cost about log2(rows) each, so they only win when they touch few
+    rows. The terms of every AND and OR are reordered so the cheap ones that
+    settle it most often run first. Tables without statistics get rough
+    default selectivities."""
+
+    file_name = '.statistics.json'
+    term_costs = {'CONTAINS': 20, 'MATCH': 20}  # tokenizing is slow, comparing is not
+
+    def __init__(self, data_dir: Path):
+        self._file = data_dir / self.file_name
+        try:
+            with open(self._file, 'r') as f:
+                self.statistics = json.load(f)
+        except (FileNotFoundError, ValueError):
+            self.statistics = {}
+
+    def __repr__(self):
+        return f'<Planner {len(self.statistics)} tables analyzed>'
+
+    def analyze(self, table):
+        stats = self.statistics[table.table_name] = table.analyze()
+        tmp = self._file.with_suffix('.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(self.statistics, f)
+        os.replace(tmp, self._file)
+        return stats
+
+    def plan(self, table, where, limit=None, reverse=False, before=None):
+        stats = self.statistics.get(table.table_name)
+        rows = max(stats['rows'] if stats else table.last_id, 1)
+        if not where:
+            return Plan('full', where, None, limit, reverse, rows)
+
+        tree, selectivity, _ = self._reorder(table, stats, condition_tree(where), rows)
+        where = flatten_condition(tree)
+        estimate = selectivity * rows
+        probe = max(math.log2(rows), 1)
+
+        ids = self._ids(tree)
+        if ids is not None and len(ids) * probe < rows:
+            return Plan('ids', where, sorted(ids), limit, reverse, min(len(ids), estimate))
+
+        ids = table._index_candidates(where, limit=limit, reverse=reverse, before=before)
+        if ids is not None and len(ids) * probe < rows:
+            return Plan('index', where, ids, limit, reverse, len(ids))
+
+        unique = self._unique_term(table, tree)
+        if unique is not None and limit is None and before is None and not reverse:
+            # at most one row matches, stop at the first one
+            column = stats['columns'].get(unique[0]) if stats else None
+            if column and (column['correlation'] or 0) > 0.5 \
+                    and self._below(column, self._value(table, *unique)) > 0.5:
+                return Plan('reverse', where, None, 1, True, estimate)
+            return Plan('full', where, None, 1, False, estimate)
+
+        return Plan('full', where, None, limit, reverse, estimate)
+
+    def reorder(self, table, where):
+        """The where clause with the terms of every AND and OR reordered."""
+        if not where:
+            return where
+        stats = self.statistics.get(table.table_name)
+        rows = max(stats['rows'] if stats else table.last_id, 1)
+        return flatten_condition(self._reorder(table, stats, condition_tree(where), rows)[0])
+
+    def _reorder(self, table, stats, node, rows):
+        """(node, selectivity, cost) of a condition tree, with the children of
+        every AND sorted by cost per row they rule out and of every OR by
+        cost per row they let through."""
+        if len(node) == 3:
+            return node, self._selectivity(table, stats, node, rows), \
+                self.term_costs.get(node[1], 1)
+
+        children = [self._reorder(table, stats, child, rows) for child in node[1]]
+        cost = 0
+        if node[0] == 'AND':
+            children.sort(key=lambda c: c[2] / max(1 - c[1], 1e-9))
+            selectivity = 1
+            for _, sel, c in children:
+                cost += selectivity * c  # only evaluated while the AND holds
+                selectivity *= sel
+        else:
+            children.sort(key=lambda c: c[2] / max(c[1], 1e-9))
+            miss = 1
+            for _, sel, c in children:
+                cost += miss * c
+                miss *= 1 - sel
+            selectivity = 1 - miss
+        return (node[0], [c[0] for c in children]), selectivity, cost
+
+    def _selectivity(self, table, stats, term, rows):
+        """Estimated fraction of the rows matching a term."""
+        left, op, right = term
+        if left not in table:
+            raise ValueError(f'Column {left} doesn\'t exist')
+        index = table.indexes.get(left)
+        if index is not None and op in index.operators:
+            return index.count(right.strip("'")) / rows
+        if op in ('CONTAINS', 'MATCH'):
+            return 0.1
+
+        column = stats['columns'].get(left) if stats else None
+        if op in ('==', '!='):
+            if table[left]().unique:  # the fields set their attributes when used
+                equal = 1 / rows
+            elif column is None:
+                equal = 0.1
+            else:
+                equal = self._equal(column, self._value(table, left, right), rows)
+            return equal if op == '==' else 1 - equal
+
+        if column is None:
+            return 1 / 3
+        below = self._below(column, self._value(table, left, right))
+        return below if op in ('<', '<=') else 1 - below
+
+    @staticmethod
+    def _value(table, left, right):
+        """A where clause value the way the statistics store it."""
+        if right.startswith("'") and right.endswith("'"):
+            right = right[1:-1]
+        value = table[left](right)
+        if table[left].__qualname__ in ('INTEGER', 'BOOLEAN'):
+            return int(value)
+        return str(value)
+
+    @staticmethod
+    def _equal(column, value, rows):
+        common = dict((v, c) for v, c in column['common'])
+        if value in common:
+            return common[value] / rows
+        others = column['distinct'] - len(common)
+        if others <= 0:
+            return 0.0
+        return (rows - sum(common.values())) / others / rows
+
+    @staticmethod
+    def _below(column, value):
+        """Estimated fraction of the rows with a smaller value."""
+        bounds = column['histogram']
+        if len(bounds) < 2:
+            return 0.5
+        i = bisect.bisect_left(bounds, value)
+        if i == 0:
+            return 0.0
+        if i == len(bounds):
+            return 1.0
+        low, high = bounds[i - 1], bounds[i]  # low < value <= high
+        within = 0.5
+        if isinstance(value, int):
+            within = (value - low) / (high - low)
+        return (i - 1 + within) / (len(bounds) - 1)
+
+    @staticmethod
+    def _ids(node):
+        """The ids a condition can only match, from its id == terms, or None
+        if it may match other ids."""
+        if len(node) == 3:
+            left, op, right = node
+            return {int(right.strip("'"))} if left == 'id' and op == '==' else None
+        sets = [Planner._ids(child) for child in node[1]]
+        if node[0] == 'AND':
+            sets = [ids for ids in sets if ids is not None]
+            return set.intersection(*sets) if sets else None
+        if any(ids is None for ids in sets):
+            return None
+        return set.union(*sets)
+
+    @staticmethod
+    def _unique_term(table, node):
+        """An equality term on a unique column other than id that the whole
+        condition depends on."""
+        terms = [node] if len(node) == 3 else node[1] if node[0] == 'AND' else []
+        for term in terms:
+            if len(term) == 3 and term[1] == '==' and term[0] != 'id' \
+                    and term[0] in table and table[term[0]]().unique:
+                return term[0], term[2]
+        return None
+
 
 class Database(OrderedDict):
-    def __init__(self, db_name, schema_file):
+    def __init__(self, db_name, schema_file, result_cache_bytes=0,
+                 parallel_scan_threshold=64 * 1024 * 1024,
+                 replication_log=False, replica_of=None, column_scans=False):
+        """With replication_log, every row change is also written to a
+        ReplicationLog in the data directory. replica_of makes a read-only
+        replica of a primary Database (or of the data directory of one in
+        another process) that follows its log. column_scans answers selects
+        whose where clause only compares numeric columns from numpy arrays
+        of those columns."""
         normalized_name = re.sub(r'\s+', "_", db_name)
         self.db_name = db_name
+        self.result_cache = None
+        if result_cache_bytes:
+            self.result_cache = ResultCache(result_cache_bytes)
         self._data_dir = Path(f'{normalized_name}_data').absolute()
+        self.parallel_scan_threshold = parallel_scan_threshold
+        if column_scans:
+            _numpy()  # fail now rather than on the first select
+        self.column_scans = column_scans
         self._data_dir.mkdir(exist_ok=True)
+        self._specs = {}  # table name -> (fields, indexes, partition) until opened
+        self._open_lock = threading.Lock()
+        self._tx = threading.local()  # the open Transaction of every thread
+        self._tx_graph = threading.Lock()
+        self._tx_owners = {}  # table name -> Transaction holding it
+        self._tx_waits = {}  # Transaction -> table name it waits for
+        self._closed = threading.Event()
+
+        self.replication_log = None
+        if replication_log:
+            self.replication_log = ReplicationLog(self._data_dir)
+        self._replicas = []  # the ones following it in this process
+
+        self.replica_of = None
+        if replica_of is not None:
+            primary_dir = replica_of._data_dir if isinstance(replica_of, Database) \
+                else Path(replica_of).absolute()
+            if primary_dir == self._data_dir:
+                raise ValueError('a replica needs a data directory of its own')
+            self.replica_of = ReplicationLog(primary_dir)
+            if isinstance(replica_of, Database):
+                replica_of._replicas.append(self)
+            self._replica_lock = threading.Lock()
+            self._replica_state_file = self._data_dir / '.replica.json'
+            self._load_replica_state(replica_of)
+
+        self.planner = Planner(self._data_dir)  # after a new replica copied the statistics
         self._initialize_schema(schema_file)
+        if self.replication_log is not None:
+            self.replication_log.recover(self)
+        Transaction.recover(self)
 
     def __repr__(self):
         return f'<Database {self.db_name} ({super().__repr__()})>'
 
-    def _initialize_schema(self, schema_file):
-        with open(schema_file, 'r') as f:
-            emp_line_btw = 0
-            current_table = ''
-            current_fields = OrderedDict()
-            line_c = 0
-            while True:
-                raw_line = f.readline()
-                line_c += 1
-                line = re.sub(r'\s+', ' ', raw_line.strip())
+    def __getitem__(self, table_name):
+        table = super().__getitem__(table_name)
+        if table is None:
+            table = self._open_table(table_name)
+        return table
+
+    def get(self, table_name, default=None):
+        return self[table_name] if table_name in self else default
+
+    def values(self):
+        return [self[table_name] for table_name in self]
+
+    def items(self):
+        return [(table_name, self[table_name]) for table_name in self]
+
+    def _opened(self):
+        return [table for table in super().values() if table is not None]
+
+    def change_tag(self, *table_names):
+        """Short string that changes whenever one of the tables does, in this
+        process or another one, without reading their files. Results read
+        after taking it are at least as new as the tag, so it can validate
+        anything built from them."""
+        return '-'.join(self[table_name].stamp() for table_name in table_names)
+
+    def sync(self):
+        """Flush the buffered appends of every table and fsync its files."""
+        for table in self._opened():
+            table.sync()
+
+    def close(self):
+        """Stop following the primary, flush every table and release its
+        file handles. Tables used afterwards open them again."""
+        self._closed.set()
+        if self.replication_log is not None:
+            self.checkpoint()
+            self.replication_log.close()
+        for table in self._opened():
+            table.close()
+
+    def checkpoint(self, upto=None):
+        """Sync the tables and record that the log entries so far are in
+        their files, a restart only applies the later ones again. Then drop
+        the entries up to lsn upto, by default those that all the replicas
+        following this database in this process have applied. Replicas that
+        still need dropped entries have to be copied again."""
+        log = self.replication_log
+        if log is None:
+            raise ValueError('the database has no replication log')
+        if upto is None:
+            upto = min((replica.replica_lsn for replica in self._replicas), default=0)
+        with ExitStack() as stack:
+            tables = sorted(self._opened(), key=lambda table: table.table_name)
+            for table in tables:
+                stack.enter_context(table._lock.write())
+            for table in tables:
+                table.sync()
+            lsn = log.lsn
+        log.checkpoint(lsn, upto)
+
+    def _table(self, table_name, write=False):
+        """The table for a statement, or its shadow in the thread's open
+        transaction."""
+        try:
+            table = self[table_name]
+        except KeyError:
+            raise ValueError(f'table {table_name} doesn\'t exist')
+
+        tx = getattr(self._tx, 'current', None)
+        if tx is None:
+            return table
+        return tx.shadow(table) if write else tx.read(table)
+
+    def begin(self):
+        if getattr(self._tx, 'current', None) is not None:
+            raise ValueError('a transaction is already open')
+        if self.replica_of is not None:
+            raise ValueError('replica is read only')
+        self._tx.current = Transaction(self)
+
+    def _end_transaction(self, commit):
+        tx = getattr(self._tx, 'current', None)
+        if tx is None:
+            raise ValueError('no transaction is open')
+        try:
+            tx.commit() if commit else tx.rollback()
+        finally:
+            self._tx.current = None
 
-                if not line:
-                    if emp_line_btw > 5:
-                        if current_table:  # initialize latest table
-                            self._initialize_table(current_table, current_fields)
-                        break
+    def commit(self):
+        self._end_transaction(commit=True)
 
-                    emp_line_btw += 1
-                    continue
+    def rollback(self):
+        self._end_transaction(commit=False)
 
-                words = line.split()
-                words_len = len(words)
-                if words_len == 1:  # table
-                    if current_table:  # initialize previous table
-                        self._initialize_table(current_table, current_fields)
-                        current_table = ''
-                        current_fields = OrderedDict()
-
-                    current_table = words[0]
-                    if re.search(r'\s+', current_table):
-                        raise ValueError(
-                            f'table name cannot contain spaces, line {line_c}')
-
-                elif words_len == 3 and current_table:  # fields
-                    field_name, unique, field_type = words
-                    try:
-                        field = self._initialize_field(
-                            current_table, field_name, unique, field_type)
-                        current_fields[field_name] = field
-                    except ValueError as e:
-                        raise ValueError(f'schema error in line {line_c}: {e}')
+    @contextmanager
+    def transaction(self):
+        """BEGIN, then COMMIT when the block is done or ROLLBACK if it
+        raises."""
+        self.begin()
+        tx = self._tx.current
+        try:
+            yield tx
+        except BaseException:
+            if getattr(self._tx, 'current', None) is tx:
+                self.rollback()
+            raise
+        self.commit()
 
-                else:
-                    raise ValueError(f'bad schema in line {line_c}')
+    def _initialize_schema(self, schema_file):
+        for table_name, fields, indexes, partition in self._load_schema(schema_file):
+            fields = OrderedDict(
+                (field_name, self._initialize_field(table_name, field_name, unique, field_type))
+                for field_name, unique, field_type in fields)
+            self._initialize_table(table_name, fields, indexes,
+                                   tuple(partition) if partition else None)
+
+    def _load_schema(self, schema_file):
+        """Parsed schema, reused from the cache in the data directory while
+        schema.txt keeps its mtime or its content."""
+        schema_file = Path(schema_file).absolute()
+        cache_file = self._data_dir / '.schema.json'
+        mtime_ns = schema_file.stat().st_mtime_ns
+        try:
+            with open(cache_file, 'r') as f:
+                cache = json.load(f)
+        except (FileNotFoundError, ValueError):
+            cache = {}
+        if cache.get('file') == str(schema_file) and cache.get('mtime_ns') == mtime_ns:
+            return cache['tables']
+
+        with open(schema_file, 'rb') as f:
+            raw = f.read()
+        digest = hashlib.sha1(raw).hexdigest()
+        if cache.get('file') != str(schema_file) or cache.get('sha1') != digest:
+            cache = {'file': str(schema_file), 'sha1': digest,
+                     'tables': self._parse_schema(raw.decode())}
+        cache['mtime_ns'] = mtime_ns
+
+        tmp = cache_file.with_suffix('.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(cache, f)
+        os.replace(tmp, cache_file)
+        return cache['tables']
+
+    def _parse_schema(self, text):
+        """[table_name, [[field_name, unique, field_type], ...], indexes,
+        partition] of every table in the schema."""
+        tables = []
+        f = io.StringIO(text)
+        emp_line_btw = 0
+        current_table = ''
+        current_fields = []
+        current_indexes = OrderedDict()
+        current_partition = None
+        line_c = 0
+        while True:
+            raw_line = f.readline()
+            line_c += 1
+            line = re.sub(r'\s+', ' ', raw_line.strip())
+
+            if not line:
+                if emp_line_btw > 5:
+                    if current_table:  # add latest table
+                        tables.append([current_table, current_fields,
+                                       current_indexes, current_partition])
+                    break
+
+                emp_line_btw += 1
+                continue
+
+            words = line.split()
+            words_len = len(words)
+            if words_len == 1 or (words_len in (5, 7) and  # table
+                                  [w.upper() for w in words[1:3]] == ['PARTITION', 'BY']):
+                if current_table:  # add previous table
+                    tables.append([current_table, current_fields,
+                                   current_indexes, current_partition])
+                    current_table = ''
+                    current_fields = []
+                    current_indexes = OrderedDict()
+                    current_partition = None
+
+                current_table = words[0]
+                if words_len > 1:
+                    # <table> PARTITION BY <field> <size|MONTH> [COMPRESS <codec>]
+                    compress = None
+                    if words_len == 7:
+                        if words[5].upper() != 'COMPRESS':
+                            raise ValueError(f'bad schema in line {line_c}')
+                        compress = words[6].lower()
+                    current_partition = [words[3], words[4], compress]
+                if re.search(r'\s+', current_table):
+                    raise ValueError(
+                        f'table name cannot contain spaces, line {line_c}')
+
+            elif words_len in (3, 4) and current_table:  # fields
+                field_name, unique, field_type, *index = words
+                try:
+                    self._initialize_field(
+                        current_table, field_name, unique, field_type)
+                    current_fields.append([field_name, unique, field_type])
+                    if index:
+                        current_indexes[field_name] = self._initialize_index(
+                            field_type, index[0])
+                except ValueError as e:
+                    raise ValueError(f'schema error in line {line_c}: {e}')
 
-    def _initialize_table(self, table_name, fields):
-        self[table_name] = Table(table_name, fields, self._data_dir)
-        return self[table_name]
+            else:
+                raise ValueError(f'bad schema in line {line_c}')
+
+        return tables
+
+    def _initialize_table(self, table_name, fields, indexes=None, partition=None):
+        """Register a table, it is opened and checked against its data file
+        on first access."""
+        if partition is not None and partition[0] != 'id' and partition[0] not in fields:
+            raise ValueError(f'cannot partition {table_name} by unknown column {partition[0]}')
+        self._specs[table_name] = fields, indexes, partition
+        super().__setitem__(table_name, None)
+
+    def _open_table(self, table_name):
+        with self._open_lock:
+            table = super().__getitem__(table_name)
+            if table is not None:
+                return table  # opened by another thread meanwhile
+
+            # the spec stays until the table is built, a failed open can be retried
+            fields, indexes, partition = self._specs[table_name]
+            if partition is None:
+                table = Table(table_name, fields, self._data_dir, indexes,
+                              self.parallel_scan_threshold)
+            else:
+                field_name, size, compress = partition
+                table = PartitionedTable(table_name, fields, self._data_dir, indexes,
+                                         self.parallel_scan_threshold,
+                                         partition=(field_name, size),
+                                         compress=compress)
+            table.log = self.replication_log
+            table.column_scans = self.column_scans
+            super().__setitem__(table_name, table)
+            del self._specs[table_name]
+            return table
+
+    def _load_replica_state(self, primary):
+        try:
+            with open(self._replica_state_file, 'r') as f:
+                self._replica_state = json.load(f)
+            return
+        except FileNotFoundError:
+            pass
+
+        # a new replica starts from a copy of the primary's files, taken
+        # while a primary in this process can't change them
+        with ExitStack() as stack:
+            if isinstance(primary, Database):
+                for table in primary.values():
+                    stack.enter_context(table._lock.read())
+            log = self.replica_of
+            if isinstance(primary, Database):
+                lsn = log.last_lsn()  # no change is between its log and its files
+            else:
+                lsn = log.checkpoint_lsn()  # later ones are applied again
+            self._replica_state = {'offset': 0, 'start': None, 'lsn': lsn}
+            skip = (ReplicationLog.file_name, ReplicationLog.checkpoint_name,
+                    '.schema.json', '.replica.json')
+            for path in log._file.parent.iterdir():
+                if path.is_file() and path.name not in skip \
+                        and path.suffix not in ('.fts', '.idx', '.tmp'):
+                    shutil.copy2(path, self._data_dir / path.name)
+        self._save_replica_state()
+
+    def _save_replica_state(self):
+        tmp = self._replica_state_file.with_suffix('.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(self._replica_state, f)
+        os.replace(tmp, self._replica_state_file)
+
+    @property
+    def replica_lsn(self):
+        return self._replica_state['lsn']
+
+    def replica_lag(self):
+        """Seconds the oldest change that isn't applied yet has been in the
+        primary's log, 0 when the replica is up to date."""
+        state = self._replica_state
+        for (lsn, logged_at, *_), _, _ in self.replica_of.read(state['offset'],
+                                                                state.get('start')):
+            if lsn > state['lsn']:
+                return max(0.0, time.time() - logged_at)
+        return 0.0
+
+    def catch_up(self):
+        """Apply the primary's changes that aren't applied yet, returns how
+        many were applied."""
+        applied = 0
+        with self._replica_lock:
+            state = self._replica_state
+            entries = self.replica_of.read(state['offset'], state.get('start'))
+            for (lsn, _, table_name, op, rows), offset, start in entries:
+                if lsn > state['lsn'] + 1:
+                    raise ValueError(f'the primary dropped the changes after {state["lsn"]}, '
+                                     'copy the replica again')
+                if lsn > state['lsn']:
+                    self[table_name].db_apply(op, rows)
+                    applied += 1
+                state['offset'], state['start'] = offset, start
+                state['lsn'] = max(lsn, state['lsn'])
+            if applied:
+                self._save_replica_state()
+        return applied
+
+    def follow(self, interval=0.05):
+        """Keep catching up in a daemon thread."""
+        def run():
+            while not self._closed.is_set():
+                self.catch_up()
+                self._closed.wait(interval)
+
+        thread = threading.Thread(target=run, name=f'replica-{self.db_name}', daemon=True)
+        thread.start()
+        return thread
+
+    def _initialize_index(self, field_type, index):
+        index = index.lower()
+        if index == 'fulltext':
+            if not field_type.lower().startswith('char'):
+                raise ValueError('only CHAR fields can have a FULLTEXT index')
+        elif index == 'index':
+            if field_type.lower() != 'integer':
+                raise ValueError('only INTEGER fields can have an INDEX')
+        else:
+            raise ValueError('unknown index')
+        return index
 
     def _initialize_field(self, table_name, field_name, unique, field_type):
         if re.search(r'\s+', field_name):
@@ -534,173 +3849,272 @@ class Database(OrderedDict):
 
         return field
 
-    def _parse_where(self, where):
-        cond = []
-        for token in where[1:]:  # start after where keyword
-            if token.ttype == sqlparse.tokens.Whitespace:
-                continue
-
-            elif isinstance(token, sqlparse.sql.Comparison):
-                op = token.value \
-                    .replace(token.left.value, '') \
-                    .replace(token.right.value, '') \
-                    .strip()
-                right = token.left.value
-                left = token.right.value
-                cond.extend([right, op, left])
-            elif token.match(sqlparse.tokens.Keyword, ['AND', 'OR']):
-                cond.append(token.value)
-            else:
-                raise ValueError('Error in where clause syntax')
-        return cond
-
-    def _parse_values(self, values):
-        fields = []
-        for token in values[1:]:  # start after value keyword
-            if isinstance(token, sqlparse.sql.Parenthesis):
-                for vals in token:
-                    if vals.ttype == sqlparse.tokens.Punctuation:
-                        continue
-                    try:
-                        for val in vals:
-                            if val.ttype in (sqlparse.tokens.Punctuation,
-                                             sqlparse.tokens.Whitespace):
-                                continue
-                            v = val.value
-                            if v.startswith("'") and v.endswith("'"):
-                                v = v[1:-1]
-                            fields.append(v)
-                    except TypeError:
-                        v = vals.value
-                        if v.startswith("'") and v.endswith("'"):
-                            v = v[1:-1]
-                        fields.append(v)
-
-        return fields
+    def _run_select(self, statement, limit=None, reverse=False, before=None):
+        table = self._table(statement.table)
+        where = statement.where
+        order_by = None
+        if statement.order_by is not None:
+            order_by, descending = statement.order_by
+            reverse = reverse != descending
+
+        def select():
+            return table.db_select(where, limit=limit, reverse=reverse, before=before,
+                                   order_by=order_by, planner=self.planner)
+
+        if self.result_cache is None or isinstance(table, _TableShadow):
+            return select()
+
+        key = (statement.text, limit, reverse, before)
+        stamp = table.stamp()  # read it before the scan, never after
+        results = self.result_cache.get(key, stamp)
+        if results is None:
+            results = select()
+            self.result_cache.put(key, stamp, results)
+        return results
 
-    def _parse_select(self, statement, limit=None, reverse=False):
-        st = filter(lambda t: t.ttype != sqlparse.tokens.Whitespace, statement)
-        try:
-            assert next(st).match(sqlparse.tokens.Keyword.DML, ['SELECT'])
-            assert next(st).match(sqlparse.tokens.Keyword, ['FROM'])
+    def _run_aggregate(self, statement):
+        table = self._table(statement.table)
+        return table.db_aggregate(statement.func, statement.column,
+                                  statement.where, group_by=statement.group_by)
+
+    def _run_write(self, statement):
+        if self.replica_of is not None:
+            raise ValueError('replica is read only')
+
+        table = self._table(statement.table, write=True)
+        if isinstance(statement, Insert):
+            return [table.db_insert(statement.values)]
+        where = self.planner.reorder(table, statement.where)
+        if isinstance(statement, Update):
+            return table.db_update(where, statement.values)
+        if isinstance(statement, UpdateSet):
+            return table.db_update_set(where, statement.assignments)
+        table.db_delete(where)
+        return []
+
+    def analyze(self, table_name=None):
+        """Collect the planner statistics of a table, or of all tables.
+        Returns a row per column."""
+        results = []
+        for name in [table_name] if table_name else list(self):
+            stats = self.planner.analyze(self._table(name))
+            for column, st in stats['columns'].items():
+                results.append(OrderedDict([
+                    ('table', name), ('column', column), ('rows', stats['rows']),
+                    ('distinct', st['distinct']), ('correlation', st['correlation'])]))
+        return results
 
-            table = next(st)
-            assert type(table) == sqlparse.sql.Identifier
-            try:
-                table = self[table.value]
-            except KeyError:
-                raise ValueError(f'table {table.value} doesn\'t exist')
-        except (StopIteration, AssertionError):
-            raise ValueError("Error in query syntax")
+    def _run_explain(self, statement, limit=None, reverse=False, before=None):
+        table = self._table(statement.table)
+        if statement.order_by is not None:
+            return [OrderedDict([('path', 'order'), ('rows', None),
+                                 ('where', ' '.join(statement.where or []))])]
+        plan = self.planner.plan(table, statement.where, limit=limit, reverse=reverse,
+                                 before=before)
+        return [OrderedDict([('path', plan.path), ('rows', round(plan.rows, 1)),
+                             ('where', ' '.join(plan.where or []))])]
+
+    def _run_statement(self, statement, limit=None, reverse=False, before=None):
+        if isinstance(statement, Select):
+            return self._run_select(statement, limit=limit, reverse=reverse,
+                                    before=before)
+
+        if isinstance(statement, Aggregate):
+            return self._run_aggregate(statement)
+
+        if isinstance(statement, Analyze):
+            return self.analyze(statement.table)
+
+        if isinstance(statement, Explain):
+            return self._run_explain(statement.statement, limit=limit,
+                                     reverse=reverse, before=before)
+
+        if isinstance(statement, Control):
+            if statement.action == 'BEGIN':
+                self.begin()
+            elif statement.action == 'COMMIT':
+                self.commit()
+            else:
+                self.rollback()
+            return []
 
-        try:
-            where = self._parse_where(next(st))
-        except StopIteration:
-            where = None
+        return self._run_write(statement)
 
-        return table.db_select(where, limit=limit, reverse=reverse)
+    def _abort(self):
+        if getattr(self._tx, 'current', None) is not None:
+            self.rollback()  # a failed statement aborts its transaction
 
-    def _parse_delete(self, statement):
-        st = filter(lambda t: t.ttype != sqlparse.tokens.Whitespace, statement)
+    def run_query(self, query, select_limit=None, select_reverse=False,
+                  select_before=None):
+        results = []
         try:
-            assert next(st).match(sqlparse.tokens.Keyword.DML, ['DELETE'])
-            assert next(st).match(sqlparse.tokens.Keyword, ['FROM'])
+            for statement in parse_sql(query):
+                results.extend(self._run_statement(statement, limit=select_limit,
+                                                   reverse=select_reverse,
+                                                   before=select_before))
+        except Exception:
+            self._abort()
+            raise
 
-            table = next(st)
-            assert type(table) == sqlparse.sql.Identifier
-            try:
-                table = self[table.value]
-            except KeyError:
-                raise ValueError(f'table {table.value} doesn\'t exist')
-        except (StopIteration, AssertionError):
-            raise ValueError("Error in query syntax")
+        return results
 
+    def stream_query(self, query):
+        """(statement, results) of every statement of the query, each run
+        when the generator gets to it. Selects without ORDER BY give their
+        rows one at a time instead of a list, read them before going on to
+        the next statement."""
         try:
-            where = self._parse_where(next(st))
-        except StopIteration:
-            where = None
-
-        return table.db_delete(where)
+            for statement in parse_sql(query):
+                if isinstance(statement, Select) and statement.order_by is None:
+                    rows = self._table(statement.table).db_iter(statement.where)
+                    yield statement, self._streamed(rows)
+                else:
+                    yield statement, self._run_statement(statement)
+        except Exception:
+            self._abort()
+            raise
 
-    def _parse_insert(self, statement):
-        st = filter(lambda t: t.ttype != sqlparse.tokens.Whitespace, statement)
+    def _streamed(self, rows):
         try:
-            assert next(st).match(sqlparse.tokens.Keyword.DML, ['INSERT'])
-            assert next(st).match(sqlparse.tokens.Keyword, ['INTO'])
+            yield from rows
+        except Exception:
+            self._abort()
+            raise
 
-            table = next(st)
-            assert type(table) == sqlparse.sql.Identifier
-            try:
-                table = self[table.value]
-            except KeyError:
-                raise ValueError(f'table {table.value} doesn\'t exist')
-
-            values = next(st)
-            assert type(values) == sqlparse.sql.Values
-            values = self._parse_values(values)
 
-        except (StopIteration, AssertionError):
-            raise ValueError("Error in query syntax")
+class AsyncDatabase(object):
+    """asyncio facade over a Database, the blocking table I/O runs in a
+    bounded thread pool. Tables take care of the locking: writers of a table
+    are serialized while its readers run in parallel."""
 
-        return table.db_insert(values)
+    def __init__(self, db: Database, max_workers=8):
+        from concurrent.futures import ThreadPoolExecutor
 
-    def _parse_update(self, statement):
-        st = filter(lambda t: t.ttype != sqlparse.tokens.Whitespace, statement)
-        try:
-            assert next(st).match(sqlparse.tokens.Keyword.DML, ['UPDATE'])
+        self.db = db
+        self._executor = ThreadPoolExecutor(max_workers=max_workers,
+                                            thread_name_prefix='db-io')
 
-            table = next(st)
-            assert type(table) == sqlparse.sql.Identifier
+    def __repr__(self):
+        return f'<AsyncDatabase {self.db.db_name}>'
+
+    async def run(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._executor, functools.partial(func, *args, **kwargs))
+
+    async def run_query(self, query, select_limit=None, select_reverse=False,
+                        select_before=None):
+        return await self.run(self.db.run_query, query,
+                              select_limit=select_limit,
+                              select_reverse=select_reverse,
+                              select_before=select_before)
+
+    def close(self, wait=True):
+        self._executor.shutdown(wait=wait)
+
+
+def _shell_line(c, r):
+    if isinstance(r, dict):
+        _ = f'{c}) '
+        for k, v in r.items():
+            _ += f'{k}: {v}\t'
+        return _
+    return f'{c}) {r}'
+
+
+class Batch(object):
+    """Runs SQL scripts without prompting, statement by statement as they
+    are read. Results are written to out as they come, as shell lines, csv
+    or json lines; with timing, the latency and row count of every
+    statement go to stderr. The first failing statement stops the script."""
+
+    outputs = ('text', 'csv', 'jsonl')
+
+    def __init__(self, db, out=sys.stdout, output='text', timing=False):
+        if output not in self.outputs:
+            raise ValueError(f'unknown output {output}')
+        self.db = db
+        self.out = out
+        self.output = output
+        self.timing = timing
+
+    @staticmethod
+    def _scripts(lines):
+        """Pieces of the input ending with a ;, as soon as it is read."""
+        buffer = ''
+        tokens = []
+        for line in lines:
+            buffer += line
             try:
-                table = self[table.value]
-            except KeyError:
-                raise ValueError(f'table {table.value} doesn\'t exist')
-
-            where_n_values = next(st)
-            assert type(where_n_values) == sqlparse.sql.Where
-            values_idx = None
-            for n, i in enumerate(where_n_values):
-                if i.match(sqlparse.tokens.Keyword, "VALUES"):
-                    values_idx = n
-            assert values_idx
-            where = self._parse_where(where_n_values[:values_idx])
-            values = self._parse_values(where_n_values[values_idx:])
-
-        except (StopIteration, AssertionError):
-            raise ValueError("Error in query syntax")
-
-        return table.db_update(where, values)
-
-    def run_query(self, query, select_limit=None, select_reverse=False):
-        splited = sqlparse.split(query)
-        if not all(p.endswith(';') for p in splited):
-            raise ValueError('Query should be ended with ;')
-
-        results = []
-        for part in splited:
-            part = part.strip(';')
-            for statement in sqlparse.parse(part):
-                _type = statement.get_type()
-
-                if _type == 'SELECT':
-                    results.extend(self._parse_select(statement,
-                                                      limit=select_limit,
-                                                      reverse=select_reverse))
-
-                elif _type == 'INSERT':
-                    results.append(self._parse_insert(statement))
-
-                elif _type == 'UPDATE':
-                    results.extend(self._parse_update(statement))
-
-                elif _type == 'DELETE':
-                    self._parse_delete(statement)
-
-        return results
+                tokens = lex_sql(buffer)
+            except ValueError:
+                tokens = None  # a string goes on in the next line
+                continue
+            if tokens and tokens[-1] == ('punct', ';'):
+                yield buffer
+                buffer, tokens = '', []
+        if tokens is None or tokens:
+            yield buffer  # let the parser tell what is wrong with it
+
+    @staticmethod
+    def _describe(statement):
+        if isinstance(statement, Control):
+            return statement.action
+        if isinstance(statement, Explain):
+            return f'EXPLAIN {statement.statement.table}'
+        kind = type(statement).__name__
+        kind = {'Aggregate': 'SELECT', 'UpdateSet': 'UPDATE'}.get(kind, kind.upper())
+        return f'{kind} {statement.table or ""}'.rstrip()
+
+    def _write(self, results):
+        """Writes the results of a statement, returns how many there were."""
+        c = 0
+        if self.output == 'csv':
+            writer = csv.writer(self.out, lineterminator='\n')
+            header = None
+            for c, r in enumerate(results, 1):
+                if not isinstance(r, dict):
+                    writer.writerow([r])
+                    continue
+                if header != list(r):
+                    header = list(r)
+                    writer.writerow(header)
+                writer.writerow(r.values())
+        elif self.output == 'jsonl':
+            for c, r in enumerate(results, 1):
+                self.out.write(json.dumps(r, default=str) + '\n')
+        else:
+            for c, r in enumerate(results, 1):
+                self.out.write(_shell_line(c, r) + '\n')
+        self.out.flush()
+        return c
+
+    def run(self, lines):
+        """Runs the statements of lines, returns how many ran."""
+        n = 0
+        for script in self._scripts(lines):
+            statements = self.db.stream_query(script)
+            while True:
+                start = time.perf_counter()
+                statement, results = next(statements, (None, None))
+                if statement is None:
+                    break
+                rows = self._write(results)
+                n += 1
+                if self.timing:
+                    ms = (time.perf_counter() - start) * 1000
+                    print(f'-- {n}) {self._describe(statement)}: {rows} rows, '
+                          f'{ms:.3f} ms', file=sys.stderr)
+        return n
 
 
 class Shell(object):
+    # the shell's dependencies are only imported when it is used, so the
+    # apps importing the database start fast
+
     def __init__(self, db_name, schema_file):
+        from prompt_toolkit.completion import WordCompleter
+
         self.db_name = db_name
         self.db = Database(db_name, schema_file)
         self.table_names = set(self.db.keys())
@@ -716,41 +4130,55 @@ class Shell(object):
             'help',
             'tables',
             'schema',
+            'compression',
             'exit',
             'SELECT',
             'FROM',
             'INSERT',
             'INTO',
             'UPDATE',
+            'SET',
             'DELETE',
             'WHERE',
             'VALUES',
+            'BEGIN',
+            'COMMIT',
+            'ROLLBACK',
+            'ANALYZE',
+            'EXPLAIN',
+            'ORDER',
+            'GROUP',
+            'BY',
+            'DESC',
+            'COUNT',
+            'SUM',
+            'MAX',
+            'MIN',
             *self.table_names,
             *self.column_names,
+            'CONTAINS',
+            'MATCH',
             '==',
             '!=',
+            '<',
+            '<=',
+            '>',
+            '>=',
         ], ignore_case=True)
 
     def run_query(self, query):
-        results = self.db.run_query(query)
-        c = 1
-        for r in results:
-            if isinstance(r, dict):
-                _ = f'{c}) '
-                for k, v in r.items():
-                    _ += f'{k}: {v}\t'
-                print(_)
-                c += 1
-            else:
-                print(f'{c}) {r}')
-                c += 1
+        for c, r in enumerate(self.db.run_query(query), 1):
+            print(_shell_line(c, r))
 
     def show_help(self):
+        from prompt_toolkit import print_formatted_text, HTML
+
         print_formatted_text(
             HTML(
                 "<b>help</b>\tShow this message\n"
                 "<b>tables</b>\tShow table names\n"
                 "<b>schema [table_name]</b>\tShow table's schema\n"
+                "<b>compression [table_name]</b>\tShow compression ratio and read overhead\n"
                 "<b>exit</b>\tExit the shell\n"
                 "\n"
                 "<b>Also you can run database queries</b>\n"
@@ -778,7 +4206,39 @@ class Shell(object):
             c += 1
         print(_, end='')
 
+    def show_compression(self, table):
+        if table not in self.table_names:
+            raise ValueError(f'table {table} doesn\'t exist')
+        if not getattr(self.db[table], 'compress', None):
+            raise ValueError(f'table {table} is not compressed')
+
+        stats = self.db[table].compression_stats()
+        c = 1
+        _ = ''
+        for key, st in stats.items():
+            ratio = st['raw_bytes'] / max(st['stored_bytes'], 1)
+            _ += (f'{c}) {key.ljust(12)}{st["codec"]:>6}{st["rows"]:>10} rows'
+                  f'{st["blocks"]:>6} blocks{st["raw_bytes"] / 1024:>12.1f} KiB ->'
+                  f'{st["stored_bytes"] / 1024:>10.1f} KiB{ratio:>8.2f}x\n')
+            c += 1
+
+        raw = sum(st['raw_bytes'] for st in stats.values())
+        stored = sum(st['stored_bytes'] for st in stats.values())
+        blocks = sum(st['blocks'] for st in stats.values())
+        seconds = sum(st['decompress_seconds'] for st in stats.values())
+        if blocks:
+            _ += (f'ratio {raw / max(stored, 1):.2f}x ({raw - stored} bytes saved)\n'
+                  f'read overhead {seconds * 1000 / blocks:.2f} ms per block, '
+                  f'{seconds * 1000 / (raw / 1024 / 1024):.1f} ms per MiB scanned\n')
+        else:
+            _ += 'no sealed segments yet\n'
+        print(_, end='')
+
     def run(self):
+        from pygments.lexers.sql import SqlLexer
+        from prompt_toolkit import PromptSession, print_formatted_text, HTML
+        from prompt_toolkit.lexers import PygmentsLexer
+
         session = PromptSession(
             lexer=PygmentsLexer(SqlLexer),
             completer=self.completer,
@@ -810,10 +4270,19 @@ class Shell(object):
                 elif matches := re.findall(r'^schema (\S+)$', cmd):
                     self.show_schema(matches[0])
 
+                elif matches := re.findall(r'^compression (\S+)$', cmd):
+                    self.show_compression(matches[0])
+
                 elif cmd_lower.startswith('select') \
                         or cmd_lower.startswith('insert') \
                         or cmd_lower.startswith('delete') \
-                        or cmd_lower.startswith('update'):
+                        or cmd_lower.startswith('update') \
+                        or cmd_lower.startswith('begin') \
+                        or cmd_lower.startswith('start') \
+                        or cmd_lower.startswith('commit') \
+                        or cmd_lower.startswith('rollback') \
+                        or cmd_lower.startswith('analyze') \
+                        or cmd_lower.startswith('explain'):
                     self.run_query(cmd)
 
                 else:
@@ -826,18 +4295,43 @@ class Shell(object):
             except EOFError:
                 break  # Control-D pressed.
 
+        self.db.close()
         print('GoodBye!')
 
 
 if __name__ == '__main__':
-    if not len(sys.argv) == 3:
-        print_formatted_text(HTML(
-            '<ansired>db_name and schema_file must be defined</ansired>\n'
-            '<i>try to run database file this way:</i>\n'
-            '<b>python database.py [db_name] [schema_file]</b>'
-        ))
-        exit(0)
-
-    _, db_name, schema_file = sys.argv
-    shell = Shell(db_name, schema_file)
-    shell.run()
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='Database shell. Given a SQL script, or SQL piped to '
+                    'stdin, it runs the statements without prompting.')
+    parser.add_argument('db_name')
+    parser.add_argument('schema_file')
+    parser.add_argument('script', nargs='?',
+                        help='SQL file to run, - for stdin')
+    parser.add_argument('--timing', action='store_true',
+                        help='print the latency and row count of every '
+                             'statement to stderr')
+    parser.add_argument('--output', choices=Batch.outputs, default=None,
+                        help='format of the results of a script (default: text)')
+    args = parser.parse_args()
+
+    if args.script is None and sys.stdin.isatty():
+        if args.timing or args.output:
+            parser.error('--timing and --output are for scripts')
+        Shell(args.db_name, args.schema_file).run()
+        sys.exit(0)
+
+    db = Database(args.db_name, args.schema_file)
+    batch = Batch(db, output=args.output or 'text', timing=args.timing)
+    try:
+        if args.script in (None, '-'):
+            batch.run(sys.stdin)
+        else:
+            with open(args.script, 'r') as f:
+                batch.run(f)
+    except ValueError as err:
+        print(f'error: {err}', file=sys.stderr)
+        sys.exit(1)
+    finally:
+        db.close()
@@ -0,0 +1,360 @@
+import os
+import re
+import sys
+import time
+import random
+import shutil
+import socket
+import argparse
+import tempfile
+import threading
+import subprocess
+import urllib.parse
+import urllib.request
+import http.cookiejar
+from pathlib import Path
+from collections import defaultdict
+
+
+APP_FILE = Path(__file__).absolute().parent / 'twitter.py'
+SCHEMA_FILE = Path(__file__).absolute().parent / 'schema.txt'
+DEFAULT_MIX = 'timeline=70,post=10,like=15,retweet=5'
+
+
+class _PassThrough(urllib.request.HTTPErrorProcessor):
+    '''Hand every response back as is, redirects and errors included,
+    so each request is timed on its own.'''
+
+    def http_response(self, request, response):
+        return response
+
+    https_response = http_response
+
+
+class Stats(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+
+    def record(self, route, latency, ok):
+        with self._lock:
+            self.latencies[route].append(latency)
+            if not ok:
+                self.errors[route] += 1
+
+    @staticmethod
+    def percentile(sorted_values, p):
+        if not sorted_values:
+            return 0.0
+        k = max(0, min(len(sorted_values) - 1,
+                       int(round(p / 100 * len(sorted_values) + 0.5)) - 1))
+        return sorted_values[k]
+
+    def report(self, elapsed):
+        rows = []
+        total = 0
+        for route in sorted(self.latencies):
+            values = sorted(self.latencies[route])
+            total += len(values)
+            rows.append((route, len(values), self.errors[route],
+                         len(values) / elapsed,
+                         self.percentile(values, 50) * 1000,
+                         self.percentile(values, 95) * 1000,
+                         self.percentile(values, 99) * 1000))
+
+        print(f'{"route".ljust(10)}{"reqs":>8}{"errors":>8}{"req/s":>10}'
+              f'{"p50 ms":>10}{"p95 ms":>10}{"p99 ms":>10}')
+        for route, count, errors, rps, p50, p95, p99 in rows:
+            print(f'{route.ljust(10)}{count:>8}{errors:>8}{rps:>10.1f}'
+                  f'{p50:>10.1f}{p95:>10.1f}{p99:>10.1f}')
+        print(f'\n{total} requests in {elapsed:.1f}s '
+              f'({total / elapsed:.1f} req/s)')
+
+
+class Client(object):
+    def __init__(self, base_url, username, password, stats):
+        self.base_url = base_url
+        self.username = username
+        self.password = password
+        self.stats = stats
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()),
+            _PassThrough())
+
+    def request(self, route, path, data=None):
+        if data is not None:
+            data = urllib.parse.urlencode(data).encode()
+
+        start = time.perf_counter()
+        ok = False
+        body = ''
+        location = ''
+        try:
+            with self.opener.open(self.base_url + path, data=data, timeout=30) as res:
+                body = res.read().decode(errors='replace')
+                location = res.headers.get('Location', '')
+                ok = res.status < 400
+        except OSError:
+            pass
+        latency = time.perf_counter() - start
+
+        if route:
+            self.stats.record(route, latency, ok)
+        return ok, body, location
+
+    def sign_up(self):
+        creds = {'username': self.username, 'password': self.password}
+        self.request(None, '/register', creds)
+        _, _, location = self.request(None, '/login', creds)
+        if not location or location.rstrip('/').endswith('/login'):
+            raise RuntimeError(f'cannot login as {self.username}')
+
+
+class LoadTest(object):
+    tweet_re = re.compile(r'id="t(\d+)"')
+    location_re = re.compile(r'#t(\d+)$')
+
+    def __init__(self, base_url, users, concurrency, mix, duration=None,
+                 requests=None, seed=None):
+        self.base_url = base_url.rstrip('/')
+        self.users = users
+        self.concurrency = concurrency
+        self.mix = mix
+        self.duration = duration
+        self.requests = requests
+        self.random = random.Random(seed)
+        self.stats = Stats()
+        self.tweet_ids = []
+        self._ids_lock = threading.Lock()
+        self._budget_lock = threading.Lock()
+        self._sent = 0
+
+    def _remember(self, ids):
+        with self._ids_lock:
+            known = set(self.tweet_ids)
+            self.tweet_ids.extend(int(i) for i in ids if int(i) not in known)
+            del self.tweet_ids[:-1000]  # keep recent ones only
+
+    def _pick_tweet(self, rnd):
+        with self._ids_lock:
+            if not self.tweet_ids:
+                return None
+            return rnd.choice(self.tweet_ids)
+
+    def _has_budget(self, deadline):
+        if deadline is not None and time.perf_counter() >= deadline:
+            return False
+        if self.requests is not None:
+            with self._budget_lock:
+                if self._sent >= self.requests:
+                    return False
+                self._sent += 1
+        return True
+
+    def _step(self, client, rnd):
+        routes, weights = zip(*self.mix.items())
+        route = rnd.choices(routes, weights)[0]
+
+        if route == 'timeline':
+            ok, body, _ = client.request(route, '/')
+            if ok:
+                self._remember(self.tweet_re.findall(body))
+            return
+
+        if route == 'post':
+            text = f'load test tweet {rnd.getrandbits(32):08x} from {client.username}'
+            ok, _, location = client.request(route, '/tweet', {'text': text})
+            if ok and (m := self.location_re.search(location)):
+                self._remember([m[1]])
+            return
+
+        tweet_id = self._pick_tweet(rnd)
+        if tweet_id is None:
+            ok, body, _ = client.request('timeline', '/')
+            if ok:
+                self._remember(self.tweet_re.findall(body))
+            return
+
+        if route == 'like':
+            client.request(route, f'/like/{tweet_id}')
+        elif route == 'retweet':
+            client.request(route, f'/retweet_confirm/{tweet_id}')
+        else:
+            raise ValueError(f'unknown route {route}')
+
+    def _worker(self, clients, deadline, seed):
+        rnd = random.Random(seed)
+        while self._has_budget(deadline):
+            self._step(rnd.choice(clients), rnd)
+
+    def run(self):
+        run_id = f'{self.random.getrandbits(24):06x}'
+        clients = [Client(self.base_url, f'lt{run_id}_{i}', 'loadtest', self.stats)
+                   for i in range(self.users)]
+        for client in clients:
+            client.sign_up()
+
+        ok, body, _ = clients[0].request(None, '/')
+        if ok:
+            self._remember(self.tweet_re.findall(body))
+
+        deadline = None
+        if self.duration is not None:
+            deadline = time.perf_counter() + self.duration
+
+        threads = []
+        start = time.perf_counter()
+        for i in range(self.concurrency):
+            # spread users over workers, they only share one when users < concurrency
+            own = clients[i::self.concurrency] or [clients[i % len(clients)]]
+            t = threading.Thread(target=self._worker,
+                                 args=(own, deadline, self.random.random()),
+                                 daemon=True)
+            t.start()
+            threads.append(t)
+
+        for t in threads:
+            t.join()
+
+        return time.perf_counter() - start
+
+
+def parse_mix(mix):
+    parsed = {}
+    for part in mix.split(','):
+        route, _, weight = part.partition('=')
+        route = route.strip()
+        if route not in ('timeline', 'post', 'like', 'retweet'):
+            raise ValueError(f'unknown route in mix: {route}')
+        try:
+            parsed[route] = float(weight)
+        except ValueError:
+            raise ValueError(f'invalid weight for {route}: {weight!r}')
+    if not any(parsed.values()):
+        raise ValueError('mix must have at least one positive weight')
+    return parsed
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def seed_data(work_dir, tweets, likes):
+    sys.path.insert(0, str(APP_FILE.parent))
+    from database import Database
+
+    cwd = os.getcwd()
+    os.chdir(work_dir)  # twitter_data is resolved against the working dir
+    try:
+        db = Database('twitter', 'schema.txt')
+    finally:
+        os.chdir(cwd)
+
+    db.run_query("INSERT INTO users VALUES ('loadtest_seed', 'loadtest', '');")
+    seed_id = db['users'].last_id
+    for i in range(tweets):
+        db['tweets'].db_insert([seed_id, 'loadtest_seed', f'seed tweet number {i}',
+                                '', 0, '', 0])
+    first = max(1, db['tweets'].last_id - tweets + 1)
+    for i in range(likes):
+        db['tweet_likes'].db_insert([first + i % max(tweets, 1), seed_id])
+
+
+def data_sizes(data_dir):
+    return {p.name: p.stat().st_size for p in sorted(Path(data_dir).glob('*.txt'))}
+
+
+def start_server(work_dir, port):
+    env = dict(os.environ, FLASK_APP=str(APP_FILE), FLASK_ENV='production')
+    proc = subprocess.Popen(
+        [sys.executable, '-m', 'flask', 'run', '--no-reload',
+         '--host', '127.0.0.1', '--port', str(port)],
+        cwd=work_dir, env=env,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError('twitter.py exited during startup')
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=0.5):
+                return proc
+        except OSError:
+            time.sleep(0.1)
+
+    proc.terminate()
+    raise RuntimeError('twitter.py did not start in time')
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Replay a mix of timeline views, posts, likes and retweets '
+                    'against Rekt Twitter and report latency per route.')
+    parser.add_argument('--url', help='target an already running server '
+                                      'instead of starting twitter.py')
+    parser.add_argument('--data-dir', help='copy this data directory into the '
+                                           'sandbox before starting')
+    parser.add_argument('--seed-tweets', type=int, default=0,
+                        help='append this many tweets before starting')
+    parser.add_argument('--seed-likes', type=int, default=0,
+                        help='append this many likes before starting')
+    parser.add_argument('--users', type=int, default=10)
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--duration', type=float, default=30,
+                        help='seconds to run (ignored with --requests)')
+    parser.add_argument('--requests', type=int, help='total requests to send')
+    parser.add_argument('--mix', default=DEFAULT_MIX,
+                        help=f'route weights (default: {DEFAULT_MIX})')
+    parser.add_argument('--seed', type=int, help='random seed')
+    parser.add_argument('--keep', action='store_true',
+                        help='keep the sandbox directory afterwards')
+    args = parser.parse_args()
+
+    try:
+        mix = parse_mix(args.mix)
+    except ValueError as err:
+        parser.error(str(err))
+
+    work_dir = None
+    proc = None
+    base_url = args.url
+    try:
+        if base_url is None:
+            work_dir = Path(tempfile.mkdtemp(prefix='rekt-loadtest-'))
+            shutil.copy(SCHEMA_FILE, work_dir / 'schema.txt')
+            if args.data_dir:
+                shutil.copytree(args.data_dir, work_dir / 'twitter_data')
+            if args.seed_tweets or args.seed_likes:
+                seed_data(work_dir, args.seed_tweets, args.seed_likes)
+
+            port = free_port()
+            proc = start_server(work_dir, port)
+            base_url = f'http://127.0.0.1:{port}'
+            print(f'started twitter.py at {base_url} in {work_dir}')
+
+            for name, size in data_sizes(work_dir / 'twitter_data').items():
+                print(f'  {name.ljust(20)}{size:>14} bytes')
+            print()
+
+        test = LoadTest(base_url, args.users, args.concurrency, mix,
+                        duration=None if args.requests else args.duration,
+                        requests=args.requests, seed=args.seed)
+        elapsed = test.run()
+        test.stats.report(elapsed)
+
+    finally:
+        if proc is not None:
+            proc.terminate()
+            proc.wait()
+        if work_dir is not None:
+            if args.keep:
+                print(f'sandbox kept at {work_dir}')
+            else:
+                shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+import re
+import sys
+import shutil
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    """Empty working directory with the app's schema.txt, databases keep
+    their data in <name>_data under it."""
+    shutil.copy(ROOT / 'schema.txt', tmp_path)
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+@pytest.fixture
+def schema(workdir):
+    """Writes a copy of schema.txt with another tweets line, like
+    'tweets PARTITION BY id 100', and returns its name."""
+    def make(tweets_line, name='test_schema.txt'):
+        text = (workdir / 'schema.txt').read_text()
+        (workdir / name).write_text(text.replace('\ntweets\n', f'\n{tweets_line}\n'))
+        return name
+    return make
+
+
+def add_tweets(db, count, **values):
+    """Insert count tweets of user 1, values override the columns."""
+    columns = dict(user_id=1, user_username='x', text='hello', posted_at='',
+                   retweet_id=0, retweet_from_username='', likes=0)
+    columns.update(values)
+    return [db['tweets'].db_insert([v(i) if callable(v) else v for v in columns.values()])
+            for i in range(count)]
+
+
+@pytest.fixture
+def twitter(workdir, monkeypatch):
+    """The twitter app module, with a CURD of a database in the working
+    directory."""
+    import twitter
+    monkeypatch.setattr(twitter, 'curd', twitter.CURD('twitter', 'schema.txt'))
+    twitter.app.config['TESTING'] = True
+    return twitter
+
+
+def logged_in(app, username):
+    """Test client of app, registered and logged in as username."""
+    client = app.test_client()
+    client.post('/register', data={'username': username, 'password': 'secret'})
+    client.post('/login', data={'username': username, 'password': 'secret'})
+    return client
+
+
+def page_ids(response):
+    """Ids of the tweets of a rendered page, in page order."""
+    return [int(i) for i in re.findall(r'id="t(\d+)"', response.get_data(as_text=True))]
@@ -0,0 +1,91 @@
+import asyncio
+import threading
+import time
+
+from conftest import add_tweets
+from database import AsyncDatabase, Database, RWLock
+
+
+def test_readers_share_the_lock_and_a_writer_waits_for_them():
+    lock, inside, events = RWLock(), threading.Barrier(2, timeout=5), []
+
+    def reader():
+        with lock.read():
+            inside.wait()  # both readers are in at once
+            time.sleep(0.1)
+            events.append('read')
+
+    def writer():
+        with lock.write():
+            events.append('write')
+
+    readers = [threading.Thread(target=reader) for _ in range(2)]
+    for thread in readers:
+        thread.start()
+    time.sleep(0.05)
+    w = threading.Thread(target=writer)
+    w.start()
+    for thread in readers + [w]:
+        thread.join(5)
+    assert events == ['read', 'read', 'write']
+
+
+def test_writers_are_serialized():
+    lock, active, most = RWLock(), [0], [0]
+
+    def writer():
+        with lock.write():
+            active[0] += 1
+            most[0] = max(most[0], active[0])
+            time.sleep(0.02)
+            active[0] -= 1
+
+    threads = [threading.Thread(target=writer) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+    assert most[0] == 1
+
+
+def test_async_queries_run_in_the_pool(workdir):
+    db = Database('twitter', 'schema.txt')
+    add_tweets(db, 10)
+    adb = AsyncDatabase(db, max_workers=4)
+
+    async def main():
+        names = await asyncio.gather(*[adb.run(lambda: threading.current_thread().name)
+                                       for _ in range(4)])
+        counts = await asyncio.gather(*[adb.run_query("SELECT FROM tweets WHERE user_id == 1;")
+                                        for _ in range(8)])
+        await adb.run_query("UPDATE tweets SET likes = 1 WHERE id == 3;")
+        return names, counts
+
+    try:
+        names, counts = asyncio.run(main())
+    finally:
+        adb.close()
+    assert all(name.startswith('db-io') for name in names)
+    assert [len(rows) for rows in counts] == [10] * 8
+    assert db['tweets'].db_select()[2]['likes'] == 1
+
+
+def test_asgi_app_serves_the_login_page(twitter, monkeypatch):
+    import twitter_async
+    from asgiref.testing import ApplicationCommunicator
+    monkeypatch.setattr(twitter_async, 'acurd', twitter_async.AsyncCURD(twitter.curd))
+
+    async def get(path):
+        scope = {'type': 'http', 'http_version': '1.1', 'method': 'GET',
+                 'path': path, 'raw_path': path.encode(), 'query_string': b'',
+                 'root_path': '', 'scheme': 'http', 'headers': [],
+                 'server': ('test', 80), 'client': ('test', 1234)}
+        app = ApplicationCommunicator(twitter_async.asgi_app, scope)
+        await app.send_input({'type': 'http.request', 'body': b''})
+        start = await app.receive_output(5)
+        body = await app.receive_output(5)
+        return start['status'], body['body']
+
+    status, body = asyncio.run(get('/login'))
+    assert status == 200
+    assert b'password' in body.lower()
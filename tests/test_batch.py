@@ -0,0 +1,25 @@
+import io
+
+from database import Batch, Database
+
+
+def test_scripts_split_on_statements_outside_strings_and_comments():
+    lines = ["-- header, it's ignored;\n",
+             "SELECT FROM tweets; -- trailing\n",
+             "INSERT INTO tweets VALUES (1, 'x', 'a -- b;\n", "c', '', 0, '', 0);\n",
+             "SELECT FROM tweets -- no end here;\n", "WHERE id == 1;\n",
+             "-- end\n"]
+    assert list(Batch._scripts(lines)) == [
+        "-- header, it's ignored;\nSELECT FROM tweets; -- trailing\n",
+        "INSERT INTO tweets VALUES (1, 'x', 'a -- b;\nc', '', 0, '', 0);\n",
+        "SELECT FROM tweets -- no end here;\nWHERE id == 1;\n"]
+    assert list(Batch._scripts(["SELECT FROM tweets\n"])) == ["SELECT FROM tweets\n"]
+
+
+def test_run_writes_the_results(workdir):
+    out = io.StringIO()
+    batch = Batch(Database('twitter', 'schema.txt'), out=out, output='jsonl')
+    script = ["INSERT INTO tweets VALUES (1, 'x', 'hi -- there', '', 0, '', 0); -- one\n",
+              "SELECT FROM tweets WHERE id == 1; -- and back\n"]
+    assert batch.run(script) == 2
+    assert '"text": "hi -- there"' in out.getvalue().splitlines()[-1]
@@ -0,0 +1,16 @@
+from conftest import add_tweets
+from database import Database
+
+
+def test_tag_changes_with_writes_of_other_processes(workdir):
+    worker, other = Database('twitter', 'schema.txt'), Database('twitter', 'schema.txt')
+    add_tweets(worker, 3)
+    tag = worker.change_tag('tweets', 'tweet_likes')
+    assert worker.change_tag('tweets', 'tweet_likes') == tag
+    assert Database('twitter', 'schema.txt').change_tag('tweets', 'tweet_likes') == tag
+
+    other.run_query("UPDATE tweets SET likes = 1 WHERE id == 2;")  # same size
+    assert worker.change_tag('tweets', 'tweet_likes') != tag
+    tag = worker.change_tag('tweets', 'tweet_likes')
+    other.run_query("INSERT INTO tweet_likes VALUES (2, 1);")
+    assert worker.change_tag('tweets', 'tweet_likes') != tag
@@ -0,0 +1,39 @@
+import pytest
+
+from conftest import add_tweets
+from database import Database
+
+pytest.importorskip('numpy')
+
+
+@pytest.fixture
+def db(workdir):
+    db = Database('twitter', 'schema.txt', column_scans=True)
+    add_tweets(db, 60, user_id=lambda i: i % 4 + 1, likes=lambda i: i % 7)
+    return db
+
+
+def test_aggregates_match_the_rows(db):
+    rows = db['tweets'].db_select()
+    assert db.run_query("SELECT SUM(likes) FROM tweets WHERE user_id < 3;")[0]['SUM(likes)'] \
+        == sum(r['likes'] for r in rows if r['user_id'] < 3)
+    grouped = db.run_query("SELECT COUNT(*) FROM tweets GROUP BY user_id;")
+    assert [(g['user_id'], g['COUNT(*)']) for g in grouped] == [(1, 15), (2, 15), (3, 15), (4, 15)]
+
+
+@pytest.mark.parametrize('direction', ['ASC', 'DESC'])
+def test_order_by_breaks_ties_by_ascending_id(db, direction):
+    rows = db['tweets'].db_select()
+    sign = -1 if direction == 'DESC' else 1
+    expected = sorted(rows, key=lambda r: (sign * r['likes'], r['id']))
+    assert db.run_query(f"SELECT FROM tweets ORDER BY likes {direction};") == expected
+    assert db.run_query(f"SELECT FROM tweets WHERE user_id == 2 ORDER BY likes {direction};",
+                        select_limit=5) == [r for r in expected if r['user_id'] == 2][:5]
+
+
+def test_arrays_follow_changes_made_elsewhere(db):
+    query = "SELECT SUM(likes) FROM tweets;"
+    total = db.run_query(query)[0]['SUM(likes)']
+    other = Database('twitter', 'schema.txt')  # another process, as far as db knows
+    other.run_query("UPDATE tweets SET likes = likes + 10 WHERE id == 1;")
+    assert db.run_query(query)[0]['SUM(likes)'] == total + 10
@@ -0,0 +1,122 @@
+import os
+import threading
+
+import pytest
+
+from database import CompressedTable, Database
+
+
+@pytest.fixture
+def rows(workdir):
+    db = Database('twitter', 'schema.txt')
+    tweets = db['tweets']
+    with tweets.get_writer() as writer:
+        for i in range(1, 3001):
+            writer.writerow([i, 1, 'x', f'word{i % 7} hello {i} ' + 'lorem ipsum ' * 10,
+                             '2024-01-01 00:00:00', 0, '', i % 5])
+    tweets._changed()
+    rows = tweets.db_select()
+    db.close()
+    return rows
+
+
+def open_tweets(schema, codec='zlib'):
+    return Database('twitter', schema(f'tweets PARTITION BY id 1000 COMPRESS {codec}'))
+
+
+def cold(db):
+    return db['tweets'].segments['000000']
+
+
+@pytest.mark.parametrize('codec', ['zlib', 'lzma'])
+def test_sealed_segments_read_back(rows, schema, codec):
+    db = open_tweets(schema, codec)
+    kinds = [type(s).__name__ for s in db['tweets'].segments.values()]
+    assert kinds == ['CompressedTable', 'CompressedTable', 'Table']
+    assert db['tweets'].db_select() == rows
+    assert db.run_query("SELECT FROM tweets;", select_limit=25, select_reverse=True,
+                        select_before=1500) == [r for r in rows[::-1] if r['id'] < 1500][:25]
+    stats = cold(db).stats()
+    assert stats['codec'] == codec and stats['blocks'] > 1
+    assert stats['stored_bytes'] < stats['raw_bytes'] / 3
+
+
+def test_reads_decompress_only_their_blocks(rows, schema, monkeypatch):
+    segment = cold(open_tweets(schema))
+    read = []
+    decompress = CompressedTable._decompress
+    monkeypatch.setattr(CompressedTable, '_decompress',
+                        lambda self, i: read.append(i) or decompress(self, i))
+    assert [segment._parse_values(r) for r in segment._rows_by_ids([57])] == [rows[56]]
+    assert len(read) == 1
+
+
+
+def test_blocks_are_read_through_one_handle(rows, schema):
+    segment = cold(open_tweets(schema))
+    assert segment._module.__name__ == 'zlib'
+    handles = set()
+    for i in range(len(segment._blocks)):
+        segment._decompress(i)
+        handles.add(id(segment._data_handle()[0]))
+    assert len(handles) == 1
+
+
+def test_threads_reading_other_blocks_get_their_own_rows(rows, schema):
+    segment = cold(open_tweets(schema))
+    ids = [b[0] for b in segment._blocks] * 20
+    wrong = []
+
+    def read(row_id):
+        row, = segment._rows_by_ids([row_id])
+        if int(row[0]) != row_id:
+            wrong.append(row_id)
+
+    threads = [threading.Thread(target=read, args=(i,)) for i in ids]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+    assert not wrong
+
+def test_changes_survive_reopening(rows, schema):
+    db = open_tweets(schema)
+    db.run_query("UPDATE tweets SET likes = likes + 1 WHERE id == 57;")
+    assert cold(db).garbage > 0
+    db.run_query("UPDATE tweets SET text = 'longer text now' WHERE likes == 3;")
+    db.run_query("DELETE FROM tweets WHERE likes == 4;")
+    expected = db['tweets'].db_select()
+    db.close()
+
+    assert open_tweets(schema, 'lzma')['tweets'].db_select() == expected
+    assert Database('twitter', 'schema.txt')['tweets'].db_select() == expected
+
+
+@pytest.mark.parametrize('crash_in', ['_write_block', 'fsync'])
+def test_crashed_rewrite_keeps_the_old_footer(rows, schema, monkeypatch, crash_in):
+    db = open_tweets(schema)
+    size = os.path.getsize(cold(db)._file)
+
+    class Crash(Exception):
+        pass
+
+    def crash(*args, **kwargs):
+        raise Crash
+    with monkeypatch.context() as patch:
+        if crash_in == 'fsync':
+            patch.setattr(os, 'fsync', crash)  # blocks and footer written, not pointed at
+        else:
+            patch.setattr(CompressedTable, '_write_block', crash)
+        with pytest.raises(Crash):
+            db.run_query("UPDATE tweets SET text = 'lost' WHERE id == 57;")
+    if crash_in == 'fsync':
+        assert os.path.getsize(cold(db)._file) > size
+
+    db = open_tweets(schema)
+    assert db['tweets'].db_select() == rows
+    db.run_query("UPDATE tweets SET text = 'kept' WHERE id == 58;")
+    db.close()
+
+    db = open_tweets(schema)
+    assert [r['text'] for r in db['tweets'].db_select() if r['id'] in (57, 58)] == \
+        [rows[56]['text'], 'kept']
@@ -0,0 +1,98 @@
+import os
+
+import pytest
+
+from conftest import add_tweets
+from database import Database, FullTextIndex, Table
+
+
+def texts(i):
+    return f'tweet {i} #tag{i % 7} Hello World' if i % 3 else f'other {i}'
+
+
+def search(db, query, **kwargs):
+    return [r['id'] for r in db.run_query(
+        f"SELECT FROM tweets WHERE text CONTAINS '{query}';", **kwargs)]
+
+
+@pytest.fixture
+def db(workdir):
+    db = Database('twitter', 'schema.txt')
+    add_tweets(db, 100, text=texts)
+    return db
+
+
+def expected(query_tokens, rows=range(100)):
+    return [i + 1 for i in rows if query_tokens <= set(texts(i).lower().split())]
+
+
+def test_contains_and_match_use_all_tokens(db):
+    assert search(db, 'hello') == expected({'hello'})
+    assert search(db, '#tag3 HELLO') == expected({'#tag3', 'hello'})
+    assert search(db, 'tag3') == search(db, '#tag3')  # hashtags match both ways
+    assert search(db, 'nothing') == []
+    ids = [r['id'] for r in db.run_query("SELECT FROM tweets WHERE text MATCH 'other';")]
+    assert ids == expected({'other'})
+
+
+def test_limit_reverse_and_other_terms(db):
+    newest = search(db, 'tag3 hello', select_limit=3, select_reverse=True)
+    assert newest == expected({'#tag3', 'hello'})[::-1][:3]
+    ids = [r['id'] for r in db.run_query(
+        "SELECT FROM tweets WHERE text CONTAINS 'other' AND id > 50;")]
+    assert ids == [i for i in expected({'other'}) if i > 50]
+    ids = [r['id'] for r in db.run_query(
+        "SELECT FROM tweets WHERE text CONTAINS 'other' OR id == 2;")]
+    assert ids == sorted(set(expected({'other'})) | {2})
+
+
+def test_selective_search_does_not_scan_the_table(db, monkeypatch):
+    monkeypatch.setattr(Table, '_search', lambda *args, **kwargs: pytest.fail('scanned'))
+    assert search(db, 'tweet 41') == [42]
+    assert search(db, '#tag3 other') == expected({'#tag3', 'other'})
+
+
+def test_index_follows_writes(db):
+    first = expected({'hello'})[0]
+    db.run_query(f"DELETE FROM tweets WHERE id == {first};")
+    db.run_query("UPDATE tweets SET text = 'now totally different' WHERE id == 5;")
+    new_id = db.run_query("INSERT INTO tweets VALUES (1, 'x', 'totally new', '', 0, '', 0);")[0]
+    assert first not in search(db, 'hello') and 5 not in search(db, 'hello')
+    assert search(db, 'totally') == [5, new_id]
+
+
+def test_index_is_loaded_not_rebuilt_on_reopen(db, monkeypatch):
+    db.run_query("UPDATE tweets SET text = 'changed' WHERE id == 2;")
+    db.close()
+    monkeypatch.setattr(FullTextIndex, 'rebuild',
+                        lambda self: pytest.fail('rebuilt a fresh index'))
+    db = Database('twitter', 'schema.txt')
+    assert search(db, 'changed') == [2]
+    db.run_query("UPDATE tweets SET likes = likes + 1 WHERE id == 2;")
+    assert not db['tweets'].indexes['text']._is_stale()
+
+
+def test_stale_index_is_rebuilt(db):
+    index_file = db['tweets'].indexes['text']._file
+    db.close()
+    index_file.write_text('FTS1\n')  # lost every posting, and older than the data
+    os.utime(index_file, ns=(0, 0))
+    db = Database('twitter', 'schema.txt')
+    assert search(db, 'hello') == expected({'hello'})
+
+
+def test_unknown_column(db):
+    with pytest.raises(ValueError):
+        db.run_query("SELECT FROM tweets WHERE nope CONTAINS 'x';")
+
+
+def test_changes_of_other_processes_reach_a_loaded_index(db):
+    assert search(db, 'zebra') == []
+    other = Database('twitter', 'schema.txt')
+    new = other.run_query("INSERT INTO tweets VALUES (1, 'x', 'a zebra', '', 0, '', 0);")[0]
+    assert search(db, 'zebra', select_limit=5) == [new]
+
+    other['tweets'].indexes['text'].rebuild()  # written again as a snapshot
+    other.run_query(f"DELETE FROM tweets WHERE id == {new};")
+    assert search(db, 'zebra', select_limit=5) == []
+    assert db['tweets'].indexes['user_id'].search('1') == list(range(1, 101))
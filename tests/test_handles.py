@@ -0,0 +1,60 @@
+import os
+
+from conftest import add_tweets
+from database import Database
+
+
+def open_fds(path):
+    """Descriptors of this process open on path."""
+    fds = []
+    for fd in os.listdir('/proc/self/fd'):
+        try:
+            if os.readlink(f'/proc/self/fd/{fd}') == str(path):
+                fds.append(fd)
+        except OSError:
+            pass
+    return fds
+
+
+def test_reads_and_appends_reuse_their_handles(workdir):
+    db = Database('twitter', 'schema.txt')
+    table = db['tweets']
+    add_tweets(db, 5)
+    table.db_select()
+    handle, append = table._handle[0], table._append[0]
+    add_tweets(db, 5)
+    assert len(table.db_select()) == 10
+    assert table._handle[0] is handle and table._append[0] is append
+    assert len(open_fds(table._file)) == 2
+
+
+def test_handles_follow_a_replaced_file(workdir):
+    db = Database('twitter', 'schema.txt')
+    table = db['tweets']
+    add_tweets(db, 5)
+    table.db_select()
+    handle, append = table._handle[0], table._append[0]
+
+    # another process writes a new version and renames it over the file
+    copy = workdir / 'copy.txt'
+    copy.write_text(table._file.read_text().replace('"hello"', '"from the copy"'))
+    os.replace(copy, table._file)
+
+    assert {row['text'] for row in table.db_select()} == {'from the copy'}
+    assert table._handle[0] is not handle
+    add_tweets(db, 1)
+    assert table._append[0] is not append
+    assert append.closed
+    assert [row['text'] for row in Database('twitter', 'schema.txt')['tweets'].db_select()] \
+        == ['from the copy'] * 5 + ['hello']
+
+
+def test_close_releases_the_descriptors(workdir):
+    db = Database('twitter', 'schema.txt')
+    table = db['tweets']
+    add_tweets(db, 5)
+    table.db_select()
+    assert open_fds(table._file)
+    db.close()
+    assert open_fds(table._file) == []
+    assert len(table.db_select()) == 5  # opened again when used
@@ -0,0 +1,79 @@
+import csv
+
+import pytest
+
+from database import Database
+
+
+@pytest.fixture
+def db(workdir):
+    db = Database('twitter', 'schema.txt', parallel_scan_threshold=None)
+    likes = db['tweet_likes']
+    with likes.get_writer() as writer:
+        for i in range(1, 150001):  # a few MB, several scan ranges
+            writer.writerow([i, i % 1000, i % 37])
+    likes._flush_appends()
+    likes.last_id = None
+    return db
+
+
+def both_ways(db, query, **kwargs):
+    likes = db['tweet_likes']
+    likes.parallel_scan_threshold = None
+    serial = db.run_query(query, **kwargs)
+    likes.parallel_scan_threshold = 1
+    assert likes._use_parallel_scan()
+    parallel = db.run_query(query, **kwargs)
+    likes.parallel_scan_threshold = None
+    return serial, parallel
+
+
+def test_scan_ranges_cover_the_file_on_row_boundaries(db):
+    likes = db['tweet_likes']
+    ranges = likes._scan_ranges(chunk_size=100000)
+    assert len(ranges) > 10
+    data = likes._file.read_bytes()
+    assert ranges[0][0] == data.index(b'\n') + 1  # after the header
+    assert ranges[-1][1] == len(data)
+    for (_, stop), (start, _) in zip(ranges, ranges[1:]):
+        assert stop == start and data[stop - 1:stop] == b'\n'
+
+
+@pytest.mark.parametrize('kwargs', [
+    {},
+    {'select_limit': 5},
+    {'select_limit': 5, 'select_reverse': True},
+    {'select_reverse': True, 'select_before': 100000},
+])
+@pytest.mark.parametrize('query', [
+    "SELECT FROM tweet_likes WHERE user_id == 5;",
+    "SELECT FROM tweet_likes WHERE tweet_id == 7 OR user_id == 3;",
+])
+def test_parallel_scan_gives_the_serial_results(db, query, kwargs):
+    serial, parallel = both_ways(db, query, **kwargs)
+    assert serial and parallel == serial
+
+
+def test_writes_through_a_parallel_scan(db):
+    db['tweet_likes'].parallel_scan_threshold = 1
+    db.run_query("UPDATE tweet_likes SET user_id = 99 WHERE tweet_id == 999;")
+    db.run_query("DELETE FROM tweet_likes WHERE user_id == 0;")
+    db['tweet_likes'].parallel_scan_threshold = None
+
+    with open(db['tweet_likes']._file, newline='') as f:
+        rows = list(csv.reader(f, delimiter=' '))[1:]
+    kept = [i for i in range(1, 150001) if i % 37 or i % 1000 == 999]
+    assert [int(row[0]) for row in rows] == kept
+    assert all(row[2] != '0' for row in rows)
+    assert all(row[2] == '99' for row in rows if row[1] == '999')
+
+
+def test_threshold_switches_it_on(workdir):
+    db = Database('twitter', 'schema.txt', parallel_scan_threshold=1 << 20)
+    likes = db['tweet_likes']
+    assert not likes._use_parallel_scan()
+    with likes.get_writer() as writer:
+        for i in range(1, 60001):
+            writer.writerow([i, i, i])
+    likes._flush_appends()
+    assert likes._use_parallel_scan()
@@ -0,0 +1,82 @@
+import pytest
+
+from database import (Aggregate, Control, Delete, Explain, Insert, Select, Update,
+                      UpdateSet, lex_sql, parse_sql)
+
+
+def parse_one(query):
+    statements = parse_sql(query)
+    assert len(statements) == 1
+    return statements[0]
+
+
+def test_select():
+    assert parse_one("SELECT FROM tweets;") == Select('tweets', None, 'SELECT FROM tweets')
+    select = parse_one("select from tweets where likes >= 10 order by likes desc;")
+    assert select.where == ['likes', '>=', '10']
+    assert select.order_by == ('likes', True)
+    assert parse_one("SELECT COUNT(*) FROM tweets GROUP BY user_id;") == \
+        Aggregate('tweets', 'COUNT', None, None, 'user_id')
+    assert parse_one("SELECT MAX(likes) FROM tweets WHERE user_id == 1;") == \
+        Aggregate('tweets', 'MAX', 'likes', ['user_id', '==', '1'], None)
+
+
+def test_insert_keeps_strings_as_written():
+    insert = parse_one("INSERT INTO tweets VALUES (1, 'it\\'s a -- b', 'two  spaces', -5);")
+    assert insert == Insert('tweets', ['1', "it\\'s a -- b", 'two  spaces', '-5'])
+    assert parse_one("INSERT INTO t VALUES ('x''y');").values == ["x''y"]
+
+
+def test_updates():
+    update = parse_one("UPDATE tweets SET likes = likes + 1, text = 'z' WHERE id == 3;")
+    assert update == UpdateSet('tweets', {'likes': ('add', 'likes', '+1'),
+                                          'text': ('value', 'z')}, ['id', '==', '3'])
+    assert parse_one("UPDATE tweets SET likes = likes -2;").assignments == \
+        {'likes': ('add', 'likes', '-2')}
+    assert parse_one("UPDATE t WHERE id == 3 VALUES (1, 'a');") == \
+        Update('t', ['id', '==', '3'], ['1', 'a'])
+
+
+def test_delete_and_control():
+    assert parse_one("DELETE FROM t WHERE id == 1;") == Delete('t', ['id', '==', '1'])
+    assert parse_one("DELETE FROM t;") == Delete('t', None)
+    assert parse_sql("BEGIN; START TRANSACTION; COMMIT; ROLLBACK;") == [
+        Control('BEGIN'), Control('BEGIN'), Control('COMMIT'), Control('ROLLBACK')]
+    assert isinstance(parse_one("EXPLAIN SELECT FROM t;"), Explain)
+
+
+def test_nested_where():
+    select = parse_one("SELECT FROM t WHERE a == 1 AND (b == 'x y' OR (c CONTAINS 'hi'"
+                       " AND d != 2)) OR e < -2;")
+    assert select.where == ['a', '==', '1', 'AND', '(', 'b', '==', "'x y'", 'OR',
+                            '(', 'c', 'CONTAINS', "'hi'", 'AND', 'd', '!=', '2', ')', ')',
+                            'OR', 'e', '<', '-2']
+
+
+def test_comments_and_several_statements():
+    assert lex_sql("id -- the key; 'not a string\n== 1") == [
+        ('name', 'id'), ('op', '=='), ('number', '1')]
+    statements = parse_sql("-- first\nDELETE FROM t; -- second\nSELECT FROM t WHERE\n"
+                           "text == '-- kept';;")
+    assert statements == [Delete('t', None),
+                          Select('t', ['text', '==', "'-- kept'"],
+                                 "SELECT FROM t WHERE text == '-- kept'")]
+
+
+@pytest.mark.parametrize('query, message', [
+    ("SELECT FROM t WHERE a == 'open;", 'Error in query syntax'),  # unterminated string
+    ("SELECT FROM t", 'Query should be ended with ;'),
+    ("SELECT FROM t WHERE a == 1 DELETE FROM t;", 'Error in query syntax'),
+    ("SELECT FROM t WHERE a ~ 1;", 'Error in query syntax'),  # bad token
+    ("DROP TABLE t;", 'Error in query syntax'),
+    ("INSERT INTO t VALUES (1 2);", 'Error in query syntax'),
+    ("UPDATE t SET a = b + -1;", 'Error in query syntax'),
+    ("UPDATE t WHERE id == 1;", 'Error in query syntax'),
+    ("SELECT FROM t WHERE (a == 1;", 'Error in where clause syntax'),
+    ("SELECT FROM t WHERE a == 1 AND;", 'Error in where clause syntax'),
+    ("SELECT FROM t WHERE text CONTAINS 5;", 'Error in where clause syntax'),
+    ("EXPLAIN DELETE FROM t;", 'Only selects can be explained'),
+])
+def test_errors(query, message):
+    with pytest.raises(ValueError, match=message):
+        parse_sql(query)
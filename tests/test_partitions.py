@@ -0,0 +1,85 @@
+import os
+
+import pytest
+
+from conftest import add_tweets
+from database import Database, PartitionedTable
+
+
+def posted(i):
+    return f'2024-{i // 100 + 1:02}-01 12:00:00'
+
+
+@pytest.fixture
+def rows(workdir):
+    """Rows of 250 tweets over three months, written unpartitioned."""
+    db = Database('twitter', 'schema.txt')
+    add_tweets(db, 250, text=lambda i: f'word{i % 7} hello {i}', posted_at=posted,
+               likes=lambda i: i % 5)
+    rows = db['tweets'].db_select()
+    db.close()
+    return rows
+
+
+def test_id_segments_and_manifest(rows, schema):
+    db = Database('twitter', schema('tweets PARTITION BY id 100'))
+    tweets = db['tweets']
+    assert isinstance(tweets, PartitionedTable)
+    assert len(tweets.segments) == 3
+    assert (db._data_dir / 'tweets.manifest').exists()
+    assert not (db._data_dir / 'tweets.txt').exists()
+    assert tweets.db_select() == rows
+    assert tweets.db_select(limit=30, reverse=True) == rows[::-1][:30]
+    assert db.run_query("SELECT FROM tweets;", select_limit=25, select_reverse=True,
+                        select_before=150) == [r for r in rows[::-1] if r['id'] < 150][:25]
+    assert db.run_query("SELECT FROM tweets WHERE text CONTAINS 'word3';") == \
+        [r for r in rows if 'word3' in r['text']]
+
+
+def test_reads_prune_segments(rows, schema):
+    tweets = Database('twitter', schema('tweets PARTITION BY id 100'))['tweets']
+    assert len(tweets._prune(['id', '==', '57'])) == 1
+    assert len(tweets._prune(['id', '==', '57', 'OR', 'id', '==', '220'])) == 2
+    assert len(tweets._prune(['likes', '==', '1'])) == 3
+    assert len(tweets._prune(before=150)) == 2
+
+
+def test_writes_rewrite_only_their_segment(rows, schema):
+    db = Database('twitter', schema('tweets PARTITION BY id 100'))
+    tweets = db['tweets']
+    files = {key: segment._file for key, segment in tweets.segments.items()}
+    first, *others = files
+    before = {key: os.stat(files[key]).st_mtime_ns for key in others}
+
+    db.run_query("UPDATE tweets SET text = 'a longer text now' WHERE id == 57;")
+    db.run_query("DELETE FROM tweets WHERE id == 58;")
+    assert {key: os.stat(files[key]).st_mtime_ns for key in others} == before
+
+    after = tweets.db_select()
+    assert [r['id'] for r in after] == [r['id'] for r in rows if r['id'] != 58]
+    assert [r['text'] for r in after if r['id'] == 57] == ['a longer text now']
+    new_id = add_tweets(db, 1)[0]
+    assert new_id == rows[-1]['id'] + 1
+    assert len(tweets.segments) == 3
+
+
+def test_month_segments(rows, schema):
+    db = Database('twitter', schema('tweets PARTITION BY posted_at MONTH'))
+    tweets = db['tweets']
+    assert len(tweets.segments) == 3
+    assert tweets.db_select() == rows
+    db.run_query("UPDATE tweets SET likes = likes + 1 WHERE id == 150;")
+    assert db.run_query("SELECT FROM tweets WHERE id == 150;")[0]['likes'] == rows[149]['likes'] + 1
+
+
+def test_repartition_and_merge_back_keep_rows(rows, schema):
+    Database('twitter', schema('tweets PARTITION BY id 100'))['tweets'].close()
+    tweets = Database('twitter', schema('tweets PARTITION BY id 40'))['tweets']
+    assert len(tweets.segments) == 7
+    assert tweets.db_select() == rows
+    tweets.close()
+
+    tweets = Database('twitter', 'schema.txt')['tweets']
+    assert not isinstance(tweets, PartitionedTable)
+    assert not (tweets._data_dir / 'tweets.manifest').exists()
+    assert tweets.db_select() == rows
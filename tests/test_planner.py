@@ -0,0 +1,60 @@
+import pytest
+
+from conftest import add_tweets
+from database import Database, condition_tree, flatten_condition, parse_sql
+
+QUERIES = [
+    "SELECT FROM tweets WHERE likes == 0 AND user_id == 3;",
+    "SELECT FROM tweets WHERE user_id == 3 OR (likes == 50 AND user_id < 5);",
+    "SELECT FROM tweets WHERE id == 3 OR id == 599 OR id == 99999;",
+    "SELECT FROM tweets WHERE text CONTAINS 'rare' AND likes == 0;",
+    "SELECT FROM tweets WHERE id == 5 AND user_id == 999;",
+]
+
+
+@pytest.fixture
+def db(workdir):
+    db = Database('twitter', 'schema.txt')
+    add_tweets(db, 600, user_id=lambda i: i % 20 + 1,
+               text=lambda i: f'hello {i} ' + ('rare' if i % 100 == 0 else 'common'),
+               likes=lambda i: (0, 0, 0, 0, 1, 2, 50)[i % 7])
+    return db
+
+
+def explain(db, query, **options):
+    return db.run_query('EXPLAIN ' + query, **{f'select_{k}': v for k, v in options.items()})[0]
+
+
+def test_condition_tree_flattens_nested_groups():
+    where = parse_sql("SELECT FROM t WHERE a == 1 and (b == 2 or (c == 3 or d == 4));")[0].where
+    tree = condition_tree(where)
+    assert tree == ('AND', [('a', '==', '1'),
+                            ('OR', [('b', '==', '2'), ('c', '==', '3'), ('d', '==', '4')])])
+    assert condition_tree(flatten_condition(tree)) == tree
+
+
+def test_paths(db):
+    assert explain(db, "SELECT FROM tweets WHERE id == 3;")['path'] == 'ids'
+    assert explain(db, "SELECT FROM tweets WHERE text CONTAINS 'rare';")['path'] == 'index'
+    assert explain(db, "SELECT FROM tweets WHERE likes < 2;")['path'] == 'full'
+
+
+def test_cheap_and_selective_terms_run_first(db):
+    db.run_query("ANALYZE tweets;")
+    plan = explain(db, "SELECT FROM tweets WHERE text CONTAINS 'common' AND likes == 50;")
+    assert plan['where'] == "likes == 50 AND text CONTAINS 'common'"
+
+
+@pytest.mark.parametrize('query', QUERIES)
+@pytest.mark.parametrize('options', [{}, {'limit': 2, 'reverse': True},
+                                     {'limit': 2, 'reverse': True, 'before': 500}])
+def test_planned_selects_match_plain_scans(db, query, options):
+    db.run_query("ANALYZE tweets;")
+    statement = parse_sql(query)[0]
+    assert db.run_query(query, **{f'select_{k}': v for k, v in options.items()}) \
+        == db['tweets'].db_select(statement.where, **options)
+
+
+def test_statistics_survive_reopening(db):
+    db.run_query("ANALYZE tweets;")
+    assert 'tweets' in Database('twitter', 'schema.txt').planner.statistics
@@ -0,0 +1,71 @@
+import threading
+
+from conftest import add_tweets, logged_in, page_ids
+from database import Database, Table
+
+
+def test_value_index_pages_newest_first(workdir):
+    db = Database('twitter', 'schema.txt')
+    ids = add_tweets(db, 30, user_id=lambda i: i % 3 + 1)
+    index = db['tweets'].indexes['user_id']
+    mine = [row_id for row_id in ids if row_id % 3 == 1]  # user 1
+
+    assert index.page('1', 4) == mine[:4]
+    assert index.page('1', 4, reverse=True) == mine[-4:]
+    assert index.page('1', 4, reverse=True, before=mine[-4]) == mine[-8:-4]
+    assert index.page('1', 4, reverse=True, before=mine[1]) == mine[:1]
+    assert index.page('9', 4, reverse=True) == []
+    assert index.count('1') == len(mine)
+
+
+def test_deletes_find_rows_by_id_and_index(workdir, monkeypatch):
+    db = Database('twitter', 'schema.txt')
+    add_tweets(db, 10, user_id=lambda i: i % 2 + 1)
+
+    def scan(*args, **kwargs):
+        raise AssertionError('scanned the table')
+    with monkeypatch.context() as patch:
+        patch.setattr(Table, 'get_reader', scan)
+        db.run_query("DELETE FROM tweets WHERE id == 3 AND user_id == 1;")
+        db.run_query("DELETE FROM tweets WHERE user_id == 2 AND likes == 0;")
+    assert db['tweets'].indexes['user_id'].search('1') == [1, 5, 7, 9]
+    assert db['tweets'].indexes['user_id'].search('2') == []
+    assert [r['id'] for r in db['tweets'].db_select()] == [1, 5, 7, 9]
+
+
+def test_profile_pages(twitter):
+    client = logged_in(twitter.app, 'alice')
+    logged_in(twitter.app, 'bob').post('/tweet', data={'text': 'not alice'})
+    alice = twitter.curd.get_user_by_username('alice')['id']
+    ids = [twitter.curd.add_tweet(alice, f'tweet {i}') for i in range(25)]
+
+    first = client.get('/u/alice')
+    assert page_ids(first) == ids[::-1][:20]
+    older = client.get(f'/u/alice?before={ids[5]}')
+    assert page_ids(older) == ids[4::-1]
+    assert client.get('/u/nobody').status_code == 404
+
+    client.get(f'/delete_tweet/{ids[-1]}')
+    assert page_ids(client.get('/u/alice')) == ids[-2::-1][:20]
+
+
+def test_replica_page_takes_the_likes_from_the_replica(twitter, monkeypatch):
+    curd = twitter.CURD('twitter', 'schema.txt', replicas=['replica'],
+                        max_replica_lag=3600)
+    replica = curd.replicas[0]
+    replica._closed.set()  # catches up only when told to
+    for thread in threading.enumerate():
+        if thread.name == 'replica-replica':
+            thread.join(5)
+    monkeypatch.setattr(twitter, 'curd', curd)
+    client = logged_in(twitter.app, 'alice')
+    tweet = curd.add_tweet(1, 'hello')
+    replica.catch_up()
+
+    curd.switch_like_tweet(1, tweet)  # not on the replica yet
+    page = client.get('/u/alice')
+    assert replica.change_tag('users', 'tweets', 'tweet_likes') in page.headers['ETag']
+    assert 'unlike' not in page.get_data(as_text=True)
+
+    replica.catch_up()
+    assert 'unlike' in client.get('/u/alice').get_data(as_text=True)
@@ -0,0 +1,51 @@
+import pytest
+
+from database import Database, Table
+
+
+@pytest.fixture
+def curd(twitter):
+    curd = twitter.curd
+    for name in ('alice', 'bob'):
+        curd.add_user(name, 'secret')
+    for i in range(30):
+        curd.add_tweet(1 + i % 2, f'tweet {i}')
+    return curd
+
+
+def no_reads(monkeypatch, curd):
+    def read(*args, **kwargs):
+        raise AssertionError('read the database')
+    monkeypatch.setattr(curd, '_load_tweets', read)
+    monkeypatch.setattr(Table, 'stamp', read)
+    monkeypatch.setattr(Table, 'get_reader', read)
+
+
+def test_own_writes_keep_the_read_models(curd, monkeypatch):
+    curd.get_tweets()
+    assert curd.get_user_likes(1) == curd.get_user_likes(2) == frozenset()
+    new = curd.add_tweet(1, 'new one')
+    liked = curd.get_tweets()[3]['id']
+    curd.switch_like_tweet(1, liked)
+    curd.delete_tweet(1, curd.get_tweets()[2]['id'])
+
+    with monkeypatch.context() as patch:
+        no_reads(patch, curd)
+        tweets = curd.get_tweets()
+        assert curd.get_user_likes(1) == {liked}
+        assert curd.get_user_likes(2) == frozenset()  # still cached after alice's like
+    assert tweets == curd._load_tweets(curd.timeline_size)
+    assert tweets[0]['id'] == new
+    assert [t['likes'] for t in tweets if t['id'] == liked] == [1]
+
+
+def test_writes_of_other_processes_are_seen(curd):
+    curd.get_tweets()
+    curd.get_user_likes(1)
+    other = Database('twitter', 'schema.txt')
+    new = other.run_query("INSERT INTO tweets VALUES (2, 'bob', 'elsewhere', '', 0, '', 0);")[0]
+    other.run_query(f"INSERT INTO tweet_likes VALUES ({new}, 1);")
+
+    curd.stamp_ttl = 0
+    assert curd.get_tweets()[0]['id'] == new
+    assert curd.get_user_likes(1) == {new}
@@ -0,0 +1,88 @@
+import os
+import time
+
+import pytest
+
+from conftest import add_tweets
+from database import Database
+
+
+def log_size():
+    return os.path.getsize('twitter_data/replication.log')
+
+
+def test_replica_applies_the_primarys_changes(workdir):
+    primary = Database('twitter', 'schema.txt', replication_log=True)
+    add_tweets(primary, 30)
+    replica = Database('replica', 'schema.txt', replica_of=primary)
+    assert replica['tweets'].db_select() == primary['tweets'].db_select()
+
+    add_tweets(primary, 5)
+    primary.run_query("UPDATE tweets SET likes = likes + 1 WHERE id == 3;")
+    primary.run_query("DELETE FROM tweets WHERE id == 4;")
+    assert replica.catch_up() == 7
+    assert replica['tweets'].db_select() == primary['tweets'].db_select()
+    with pytest.raises(ValueError):
+        replica.run_query("DELETE FROM tweets WHERE id == 1;")
+
+
+def test_checkpoint_drops_what_the_replicas_applied(workdir):
+    primary = Database('twitter', 'schema.txt', replication_log=True)
+    add_tweets(primary, 10)
+    replica = Database('replica', 'schema.txt', replica_of=primary)
+    add_tweets(primary, 3)
+    primary.checkpoint()
+    assert log_size() > 0  # the replica still needs them
+
+    assert replica.catch_up() == 3
+    primary.checkpoint()
+    assert log_size() == 0
+    add_tweets(primary, 2)
+    assert replica.catch_up() == 2
+    assert replica['tweets'].db_select() == primary['tweets'].db_select()
+
+    lsn = primary.replication_log.lsn
+    primary.close()
+    assert Database('twitter', 'schema.txt', replication_log=True).replication_log.lsn == lsn
+
+
+def test_replica_behind_a_checkpoint_has_to_be_copied_again(workdir):
+    primary = Database('twitter', 'schema.txt', replication_log=True)
+    replica = Database('replica', 'schema.txt', replica_of=primary)
+    add_tweets(primary, 3)
+    primary.checkpoint(upto=primary.replication_log.lsn)
+    add_tweets(primary, 1)
+    with pytest.raises(ValueError, match='copy the replica again'):
+        replica.catch_up()
+
+
+def test_logged_change_missing_from_the_files_is_applied_on_start(workdir):
+    primary = Database('twitter', 'schema.txt', replication_log=True)
+    add_tweets(primary, 3)
+    primary.checkpoint()
+    # a crash right after the log entry was written
+    primary.replication_log.append('tweets', 'insert', [
+        ['4', '1', 'x', 'logged', '2024-01-01 00:00:00', '0', '', '0']])
+    primary.run_query("UPDATE tweets SET likes = 5 WHERE id == 2;")  # applied twice
+
+    primary = Database('twitter', 'schema.txt', replication_log=True)
+    rows = primary['tweets'].db_select()
+    assert [row['text'] for row in rows] == ['hello'] * 3 + ['logged']
+    assert rows[1]['likes'] == 5
+
+
+def test_app_checkpoints_as_the_log_grows(twitter, monkeypatch):
+    curd = twitter.CURD('twitter', 'schema.txt', replicas=['replica'])
+    monkeypatch.setattr(curd, 'checkpoint_bytes', 2000)
+    user_id = curd.add_user('ann', 'secret')
+    for i in range(20):
+        curd.add_tweet(user_id, f'tweet {i}')
+        deadline = time.monotonic() + 5
+        while curd.replicas[0].replica_lsn < curd.db.replication_log.lsn \
+                and time.monotonic() < deadline:
+            time.sleep(0.01)
+    assert curd.db.replication_log.checkpoint_lsn() > 0
+    assert log_size() < 3000  # the applied entries were dropped
+    assert curd.replicas[0]['tweets'].db_select() == curd.db['tweets'].db_select()
+    curd.db.close()
+    curd.replicas[0].close()
@@ -0,0 +1,50 @@
+from conftest import add_tweets
+from database import Database, ResultCache
+
+
+def cached_db(workdir):
+    db = Database('twitter', 'schema.txt', result_cache_bytes=1024 * 1024)
+    add_tweets(db, 20, user_id=lambda i: i % 2 + 1)
+    db.run_query("INSERT INTO users VALUES ('alice', 'secret', '');")
+    return db
+
+
+def test_repeated_select_is_a_hit(workdir):
+    db = cached_db(workdir)
+    query = "SELECT FROM tweets WHERE user_id == 1;"
+    first = db.run_query(query)
+    first[0]['text'] = 'changed by the caller'
+    assert db.run_query(query)[0]['text'] == 'hello'  # callers get copies
+    assert (db.result_cache.hits, db.result_cache.misses) == (1, 1)
+
+
+def test_write_to_the_table_invalidates(workdir):
+    db = cached_db(workdir)
+    query = "SELECT FROM tweets WHERE user_id == 1;"
+    db.run_query(query)
+    db.run_query("UPDATE tweets SET likes = 7 WHERE id == 1;")
+    assert db.run_query(query)[0]['likes'] == 7
+    assert db.result_cache.hits == 0
+
+    other = Database('twitter', 'schema.txt')  # a write of another process
+    other.run_query("DELETE FROM tweets WHERE id == 1;")
+    assert db.run_query(query)[0]['id'] == 3
+
+
+def test_write_to_another_table_keeps_the_entry(workdir):
+    db = cached_db(workdir)
+    query = "SELECT FROM tweets WHERE user_id == 1;"
+    db.run_query(query)
+    db.run_query("INSERT INTO users VALUES ('bob', 'secret', '');")
+    db.run_query(query)
+    assert db.result_cache.hits == 1
+
+
+def test_entries_are_bounded_by_size():
+    cache = ResultCache(2000)
+    rows = [{'id': 1, 'text': 'x' * 100}]
+    for key in range(20):
+        cache.put(key, 'stamp', rows)
+    assert cache.size <= 2000
+    assert cache.get(19, 'stamp') == rows and cache.get(0, 'stamp') is None
+    assert cache.get(19, 'newer') is None and cache.size < 2000
@@ -0,0 +1,24 @@
+import pytest
+
+from conftest import add_tweets
+from database import Database, Table
+
+
+def test_tables_open_when_first_used(workdir):
+    add_tweets(Database('twitter', 'schema.txt'), 3)
+    db = Database('twitter', 'schema.txt')
+    assert db._opened() == []
+    assert len(db['tweets'].db_select()) == 3
+    assert [table.table_name for table in db._opened()] == ['tweets']
+    assert (workdir / 'twitter_data' / '.schema.json').exists()
+
+
+def test_failed_open_can_be_retried(workdir, monkeypatch):
+    db = Database('twitter', 'schema.txt')
+    with monkeypatch.context() as patch:
+        def fail(*args, **kwargs):
+            raise OSError('no file handles left')
+        patch.setattr(Table, '_open', fail)
+        with pytest.raises(OSError):
+            db['tweets']
+    assert add_tweets(db, 1) == [1]
@@ -0,0 +1,177 @@
+import os
+import threading
+
+import pytest
+
+from conftest import add_tweets
+from database import Database, Transaction
+
+
+def likes_of(db, tweet_id):
+    return db.run_query(f"SELECT FROM tweets WHERE id == {tweet_id};")[0]['likes']
+
+
+def test_commit_is_seen_by_others_only_after_it(workdir):
+    db = Database('twitter', 'schema.txt')
+    add_tweets(db, 50)
+    db.run_query("BEGIN; UPDATE tweets SET likes = likes + 1 WHERE id == 3;"
+                 " INSERT INTO tweet_likes VALUES (3, 1);")
+    assert likes_of(db, 3) == 1  # the transaction reads its own writes
+
+    seen = []
+    reader = threading.Thread(target=lambda: seen.append(
+        (likes_of(db, 3), len(db.run_query("SELECT FROM tweet_likes;")))))
+    reader.start()
+    reader.join(5)
+    assert seen == [(0, 0)]
+
+    db.run_query("COMMIT;")
+    assert likes_of(db, 3) == 1
+    assert db.run_query("SELECT FROM tweet_likes WHERE tweet_id == 3;")[0]['user_id'] == 1
+
+
+def test_rollback_and_failed_statement_leave_no_trace(workdir):
+    db = Database('twitter', 'schema.txt')
+    add_tweets(db, 10)
+    db.run_query("BEGIN; INSERT INTO tweet_likes VALUES (4, 1); DELETE FROM tweets WHERE id == 4;")
+    assert not db.run_query("SELECT FROM tweets WHERE id == 4;")
+    db.run_query("ROLLBACK;")
+    assert db.run_query("SELECT FROM tweets WHERE id == 4;")
+
+    with pytest.raises(ValueError):
+        db.run_query("BEGIN; INSERT INTO tweet_likes VALUES (5, 1); SELECT FROM nope;")
+    assert db['tweet_likes'].db_select() == []
+
+
+def test_writes_do_not_copy_the_data_file(workdir):
+    db = Database('twitter', 'schema.txt')
+    add_tweets(db, 200)
+    before = sorted(os.listdir(db._data_dir))
+    inode = os.stat(db['tweets']._file).st_ino
+    with db.transaction():
+        db.run_query("UPDATE tweets SET likes = likes + 1 WHERE id == 7;")
+        new_id = db.run_query("INSERT INTO tweets VALUES (1, 'x', 'new', '', 0, '', 0);")[0]
+        assert sorted(os.listdir(db._data_dir)) == before
+    assert os.stat(db['tweets']._file).st_ino == inode  # patched in place
+    assert likes_of(db, 7) == 1
+
+    with db.transaction():
+        db.run_query("UPDATE tweets SET text = 'a longer text' WHERE id == 8;")
+    assert db.run_query("SELECT FROM tweets WHERE id == 8;")[0]['text'] == 'a longer text'
+    assert likes_of(db, 7) == 1
+    assert db.run_query("SELECT FROM tweets WHERE text CONTAINS 'new';")[0]['id'] == new_id
+    # ids continue after those taken in the transaction
+    assert add_tweets(db, 1) == [new_id + 1]
+
+
+
+def test_update_of_many_rows_writes_the_file_once(workdir, monkeypatch):
+    db = Database('twitter', 'schema.txt')
+    add_tweets(db, 20)
+    table, patches = db['tweets'], []
+    patch_lines = table._patch_lines
+    monkeypatch.setattr(table, '_patch_lines', lambda p: patches.append(p) or patch_lines(p))
+    ids = db.run_query("UPDATE tweets WHERE user_id == 1 AND id <= 5"
+                       " VALUES (1, 'x', 'edited', '', 0, '', 0);")
+    assert ids == [1, 2, 3, 4, 5]
+    assert [len(p) for p in patches] == [5]
+    assert [row['text'] for row in table.db_select()] == ['edited'] * 5 + ['hello'] * 15
+
+def test_like_in_partitioned_table(workdir, schema):
+    from twitter import CURD
+
+    curd = CURD('twitter', schema('tweets PARTITION BY id 20'))
+    user_id = curd.add_user('alice', 'secret')
+    tweet_ids = [curd.add_tweet(user_id, f'tweet {i}') for i in range(50)]
+    assert len(curd.db['tweets'].segments) > 1
+
+    curd.switch_like_tweet(user_id, tweet_ids[5])
+    curd.switch_like_tweet(user_id, tweet_ids[45])
+    assert curd.get_tweet(tweet_ids[5], primary=True)['likes'] == 1
+    assert curd.is_liker(user_id, tweet_ids[45])
+
+    curd.switch_like_tweet(user_id, tweet_ids[5])  # unlike
+    assert curd.get_tweet(tweet_ids[5], primary=True)['likes'] == 0
+    assert curd.get_tweet_likes_count(tweet_ids[45]) == 1
+    assert not curd.is_liker(user_id, tweet_ids[5])
+
+
+def test_concurrent_likes_count_once_each(workdir):
+    from twitter import CURD
+
+    curd = CURD('twitter', 'schema.txt')
+    users = [curd.add_user(f'user{i}', 'secret') for i in range(8)]
+    tweet_id = curd.add_tweet(users[0], 'popular')
+    threads = [threading.Thread(target=curd.switch_like_tweet, args=(u, tweet_id))
+               for u in users for _ in range(3)]  # like, unlike, like
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert curd.get_tweet(tweet_id, primary=True)['likes'] == len(users)
+    assert curd.get_tweet_likes_count(tweet_id) == len(users)
+
+
+def test_crashed_commit_is_finished_on_reopen(workdir):
+    db = Database('twitter', 'schema.txt')
+    add_tweets(db, 20)
+
+    class Crash(Exception):
+        pass
+
+    class CrashingTransaction(Transaction):
+        @staticmethod
+        def _apply(db, entries):
+            Transaction._apply(db, entries[:1])  # dies after the first change
+            raise Crash
+
+    db._tx.current = CrashingTransaction(db)
+    db.run_query("UPDATE tweets SET likes = likes + 1 WHERE id == 2;")
+    db.run_query("INSERT INTO tweet_likes VALUES (2, 1);")
+    db.run_query("DELETE FROM tweets WHERE id == 3;")
+    with pytest.raises(Crash):
+        db.commit()
+    assert likes_of(db, 2) == 1
+    assert db.run_query("SELECT FROM tweets WHERE id == 3;")
+    db.close()
+
+    db = Database('twitter', 'schema.txt')
+    assert not (db._data_dir / Transaction.journal_name).exists()
+    assert likes_of(db, 2) == 1  # applied once, not twice
+    assert not db.run_query("SELECT FROM tweets WHERE id == 3;")
+    assert len(db.run_query("SELECT FROM tweet_likes;")) == 1
+
+
+def test_deadlock_is_reported(workdir):
+    db = Database('twitter', 'schema.txt')
+    add_tweets(db, 5)
+    first_locked, second_locked = threading.Event(), threading.Event()
+    errors = []
+
+    def first():
+        with db.transaction() as tx:
+            tx.lock('tweets')
+            first_locked.set()
+            second_locked.wait(5)
+            db.run_query("INSERT INTO tweet_likes VALUES (1, 1);")  # waits for second
+
+    def second():
+        first_locked.wait(5)
+        try:
+            with db.transaction() as tx:
+                tx.lock('tweet_likes')
+                second_locked.set()
+                while not db._tx_waits:
+                    threading.Event().wait(0.01)
+                db.run_query("UPDATE tweets SET likes = 1 WHERE id == 1;")
+        except ValueError as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=first), threading.Thread(target=second)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+    assert not any(thread.is_alive() for thread in threads)
+    assert len(errors) == 1 and 'deadlock' in str(errors[0])
+    assert len(db.run_query("SELECT FROM tweet_likes;")) == 1
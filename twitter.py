@@ -1,27 +1,117 @@
-from flask import Flask, render_template, redirect, url_for, request, flash
+from flask import Flask, render_template, redirect, url_for, request, flash, \
+    make_response
 from flask_login import LoginManager, login_required, logout_user, \
     current_user, login_user
 from werkzeug.exceptions import NotFound, BadRequest
 from database import Database
 from datetime import datetime
+from itertools import cycle
+from collections import OrderedDict
+from threading import Lock, RLock
+import time
 
 
 db_name = "twitter"
 db_schema_file = "schema.txt"
 flask_secret_key = "SUPERSUPERSECRET"
+db_result_cache_bytes = 16 * 1024 * 1024
+db_replicas = []  # names of local read replicas, e.g. ['twitter_replica1']
+db_max_replica_lag = 1.0  # seconds
 
 
 class CURD(object):
-    def __init__(self, db_name, schema_file):
-        self.db = Database(db_name, schema_file)
+    timeline_size = 20
+    likes_cache_users = 10000
+    stamp_ttl = 1.0  # seconds the read models trust the table files unchecked
+    checkpoint_bytes = 16 * 1024 * 1024  # of replication log between checkpoints
+
+    def __init__(self, db_name, schema_file, result_cache_bytes=0,
+                 replicas=(), max_replica_lag=1.0):
+        self.db = Database(db_name, schema_file,
+                           result_cache_bytes=result_cache_bytes,
+                           replication_log=bool(replicas))
+        # plain reads go to the replicas, writes and the reads that must see
+        # them (login, caches, checks before a write) go to self.db
+        self.replicas = [Database(name, schema_file,
+                                  result_cache_bytes=result_cache_bytes,
+                                  replica_of=self.db)
+                         for name in replicas]
+        for replica in self.replicas:
+            replica.follow()
+        self.max_replica_lag = max_replica_lag
+        self._replica_cycle = cycle(self.replicas)
+        self._checkpoint_lock = Lock()
+        self._checkpointed_size = 0  # of the log after the last checkpoint
+        # in-process read models, kept in sync by the write methods below;
+        # writes of other processes are noticed by the stamps of the tables
+        self._cache_lock = RLock()
+        self._timeline = None  # first page of tweets, newest first
+        self._user_likes = OrderedDict()  # user_id -> liked tweet ids (LRU)
+        self._seen = {}  # table name -> (version, stamp, time) the models are valid at
+
+    def reader(self):
+        '''next replica at most max_replica_lag behind, or the primary'''
+        if not self.replicas:
+            return self.db
+
+        with self._cache_lock:
+            replica = next(self._replica_cycle)
+        if replica.replica_lag() > self.max_replica_lag:
+            replica.catch_up()
+        return replica
+
+    def page_tag(self, user_id, *table_names, db=None):
+        '''ETag of a page built for user_id from table_names of db and the
+        read models, take it before reading them'''
+        if db is None or db is self.db:
+            with self._cache_lock:
+                return '-'.join([str(user_id), *map(self._valid_stamp, table_names)])
+        return f'{user_id}-{db.change_tag(*table_names)}'
+
+    def _valid_stamp(self, table_name):
+        '''stamp of the table that the read models are valid at, the file is
+        only looked at after a change in this process or every stamp_ttl
+        seconds; models read before another process changed it are dropped'''
+        table = self.db[table_name]
+        seen = self._seen.get(table_name)
+        now = time.monotonic()
+        if seen is not None and seen[0] == table.version and now - seen[2] < self.stamp_ttl:
+            return seen[1]
+        stamp = table.stamp()
+        if seen is None or seen[1] != stamp:
+            if table_name == 'tweets':
+                self._timeline = None
+            elif table_name == 'tweet_likes':
+                self._user_likes.clear()
+        self._seen[table_name] = table.version, stamp, now
+        return stamp
+
+    def _wrote(self, *table_names):
+        '''after a write whose changes are already in the read models'''
+        for table_name in table_names:
+            table = self.db[table_name]
+            self._seen[table_name] = table.version, table.stamp(), time.monotonic()
+
+    def _checkpoint_if_due(self):
+        '''after a write: once the log grew by checkpoint_bytes, checkpoint
+        the primary, dropping the entries the replicas have applied'''
+        log = self.db.replication_log
+        if log is None or log.size() - self._checkpointed_size < self.checkpoint_bytes:
+            return
+        with self._checkpoint_lock:
+            if log.size() - self._checkpointed_size >= self.checkpoint_bytes:
+                self.db.checkpoint()
+                self._checkpointed_size = log.size()
 
     def add_user(self, username, password):
         now = datetime.utcnow()
         q = f"INSERT INTO users VALUES ('{username}', '{password}', '{now}');"
         try:
-            return self.db.run_query(q)[0]
+            user_id = self.db.run_query(q)[0]
         except IndexError:
             return
+        self._checkpoint_if_due()
+        return user_id
 
     def get_user(self, username, password):
         q = f"SELECT FROM users WHERE username == '{username}' and password == '{password}';"
@@ -37,6 +127,15 @@ class CURD(object):
         except IndexError:
             return
 
+    def get_user_by_username(self, username, db=None):
+        if "'" in username or '\\' in username:
+            return  # it can't be put in the string of a query
+        q = f"SELECT FROM users WHERE username == '{username}';"
+        try:
+            return (db or self.db).run_query(q)[0]
+        except IndexError:
+            return
+
     def add_tweet(self, user_id, text: str = None, retweet_id: int = None):
         try:
             user = self.get_user_by_id(user_id)
@@ -49,7 +148,7 @@ class CURD(object):
             retweet_id = 0
             retweet_username = ''
         elif retweet_id:
-            retweet = self.get_tweet(retweet_id)
+            retweet = self.get_tweet(retweet_id, primary=True)
             retweet_id = retweet['id']
             retweet_username = retweet['user_username']
             if user['username'] == retweet_username:
@@ -60,83 +159,169 @@ class CURD(object):
 
         text = text.replace("'", "\\'")
         q = f"INSERT INTO tweets VALUES ('{user['id']}', '{user['username']}', '{text}', '{now}', '{retweet_id}', '{retweet_username}', 0);"
-        try:
-            return self.db.run_query(q)[0]
-        except IndexError:
-            return
-
-    def get_tweet(self, tweet_id):
+        with self._cache_lock:
+            self._valid_stamp('tweets')  # drops the timeline other processes changed
+            try:
+                tweet_id = self.db.run_query(q)[0]
+            except IndexError:
+                return
+
+            if self._timeline is not None:
+                q = f"SELECT FROM tweets WHERE id == {tweet_id};"
+                self._timeline.insert(0, self._unescape(self.db.run_query(q)[0]))
+                del self._timeline[self.timeline_size:]
+            self._wrote('tweets')
+        self._checkpoint_if_due()
+        return tweet_id
+
+    @staticmethod
+    def _unescape(tweet):
+        tweet['text'] = tweet['text'].replace('\\n', '\n').replace("\\'", "'")
+        return tweet
+
+    def get_tweet(self, tweet_id, primary=False):
         q = f"SELECT FROM tweets WHERE id == '{tweet_id}';"
+        db = self.db if primary else self.reader()
         try:
-            t = self.db.run_query(q)[0]
-            t['text'] = t['text'].replace('\\n', '\n').replace("\\'", "'")
-            return t
+            return self._unescape(db.run_query(q)[0])
         except IndexError:
             return
 
-    def get_tweets(self, limit=20):
+    def _load_tweets(self, limit, before=None, db=None):
         q = "SELECT FROM tweets;"
-        tweets = self.db.run_query(q, select_limit=limit, select_reverse=True)
-        for t in tweets:
-            t['text'] = t['text'].replace('\\n', '\n').replace("\\'", "'")
-        return tweets
+        tweets = (db or self.reader()).run_query(
+            q, select_limit=limit, select_reverse=True, select_before=before)
+        return [self._unescape(t) for t in tweets]
+
+    def get_tweets(self, limit=20, before=None, db=None):
+        if before is not None or limit > self.timeline_size:
+            return self._load_tweets(limit, before, db)
+
+        with self._cache_lock:
+            self._valid_stamp('tweets')  # before reading, never after
+            if self._timeline is None:
+                self._timeline = self._load_tweets(self.timeline_size, db=self.db)
+            return [t.copy() for t in self._timeline[:limit]]
+
+    def get_user_tweets(self, user_id, limit=20, before=None, db=None):
+        '''a page of the tweets of a user, newest first, looked up from the
+        index of tweets.user_id'''
+        q = f"SELECT FROM tweets WHERE user_id == {user_id};"
+        tweets = (db or self.reader()).run_query(
+            q, select_limit=limit, select_reverse=True, select_before=before)
+        return [self._unescape(t) for t in tweets]
+
+    def _liked_set(self, user_id):
+        with self._cache_lock:
+            self._valid_stamp('tweet_likes')
+            if user_id in self._user_likes:
+                self._user_likes.move_to_end(user_id)
+                return self._user_likes[user_id]
+
+            q = f"SELECT FROM tweet_likes WHERE user_id == {user_id};"
+            liked = {like['tweet_id'] for like in self.db.run_query(q)}
+            self._user_likes[user_id] = liked
+            while len(self._user_likes) > self.likes_cache_users:
+                self._user_likes.popitem(last=False)
+            return liked
+
+    def search_tweets(self, query, limit=20, before=None):
+        query = query.replace("'", ' ').replace('\\', ' ')
+        q = f"SELECT FROM tweets WHERE text CONTAINS '{query}';"
+        tweets = self.reader().run_query(q, select_limit=limit, select_reverse=True,
+                                          select_before=before)
+        return [self._unescape(t) for t in tweets]
 
     def is_liker(self, user_id, tweet_id):
-        q = f"SELECT FROM tweet_likes WHERE tweet_id == {tweet_id} AND user_id == {user_id};"
-        liked = self.db.run_query(q, select_limit=1)
-        return bool(liked)
+        return tweet_id in self._liked_set(user_id)
 
-    def get_user_likes(self, user_id, limit=20):
+    def get_user_likes(self, user_id, db=None):
+        '''from the read model, or straight from db when it is a replica'''
+        if db is None or db is self.db:
+            return frozenset(self._liked_set(user_id))
         q = f"SELECT FROM tweet_likes WHERE user_id == {user_id};"
-        likes = self.db.run_query(q, select_limit=limit, select_reverse=True)
-        return [like['tweet_id'] for like in likes]
+        return frozenset(like['tweet_id'] for like in db.run_query(q))
 
     def switch_like_tweet(self, user_id, tweet_id):
-        q = f"SELECT FROM tweets WHERE id == {tweet_id};"
-        t = self.db.run_query(q, select_limit=1)
-        if not t:
-            raise ValueError("tweet not found")
-        t = t[0]
-
-        if self.is_liker(user_id, tweet_id):
-            q = f"DELETE FROM tweet_likes WHERE user_id == {user_id} AND tweet_id == {tweet_id};"
-            q += f"UPDATE tweets WHERE id == {tweet_id} VALUES "
-            q += f" ('{t['user_id']}', '{t['user_username']}', '{t['text']}',"
-            q += f"'{t['posted_at']}', '{t['retweet_id']}', '{t['retweet_from_username']}', '{t['likes']-1}');"
-            self.db.run_query(q)
-        else:
-            q = f"INSERT INTO tweet_likes VALUES ({tweet_id}, {user_id});"
-            q += f"UPDATE tweets WHERE id == {tweet_id} VALUES "
-            q += f" ('{t['user_id']}', '{t['user_username']}', '{t['text']}',"
-            q += f"'{t['posted_at']}', '{t['retweet_id']}', '{t['retweet_from_username']}', '{t['likes']+1}');"
+        with self._cache_lock:
+            self._valid_stamp('tweets')
+            self._valid_stamp('tweet_likes')
+            liked = self._switch_like(user_id, tweet_id)
+
+            likes = self._user_likes.get(user_id)
+            if likes is not None:
+                if liked:
+                    likes.discard(tweet_id)
+                else:
+                    likes.add(tweet_id)
+            for cached in self._timeline or ():
+                if cached['id'] == tweet_id:
+                    cached['likes'] += -1 if liked else 1
+            self._wrote('tweets', 'tweet_likes')
+        self._checkpoint_if_due()
+
+    def _switch_like(self, user_id, tweet_id):
+        '''likes or unlikes the tweet, returns whether it was liked before'''
+        with self.db.transaction() as tx:  # the counter and the like change together
+            # the check holds until the end, nobody else can like meanwhile
+            tx.lock('tweets', 'tweet_likes')
+            q = f"SELECT FROM tweet_likes WHERE user_id == {user_id} AND tweet_id == {tweet_id};"
+            liked = bool(self.db.run_query(q, select_limit=1))
+
+            q = f"UPDATE tweets SET likes = likes {'-' if liked else '+'} 1 WHERE id == {tweet_id};"
+            if not self.db.run_query(q):
+                raise ValueError("tweet not found")
+
+            if liked:
+                q = f"DELETE FROM tweet_likes WHERE user_id == {user_id} AND tweet_id == {tweet_id};"
+            else:
+                q = f"INSERT INTO tweet_likes VALUES ({tweet_id}, {user_id});"
             self.db.run_query(q)
+        return liked
 
     def get_tweet_likes_count(self, tweet_id):
         q = f"SELECT FROM tweet_likes WHERE tweet_id == {tweet_id};"
-        return len(self.db.run_query(q))
+        return len(self.reader().run_query(q))
 
-    def get_tweet_likers(self, tweet_id):
+    def get_tweet_likers(self, tweet_id, limit=20, before=None, db=None):
+        '''returns a page of likers and the cursor of the next page'''
+        db = db or self.reader()
         q = f"SELECT FROM tweet_likes WHERE tweet_id == {tweet_id};"
-        likes = self.db.run_query(q)
+        likes = db.run_query(q, select_limit=limit, select_reverse=True,
+                             select_before=before)
+        next_before = likes[-1]['id'] if len(likes) == limit else None
         ors = set()
         for like in likes:
             ors.add(f"id == {like['user_id']}")
 
         where = ' OR '.join(ors)
         if not where:
-            return []
+            return [], None
 
         q = f"SELECT FROM users WHERE {where};"
-        return self.db.run_query(q)
+        return db.run_query(q), next_before
+
+    def delete_tweet(self, user_id, tweet_id):
+        q = f"DELETE FROM tweets WHERE id == {tweet_id} AND user_id == {user_id};"
+        with self._cache_lock:
+            self._valid_stamp('tweets')
+            results = self.db.run_query(q)
 
-    def delete_tweet(self, tweet_id):
-        q = f"DELETE FROM tweets WHERE id == {tweet_id} AND user_id == {current_user.id};"
-        return self.db.run_query(q)
+            timeline = self._timeline or []
+            kept = [t for t in timeline if t['id'] != tweet_id or t['user_id'] != user_id]
+            if len(kept) < len(timeline):
+                # the page is one tweet short now, the next older one fills it
+                kept += self._load_tweets(1, before=timeline[-1]['id'], db=self.db)
+                self._timeline = kept
+            self._wrote('tweets')
+        self._checkpoint_if_due()
+        return results
 
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = flask_secret_key
-curd = CURD(db_name, db_schema_file)
+curd = CURD(db_name, db_schema_file, result_cache_bytes=db_result_cache_bytes,
+            replicas=db_replicas, max_replica_lag=db_max_replica_lag)
 login_manager = LoginManager()
 login_manager.init_app(app)
 
@@ -162,6 +347,19 @@ class User(object):
         return False
 
 
+def not_modified(etag):
+    '''True when the browser's copy of the page is still etag'''
+    return request.if_none_match.contains_weak(etag)
+
+
+def tagged(etag, body='', status=200):
+    '''response the browser keeps, but revalidates on every load'''
+    response = make_response(body, status)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+
 @login_manager.user_loader
 def load_user(user_id):
     return User(user_id)
@@ -233,15 +431,73 @@ def logout():
 @app.route("/")
 @login_required
 def tweets():
-    tweets = curd.get_tweets()
+    limit = 20
+    before = request.args.get('before', type=int)
+    # the first page comes from the primary's cache, older ones from a replica
+    db = None if before is None else curd.reader()
+    etag = curd.page_tag(current_user.id, 'tweets', 'tweet_likes', db=db)
+    if not_modified(etag):
+        return tagged(etag, status=304)
+
+    tweets = curd.get_tweets(limit=limit, before=before, db=db)
+    my_likes = curd.get_user_likes(current_user.id, db=db)
+    my_tweets = [t['id'] for t in filter(
+        lambda t: t['user_id'] == current_user.id, tweets)]
+    next_before = tweets[-1]['id'] if len(tweets) == limit else None
+    return tagged(etag, render_template('tweets.html',
+                                        tweets=tweets,
+                                        me=current_user,
+                                        my_likes=my_likes,
+                                        my_tweets=my_tweets,
+                                        next_before=next_before))
+
+
+@app.route("/search")
+@login_required
+def search():
+    limit = 20
+    query = request.args.get('q', '').strip()
+    before = request.args.get('before', type=int)
+    if not query:
+        return redirect(url_for('tweets'))
+    tweets = curd.search_tweets(query, limit=limit, before=before)
     my_likes = curd.get_user_likes(current_user.id)
     my_tweets = [t['id'] for t in filter(
         lambda t: t['user_id'] == current_user.id, tweets)]
+    next_before = tweets[-1]['id'] if len(tweets) == limit else None
     return render_template('tweets.html',
                            tweets=tweets,
+                           query=query,
                            me=current_user,
                            my_likes=my_likes,
-                           my_tweets=my_tweets)
+                           my_tweets=my_tweets,
+                           next_before=next_before)
+
+
+@app.route("/u/<username>")
+@login_required
+def profile(username):
+    limit = 20
+    before = request.args.get('before', type=int)
+    db = curd.reader()
+    etag = curd.page_tag(current_user.id, 'users', 'tweets', 'tweet_likes', db=db)
+    if not_modified(etag):
+        return tagged(etag, status=304)
+
+    user = curd.get_user_by_username(username, db=db)
+    if not user:
+        raise NotFound()
+    tweets = curd.get_user_tweets(user['id'], limit=limit, before=before, db=db)
+    my_likes = curd.get_user_likes(current_user.id, db=db)
+    my_tweets = [t['id'] for t in tweets] if user['id'] == current_user.id else []
+    next_before = tweets[-1]['id'] if len(tweets) == limit else None
+    return tagged(etag, render_template('tweets.html',
+                                        tweets=tweets,
+                                        profile=user,
+                                        me=current_user,
+                                        my_likes=my_likes,
+                                        my_tweets=my_tweets,
+                                        next_before=next_before))
 
 
 @app.route("/like/<int:tweet_id>")
@@ -289,15 +545,23 @@ def tweet():
 @app.route("/delete_tweet/<int:tweet_id>")
 @login_required
 def delete_tweet(tweet_id):
-    curd.delete_tweet(tweet_id)
+    curd.delete_tweet(current_user.id, tweet_id)
     return redirect(url_for('tweets'))
 
 
 @app.route("/likes/<int:tweet_id>")
 @login_required
 def likes(tweet_id):
-    likers = curd.get_tweet_likers(tweet_id)
-    return render_template('likes.html', likers=likers)
+    before = request.args.get('before', type=int)
+    db = curd.reader()
+    etag = curd.page_tag(current_user.id, 'tweet_likes', 'users', db=db)
+    if not_modified(etag):
+        return tagged(etag, status=304)
+
+    likers, next_before = curd.get_tweet_likers(tweet_id, before=before, db=db)
+    return tagged(etag, render_template('likes.html', likers=likers,
+                                        tweet_id=tweet_id,
+                                        next_before=next_before))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,263 @@
+from functools import wraps
+from flask import Flask, render_template, redirect, url_for, request, flash, \
+    current_app
+from flask_login import LoginManager, logout_user, current_user, login_user
+from flask_login.config import EXEMPT_METHODS
+from werkzeug.exceptions import NotFound, BadRequest
+from asgiref.wsgi import WsgiToAsgi
+from database import AsyncDatabase
+from twitter import User, curd, flask_secret_key, load_user, \
+    unauthorized_callback, not_modified, tagged
+
+
+db_io_workers = 16
+
+
+# Flask runs every coroutine view to the end in the thread of its request.
+# Under an ASGI server (asgi_app below) WsgiToAsgi gives every request a
+# thread of its own, under a WSGI server the server's threads serve them.
+# Either way the database calls of all those threads go through one
+# bounded pool of db_io_workers threads.
+
+
+class AsyncCURD(object):
+    '''Awaitable version of every CURD method, the calls run in the
+    bounded I/O pool of an AsyncDatabase over the same Database.'''
+
+    def __init__(self, curd, max_workers=8):
+        self.curd = curd
+        self.adb = AsyncDatabase(curd.db, max_workers=max_workers)
+
+    def __getattr__(self, name):
+        method = getattr(self.curd, name)
+
+        async def call(*args, **kwargs):
+            return await self.adb.run(method, *args, **kwargs)
+
+        call.__name__ = name
+        return call
+
+
+def login_required(func):
+    '''flask_login.login_required for coroutine views'''
+    @wraps(func)
+    async def decorated_view(*args, **kwargs):
+        if request.method in EXEMPT_METHODS \
+                or current_app.config.get('LOGIN_DISABLED'):
+            return await func(*args, **kwargs)
+        if not current_user.is_authenticated:
+            return current_app.login_manager.unauthorized()
+        return await func(*args, **kwargs)
+    return decorated_view
+
+
+app = Flask(__name__)
+app.config['SECRET_KEY'] = flask_secret_key
+acurd = AsyncCURD(curd, max_workers=db_io_workers)
+login_manager = LoginManager()
+login_manager.init_app(app)
+login_manager.user_loader(load_user)
+login_manager.unauthorized_handler(unauthorized_callback)
+
+
+@app.route('/login', methods=['GET', 'POST'])
+async def login():
+    if current_user.is_authenticated:
+        return redirect(url_for('tweets'))
+
+    if request.method == 'POST':
+        username = request.form.get('username')
+        password = request.form.get('password')
+        if not username or not password:
+            flash('username or password is wrong.', 'danger')
+            return render_template('login.html')
+
+        user = await acurd.get_user(username, password)
+        if user:
+            user_id = f"{user['username']}:{user['id']}"
+            login_user(User(user_id))
+            return redirect(url_for('tweets'))
+        else:
+            flash('username or password is wrong.', 'danger')
+
+    return render_template('login.html')
+
+
+@app.route('/register', methods=['GET', 'POST'])
+async def register():
+    if current_user.is_authenticated:
+        return redirect(url_for('tweets'))
+
+    if request.method == 'POST':
+        username = request.form.get('username')
+        password = request.form.get('password')
+        if not username or not password:
+            flash('username or password is wrong.', 'danger')
+            return render_template('register.html')
+
+        try:
+            user = await acurd.add_user(username, password)
+            if user:
+                flash('User registered successfully, login now!', 'success')
+                return redirect(url_for('login'))
+            else:
+                flash('Something went wrong!', 'danger')
+        except ValueError as err:
+            if 'duplicate' in str(err):
+                flash('This username already exists', 'danger')
+            else:
+                flash('Something went wrong!', 'danger')
+
+    return render_template('register.html')
+
+
+@app.route("/logout")
+@login_required
+async def logout():
+    logout_user()
+    return redirect(url_for('login'))
+
+
+@app.route("/")
+@login_required
+async def tweets():
+    limit = 20
+    before = request.args.get('before', type=int)
+    db = None if before is None else await acurd.reader()
+    etag = await acurd.page_tag(current_user.id, 'tweets', 'tweet_likes', db=db)
+    if not_modified(etag):
+        return tagged(etag, status=304)
+
+    tweets = await acurd.get_tweets(limit=limit, before=before, db=db)
+    my_likes = await acurd.get_user_likes(current_user.id, db=db)
+    my_tweets = [t['id'] for t in filter(
+        lambda t: t['user_id'] == current_user.id, tweets)]
+    next_before = tweets[-1]['id'] if len(tweets) == limit else None
+    return tagged(etag, render_template('tweets.html',
+                                        tweets=tweets,
+                                        me=current_user,
+                                        my_likes=my_likes,
+                                        my_tweets=my_tweets,
+                                        next_before=next_before))
+
+
+@app.route("/search")
+@login_required
+async def search():
+    limit = 20
+    query = request.args.get('q', '').strip()
+    before = request.args.get('before', type=int)
+    if not query:
+        return redirect(url_for('tweets'))
+    tweets = await acurd.search_tweets(query, limit=limit, before=before)
+    my_likes = await acurd.get_user_likes(current_user.id)
+    my_tweets = [t['id'] for t in filter(
+        lambda t: t['user_id'] == current_user.id, tweets)]
+    next_before = tweets[-1]['id'] if len(tweets) == limit else None
+    return render_template('tweets.html',
+                           tweets=tweets,
+                           query=query,
+                           me=current_user,
+                           my_likes=my_likes,
+                           my_tweets=my_tweets,
+                           next_before=next_before)
+
+
+@app.route("/u/<username>")
+@login_required
+async def profile(username):
+    limit = 20
+    before = request.args.get('before', type=int)
+    db = await acurd.reader()
+    etag = await acurd.page_tag(current_user.id, 'users', 'tweets', 'tweet_likes', db=db)
+    if not_modified(etag):
+        return tagged(etag, status=304)
+
+    user = await acurd.get_user_by_username(username, db=db)
+    if not user:
+        raise NotFound()
+    tweets = await acurd.get_user_tweets(user['id'], limit=limit, before=before,
+                                         db=db)
+    my_likes = await acurd.get_user_likes(current_user.id, db=db)
+    my_tweets = [t['id'] for t in tweets] if user['id'] == current_user.id else []
+    next_before = tweets[-1]['id'] if len(tweets) == limit else None
+    return tagged(etag, render_template('tweets.html',
+                                        tweets=tweets,
+                                        profile=user,
+                                        me=current_user,
+                                        my_likes=my_likes,
+                                        my_tweets=my_tweets,
+                                        next_before=next_before))
+
+
+@app.route("/like/<int:tweet_id>")
+@login_required
+async def like(tweet_id):
+    await acurd.switch_like_tweet(current_user.id, tweet_id)
+    return redirect(url_for('tweets') + f'#t{tweet_id}')
+
+
+@app.route("/retweet/<int:tweet_id>")
+@login_required
+async def retweet(tweet_id):
+    tweet = await acurd.get_tweet(tweet_id)
+    if not tweet:
+        raise NotFound()
+    return render_template('retweet.html', tweet=tweet)
+
+
+@app.route("/retweet_confirm/<int:tweet_id>")
+@login_required
+async def retweet_confirm(tweet_id):
+    try:
+        tweet_id = await acurd.add_tweet(current_user.id, retweet_id=tweet_id)
+    except (TypeError, ValueError) as err:
+        if str(err) == 'You cannot retweet your own tweet':
+            raise BadRequest('You cannot retweet your own tweet')
+        raise NotFound()
+    return redirect(url_for('tweets') + f'#t{tweet_id}')
+
+
+@app.route("/tweet", methods=['POST'])
+@login_required
+async def tweet():
+    text = request.form.get('text')
+    if not text:
+        raise BadRequest()
+    try:
+        tweet_id = await acurd.add_tweet(current_user.id, text)
+    except ValueError as err:
+        print(err)
+        raise BadRequest()
+    return redirect(url_for('tweets') + f'#t{tweet_id}')
+
+
+@app.route("/delete_tweet/<int:tweet_id>")
+@login_required
+async def delete_tweet(tweet_id):
+    await acurd.delete_tweet(current_user.id, tweet_id)
+    return redirect(url_for('tweets'))
+
+
+@app.route("/likes/<int:tweet_id>")
+@login_required
+async def likes(tweet_id):
+    before = request.args.get('before', type=int)
+    db = await acurd.reader()
+    etag = await acurd.page_tag(current_user.id, 'tweet_likes', 'users', db=db)
+    if not_modified(etag):
+        return tagged(etag, status=304)
+
+    likers, next_before = await acurd.get_tweet_likers(tweet_id, before=before,
+                                                       db=db)
+    return tagged(etag, render_template('likes.html', likers=likers,
+                                        tweet_id=tweet_id,
+                                        next_before=next_before))
+
+
+# serve with any ASGI server, e.g. `uvicorn twitter_async:asgi_app`
+asgi_app = WsgiToAsgi(app)
+
+
+if __name__ == '__main__':
+    app.run(debug=True)